@@ -1,46 +1,58 @@
-import io
+import time
+
+# taken before anything else is imported, so --measure-startup includes the imports
+STARTUP_START = time.perf_counter()
+
+import argparse
 import math
 import os
-import time
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pygame
-from PIL import Image
 
 from components.button import Button
+from components.clock import Clock
+from components.event_log import EventRecorder
+from components.fonts import load_font
+from components.frame_scheduler import FrameScheduler
+from components.image_view import ImageView
+from components.mouse_state import MouseState
+from components.perf_hud import PerfHud
 from components.slider import Slider
+from components.text_cache import render_text
 from components.toast import Toast
-
-
-def is_valid_img_path(im_path):
-    """
-    Validate img path and file type
-    """
-    return (os.path.exists(im_path)
-            and os.path.isfile(im_path)
-            and os.path.splitext(im_path)[1].lower() in [".jpeg",  # check if file is jpeg
-                                                         ".jpg"])
-
-
-def format_byte_count(total_bytes):
-    """
-    Format byte size to human-readable format
-    """
-    if total_bytes == 0:
-        return "0B"
-    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-
-    # store the power of 1024 which is nearest to total bytes,
-    # this power will be the index of size_name
-    power_of_1024 = int(math.floor(math.log(total_bytes, 1024)))
-    converted_bytes = round(total_bytes / (1024 ** power_of_1024), 2)
-
-    return f"{converted_bytes} {size_name[power_of_1024]}"
+from processing.encoders import (DEFAULT_ENCODER, DEFAULT_SETTINGS, ENCODERS,
+                                 METADATA_CHOICES, SUBSAMPLINGS, format_setting,
+                                 get_encoder, get_jpeg_mcu_size, get_other_choice,
+                                 read_metadata, resolve_settings)
+from processing.image_store import (DEFAULT_MAX_BYTES, ImageStore, StoredImage,
+                                    get_resident_memory)
+from processing.pipeline import (buffer_to_pil, format_byte_count,
+                                 get_modified_img_path, is_valid_img_path,
+                                 parse_byte_count, pil_to_rgb_buffer, scale_resolution)
+from processing.preview_cache import PreviewCache, make_cache_key
+from processing.profiler import StartupTimer, profiler
+from processing.result_cache import (DEFAULT_MAX_BYTES as DEFAULT_CACHE_MAX_BYTES,
+                                     ResultCache, get_default_cache_dir,
+                                     get_encode_params, get_params_id, hash_file)
+from processing.surfaces import buffer_to_surface
 
 
 # Main application class
 class App:
-    def __init__(self) -> None:
+    def __init__(self, max_image_memory=DEFAULT_MAX_BYTES, profile=False,
+                 encoder=DEFAULT_ENCODER, encoder_settings=None,
+                 result_cache=None, font_name=None, startup_timer=None, clock=None,
+                 record_path=None) -> None:
+        # times each phase until the first frame is on screen, printed by loop if
+        # startup_timer was given
+        self.is_startup_printed = startup_timer is not None
+        self.startup_timer = startup_timer or StartupTimer()
+
         pygame.init()
+        self.startup_timer.mark("pygame.init")
 
         self.screen = pygame.display.set_mode((1080, 620), flags=pygame.RESIZABLE)
         self.pad = 20
@@ -49,6 +61,7 @@ class App:
             pygame.display.set_caption("Image Quality Modifier", "Image Quality Modifier")
         except Exception as e:
             print(e)
+        self.startup_timer.mark("window")
 
         # RGB colors
         self.img_info_text_bg = pygame.Color("#191c20")
@@ -74,7 +87,29 @@ class App:
 
         # text
         self.info_text_height = 0
-        self.font = pygame.font.SysFont(None, 24)
+        self.target_size_text = None  # size being typed in target size mode
+        self.quality_target_text = None  # SSIM or PSNR being typed in quality mode
+        # the path of a named font is kept in the cache folder, so only the first run
+        # searches the installed fonts for it
+        self.font = load_font(font_name, 24,
+                              os.path.join(get_default_cache_dir(), "fonts.json"))
+        self.startup_timer.mark("font")
+
+        # only draws frames when something on screen changed. Everything which waits
+        # reads the time from clock, which replays of recorded sessions replace
+        self.clock = clock or Clock()
+        self.scheduler = FrameScheduler(clock=self.clock)
+        self.REDRAW_EVENTS = (pygame.VIDEORESIZE, pygame.VIDEOEXPOSE,
+                              pygame.WINDOWEXPOSED, pygame.WINDOWSIZECHANGED,
+                              pygame.WINDOWRESTORED)
+
+        # the mouse is followed through its events, and with record_path every event
+        # is written there so the session can be replayed by benchmarks/replay.py
+        self.mouse = MouseState()
+        self.event_recorder = None
+        if record_path is not None:
+            self.event_recorder = EventRecorder(record_path, self.screen.get_size(),
+                                                self.clock)
 
         # image variables
         self.predicted_img_size = None
@@ -84,22 +119,125 @@ class App:
         self.new_img_res = (0, 0)
         self.img_extension = None
         self.original_img_path = None
+        self.img_source_key = None  # identifies the loaded file in the preview cache
         self.modified_img_path = None
         self.img_info_dict = {"Original Image Resolution": "",
                               "New Image Resolution": "",
                               "Save path": "",
                               "Quality": "",
-                              "Size": ""
+                              "Size": "",
+                              "Preview cache": "",
+                              "Size estimate error": "",
+                              "Quality score": "",
+                              "Memory": "",
+                              "Queue": "",
+                              "Format sizes": "",
+                              "Format encode times": "",
+                              "Encoder settings": "",
+                              "Viewport preview": "",
+                              "Block cost": ""
                               }
         self.drag_delta = (0, 0)  # amount mouse was dragged in x-axis and y-axis
         self.zoom = 1.0  # stores the current zoom level
         self.MIN_ZOOM = 0.3
         self.MAX_ZOOM = 5.0
 
+        # The workers below, and the Pillow they import, are only made by
+        # start_pipeline once the first frame is on screen, so the window opens sooner
+        self.is_pipeline_started = False
+        self.max_image_memory = max_image_memory
+
         # image surface
+        # decodes each image once, images over max_image_memory are kept on disk
+        self.image_store = None
+        self.stored_img = None  # the loaded image once it is fully decoded
+        self.orig_rgb_buffer = None  # decoded pixels of original image, shared by both
+        self.orig_pil_img = None  # views below without being copied
         self.orig_img_surface = None  # to maintain a copy of original image in memory
         self.modified_img_surface = None  # stores image with new quality and resolution
-        self.active_img_surface = None  # this image  is what is visible as image preview
+        # draws only the visible part of modified_img_surface at the current zoom
+        self.img_view = ImageView()
+        self.full_decode_future = None  # full resolution decode of the loaded image
+        self.target_size_solver = None  # remembers encoded sizes of the loaded image
+        self.target_size_result = None  # (quality, resolution, size) found last
+        self.target_size_future = None
+        # (image, encoder, settings, max bytes) searched last
+        self.target_size_request = None
+        self.size_estimator = None  # predicts sizes of the loaded image without encoding
+
+        # quality mode searches for the lowest quality reaching an SSIM or PSNR target.
+        # Scores are measured on at most METRIC_MAX_PIXELS pixels
+        self.METRIC_MAX_PIXELS = 1_000_000
+        self.quality_target_solver = None  # remembers scores of the loaded image
+        # target size and quality mode search one after the other on their own thread
+        self.search_executor = None
+        self.quality_target_future = None
+        # (image, encoder, settings, metric, target) searched last
+        self.quality_target_request = None
+        # searches asked for while the full resolution image was still being decoded,
+        # started by start_pending_searches once it is
+        self.pending_target_size = None  # max bytes
+        self.pending_quality_target = None  # (metric, target)
+
+        # previews are encoded on a background thread and kept in a cache so that
+        # settings which were already seen are shown instantly
+        self.PREVIEW_CACHE_MAX_BYTES = 256 * 1024 * 1024
+        self.preview_cache = None
+        self.preview_worker = None
+        self.last_preview_request = None  # (quality, resolution) requested last
+        self.shown_preview_key = None  # cache key of modified_img_surface, if encoded
+
+        # zoomed in, only the part of the image inside the window is encoded, on a
+        # second worker so it is not held up by whole images. It is aligned to the
+        # blocks of the encoder, so its artifacts are exactly those of the whole
+        # image, and is drawn over the whole preview
+        self.VIEWPORT_MAX_FRACTION = 0.5  # of the image which may be visible, at most
+        self.VIEWPORT_GRID = 64  # the part is snapped outwards to this many pixels
+        self.viewport_worker = None
+        self.is_viewport_mode = False  # if a part is previewed instead of the image
+        self.viewport_key = None  # cache key of the part requested last
+        self.viewport_preview = None  # the newest part, like a viewport_worker result
+        self.viewport_scaled = None  # (key, surface) of the part scaled to the window
+
+        # how many bits JPEG spends on each block is measured in the background once
+        # the image is decoded. H shows it over the preview with the crop which saves
+        # the most, and the info text suggests a crop and a resolution
+        self.block_cost_map = None
+        self.block_cost_suggestions = None  # {"crop", "scale"} once the map is ready
+        self.is_heatmap_shown = False
+        self.heatmap_view = ImageView()  # one pixel per block, scaled like the image
+        self.heatmap_key = None  # (block cost map, block size) of heatmap_view
+
+        # saves are encoded and written in the background, one after another. The
+        # result cache keeps saved encodes on disk across runs, and the sizes it knows
+        # for the loaded image are shown on the sliders instead of the estimate
+        self.result_cache = result_cache
+        self.img_cached_results = {}  # params id -> metadata of the loaded image
+        self.img_source_digest = None  # hash of the loaded file, None until known
+        self.save_worker = None
+
+        # previews and saves use the selected encoder, E switches to the next one. Every
+        # encoder is tried on the current settings in the background to compare them
+        self.encoder_name = encoder
+        self.encoder_comparison = None
+
+        # O, P, S and M change the encoder settings. The bytes each one saves are
+        # measured along with the encoder comparison
+        self.encoder_settings = dict(encoder_settings or DEFAULT_SETTINGS)
+        self.img_metadata = {}  # EXIF and ICC profile of the loaded image
+        # encoder_settings with the metadata of the loaded image, used by every encode
+        self.encode_settings = resolve_settings(self.encoder_settings, {})
+        self.SETTING_KEYS = {pygame.K_o: "optimize", pygame.K_p: "progressive",
+                             pygame.K_s: "subsampling", pygame.K_m: "metadata"}
+
+        # files dropped together are queued, the next ones are decoded ahead of time
+        # so switching to them is instant
+        self.PREFETCH_COUNT = 2
+        self.prefetcher = None
+        self.img_queue = []  # paths of every image dropped in this session
+        self.img_queue_index = -1  # position of the loaded image in img_queue
+        self.img_settings = {}  # path -> sliders, zoom and drag of images switched away
+        self.is_first_file_of_drop = True
 
         # save button
         self.save_btn = Button(self.save_btn_bg, self.save_btn_hover_bg,
@@ -109,7 +247,15 @@ class App:
                                (80, 40), (0, 0))
 
         # A toast component used to display popup messages
-        self.toast = Toast("", self.font, 5, toast_fg, toast_bg)
+        self.toast = Toast("", self.font, 5, toast_fg, toast_bg, self.clock)
+
+        # F3 shows frame and work timings, F4 saves the last seconds as a trace file.
+        # Timings are only recorded while the overlay is shown, or always with profile
+        self.always_profile = profile
+        self.TRACE_SECONDS = 10
+        profiler.set_enabled(profile)
+        self.perf_hud = PerfHud(profiler, self.font, self.img_info_text_color,
+                                self.img_info_text_bg, clock=self.clock)
 
         # two sliders used for changing resolution and quality of image
         self.resolution_slider = Slider(slider_bg, slider_fg, slider_text_color,
@@ -124,140 +270,1199 @@ class App:
 
         #  "Drag an image here" message on app launch
         self.toast.show("Drag and drop an image here")
+        self.startup_timer.mark("components")
+
+    def start_pipeline(self):
+        """
+        Makes the image store, caches and background workers. Their modules import
+        Pillow and start threads, which the first frame does not need
+        """
+        from processing.encoder_comparison import EncoderComparison
+        from processing.prefetcher import ImagePrefetcher
+        from processing.preview_worker import PreviewWorker
+        from processing.save_worker import SaveWorker
+
+        self.image_store = ImageStore(self.max_image_memory)
+        self.search_executor = ThreadPoolExecutor(max_workers=1,
+                                                  thread_name_prefix="search")
+        self.preview_cache = PreviewCache(self.PREVIEW_CACHE_MAX_BYTES)
+        self.preview_worker = PreviewWorker(self.preview_cache,
+                                            on_result=self.scheduler.wake)
+        self.viewport_worker = PreviewWorker(self.preview_cache,
+                                             on_result=self.scheduler.wake)
+        self.save_worker = SaveWorker(self.preview_cache, on_done=self.scheduler.wake,
+                                      result_cache=self.result_cache)
+        self.encoder_comparison = EncoderComparison(on_done=self.scheduler.wake)
+        self.prefetcher = ImagePrefetcher(self.image_store, self.max_image_memory // 2,
+                                          on_ready=self.scheduler.wake)
+        self.is_pipeline_started = True
 
     def update_image_quality_and_resolution(self, new_quality, new_resolution):
         """
-        This function will use PIL to modify the self.active_img_surface to the quality
-        and resolution set by the user using the sliders
+        Modifies the original image to the quality and resolution set by the user
+        using the sliders. If new_resolution is None the last resolution is kept.
+        Settings seen before are shown straight from the preview cache, others are
+        sent to the preview worker and shown by apply_preview_result
         """
-        if self.orig_img_surface is None:  # if no image has been loaded then return
+        if self.original_img_path is None:  # if no image has been loaded then return
             return
 
-        # save original unmodified pygame surface to BytesIO buffer
-        curr_img_buffer = io.BytesIO()
-        pygame.image.save(self.orig_img_surface, curr_img_buffer, self.img_extension)
-
-        # load buffer as PIL image and convert it into RGB format.
-        pil_img = Image.open(curr_img_buffer, mode="r")
-
-        # pil_image is resized to new_resolution  and saved with new_quality if
-        # new_resolution has been provided
         if new_resolution is not None:
-            pil_img = pil_img.convert("RGB").resize(new_resolution,
-                                                    Image.Resampling.NEAREST)
             self.new_img_res = new_resolution
+        new_quality = int(new_quality)
 
-        # update information regarding image quality by saving it to a buffer in memory
-        # and then counting the number of bytes in it the image is saved with quality
-        # provided in # new_quality
-        new_img_buffer = io.BytesIO()
-        pil_img.save(new_img_buffer, format="JPEG", optimized=True, quality=new_quality)
-        new_img_size = new_img_buffer.tell()
+        # the preview is made once the full resolution image has been decoded
+        if not self.finish_full_decode():
+            return
 
-        self.img_info_dict["Quality"] = f"{new_quality}%"
+        # zoomed in, a dragged slider only updates the part of the image in the window
+        # (see update_viewport_preview). The whole image is encoded for its size once
+        # the slider is released
+        if self.is_viewport_mode and (self.is_dragging_on_res_slider
+                                      or self.is_dragging_on_quality_slider):
+            self.img_info_dict["Size"] = "encoded once the slider is released"
+            return
+
+        # dragging asks for a preview every frame, so skip settings already requested
+        request = (new_quality, self.new_img_res)
+        if request == self.last_preview_request:
+            return
+        self.last_preview_request = request
+
+        rgb_buffer, source_size, preview_res, key = self.get_preview_key(
+            new_quality, self.new_img_res)
+        entry = self.preview_cache.get(key)
+        if entry is not None and entry["surface"] is not None:
+            # drop any older preview still being encoded so it does not replace this one
+            self.preview_worker.cancel()
+            self.shown_preview_key = key
+            self.show_preview(new_quality, self.new_img_res, entry["size"],
+                              entry["surface"])
+            return
+
+        # if only the encoded bytes are cached (from saving) the worker just decodes them
+        data = entry["data"] if entry is not None else None
+        self.preview_worker.submit(key, rgb_buffer, source_size, new_quality,
+                                   preview_res, data, self.encoder_name,
+                                   self.encode_settings)
+
+    def get_preview_key(self, quality, resolution):
+        """
+        Returns the pixels, their size, the resolution of the preview at quality and
+        resolution, and the key it is cached under
+        """
+        from PIL import Image
+
+        # images kept on disk are previewed from their smaller proxy
+        rgb_buffer, source_size, preview_res = self.stored_img.get_preview_source(
+            resolution)
+        source_key = self.img_source_key
+        if self.stored_img.is_mapped:
+            source_key += ("proxy",)
+        key = make_cache_key(source_key, source_size, quality, preview_res,
+                             Image.Resampling.NEAREST, self.encoder_name,
+                             self.encode_settings)
+        return rgb_buffer, source_size, preview_res, key
+
+    def get_viewport_region(self, preview_res):
+        """
+        Returns the part of the preview at preview_res which is inside the window as
+        (left, top, right, bottom), snapped outwards to VIEWPORT_GRID pixels. Returns
+        None if too much of the image is visible for a part to be worth encoding
+        """
+        img_rect = pygame.Rect(round(self.img_render_pos[0]),
+                               round(self.img_render_pos[1]), *self.img_render_size)
+        visible = img_rect.clip(self.screen.get_rect())
+        if (visible.width * visible.height == 0 or visible.width * visible.height
+                > self.VIEWPORT_MAX_FRACTION * img_rect.width * img_rect.height):
+            return None
+
+        scale_x = preview_res[0] / img_rect.width
+        scale_y = preview_res[1] / img_rect.height
+        grid = self.VIEWPORT_GRID
+        return ((visible.left - img_rect.left) * scale_x // grid * grid,
+                (visible.top - img_rect.top) * scale_y // grid * grid,
+                min(preview_res[0],
+                    math.ceil((visible.right - img_rect.left) * scale_x / grid) * grid),
+                min(preview_res[1],
+                    math.ceil((visible.bottom - img_rect.top) * scale_y / grid) * grid))
+
+    def update_viewport_preview(self):
+        """
+        When zoomed in, asks the viewport worker for the part of the image in the
+        window at the slider settings, unless the whole preview already shows them.
+        Encoders whose blocks depend on each other always preview the whole image
+        """
+        self.is_viewport_mode = False
+        if self.stored_img is None or self.modified_img_surface is None:
+            return
+        if get_encoder(self.encoder_name).get_tile_size(self.encode_settings) is None:
+            return
+        quality = int(self.quality_slider.value)
+        rgb_buffer, source_size, preview_res, key = self.get_preview_key(
+            quality, self.new_img_res)
+        region = self.get_viewport_region(preview_res)
+        if region is None:
+            return
+        region = tuple(int(side) for side in region)
+
+        self.is_viewport_mode = True
+        if key == self.shown_preview_key:
+            return
+        key += (("region",) + region,)
+        if key == self.viewport_key:
+            return
+        self.viewport_key = key
+
+        entry = self.preview_cache.get(key, needs_surface=True)
+        if entry is not None:
+            self.viewport_worker.cancel()
+            self.viewport_preview = {"key": key, "resolution": preview_res,
+                                     "region": region, "surface": entry["surface"]}
+            self.img_info_dict["Viewport preview"] = (
+                f"{region[2] - region[0]} x {region[3] - region[1]} from the preview "
+                f"cache")
+            return
+        self.viewport_worker.submit(key, rgb_buffer, source_size, quality, preview_res,
+                                    None, self.encoder_name, self.encode_settings,
+                                    region)
+
+    def apply_viewport_result(self):
+        """
+        Shows the newest part of the image finished by the viewport worker
+        """
+        result = self.viewport_worker.get_result()
+        if result is None:
+            return
+        if "error" in result:
+            self.toast.show(f"Error occurred: {result['error']}")
+            return
+        self.viewport_preview = result
+        region = result["region"]
+        self.img_info_dict["Viewport preview"] = (
+            f"{region[2] - region[0]} x {region[3] - region[1]} encoded in "
+            f"{result['seconds'] * 1000:.1f} ms")
+
+    def get_shown_viewport_preview(self):
+        """
+        Returns the part of the image drawn over the whole preview, or None. A part
+        is drawn while it has the settings of the sliders, even once the window shows
+        a different part of the image
+        """
+        if (not self.is_viewport_mode or self.viewport_preview is None
+                or self.viewport_key is None
+                or self.viewport_preview["key"][:-1] != self.viewport_key[:-1]):
+            return None
+        return self.viewport_preview
+
+    def draw_viewport_preview(self, viewport_preview):
+        """
+        Draws viewport_preview over the whole preview, scaled the same way
+        """
+        resolution = viewport_preview["resolution"]
+        left, top, right, bottom = viewport_preview["region"]
+        scale_x = self.img_render_size[0] / resolution[0]
+        scale_y = self.img_render_size[1] / resolution[1]
+        x = round(self.img_render_pos[0] + left * scale_x)
+        y = round(self.img_render_pos[1] + top * scale_y)
+        size = (max(1, round(self.img_render_pos[0] + right * scale_x) - x),
+                max(1, round(self.img_render_pos[1] + bottom * scale_y) - y))
+
+        # scaled once for each zoom, panning only moves it
+        key = (id(viewport_preview["surface"]), size)
+        if self.viewport_scaled is None or self.viewport_scaled[0] != key:
+            with profiler.span("rescale", "render"):
+                self.viewport_scaled = (key, pygame.transform.scale(
+                    viewport_preview["surface"], size))
+        self.screen.blit(self.viewport_scaled[1], (x, y))
+
+    def apply_preview_result(self):
+        """
+        Shows the newest preview finished by the preview worker, if there is one
+        """
+        result = self.preview_worker.get_result()
+        if result is None:
+            return
+        if "error" in result:
+            self.toast.show(f"Error occurred: {result['error']}")
+            return
+
+        # check how far the prediction for this encode was from the real size
+        if self.size_estimator is not None and not self.stored_img.is_mapped:
+            self.size_estimator.record_actual(result["quality"], result["resolution"],
+                                              result["size"])
+            error_stats = self.size_estimator.get_error_stats()
+            if error_stats is not None:
+                self.img_info_dict["Size estimate error"] = (
+                    f"{error_stats['mean']:.1%} average, {error_stats['max']:.1%} max "
+                    f"over {error_stats['count']} encodes")
+
+        self.shown_preview_key = result["key"]
+        self.show_preview(result["quality"], result["resolution"], result["size"],
+                          result["surface"])
+
+    def show_preview(self, quality, resolution, size, surface):
+        """
+        Makes surface the image preview and updates the image information
+        """
+        size_text = format_byte_count(size)
+        if self.stored_img.is_mapped:
+            # the preview was made from the proxy, so neither its resolution nor its
+            # size are the ones the saved image will have
+            resolution = self.new_img_res
+            size_text = "unknown until saved"
+            if self.size_estimator is not None:
+                predicted_size = self.size_estimator.estimate(quality, resolution)
+                if predicted_size is not None:
+                    size_text = f"~{format_byte_count(predicted_size)}"
+
+        self.img_info_dict["Quality"] = f"{quality}%"
         self.img_info_dict[
-            "New Image Resolution"] = f"{self.new_img_res[0]} x {self.new_img_res[1]}"
-        self.img_info_dict["Size"] = format_byte_count(new_img_size)
+            "New Image Resolution"] = f"{resolution[0]} x {resolution[1]}"
+        self.img_info_dict["Size"] = size_text
 
-        # load image back as pygame surface
-        new_img_buffer.seek(0)
-        self.modified_img_surface = pygame.image.load(new_img_buffer, "JPEG")
+        # the preview is resized differently from the saved image, so show the size
+        # the saved image will actually have if target size mode found it
+        if self.target_size_result is not None and self.target_size_result[:2] == (
+                quality, resolution):
+            self.img_info_dict["Size"] = format_byte_count(self.target_size_result[2])
 
-        # scales the image to new resolution
-        self.active_img_surface = pygame.transform.scale(self.modified_img_surface,
-                                                         self.img_render_size)
+        stats = self.preview_cache.get_stats()
+        self.img_info_dict["Preview cache"] = (
+            f"{stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['evictions']} evictions, {format_byte_count(stats['used_bytes'])} "
+            f"of {format_byte_count(stats['max_bytes'])}")
+        self.update_memory_info()
 
-        # close the buffers
-        pil_img.close()
-        curr_img_buffer.close()
-        new_img_buffer.close()
+        self.modified_img_surface = surface
+
+    def update_memory_info(self):
+        """
+        Shows how much memory the app and its images use in the image information
+        """
+        memory_size = self.image_store.get_memory_size()
+        mapped_size = self.image_store.get_mapped_size()
+        memory_text = (f"images {format_byte_count(memory_size)} in memory, "
+                       f"{format_byte_count(mapped_size)} on disk")
+        resident_memory = get_resident_memory()
+        if resident_memory is not None:
+            memory_text = (f"{format_byte_count(resident_memory['resident'])} resident "
+                           f"({format_byte_count(resident_memory['file'])} from files), "
+                           + memory_text)
+        self.img_info_dict["Memory"] = memory_text
+
+    def get_slider_resolution(self):
+        """
+        Returns the resolution selected on the resolution slider
+        """
+        slider_ratio = self.resolution_slider.value / self.resolution_slider.max_val
+        return scale_resolution(self.img_org_res, slider_ratio)
 
     def save_img(self):
         """
-        Saves image to self.modified_img_path
+        Saves image to self.modified_img_path. The save worker encodes and writes it in
+        the background and apply_save_results shows when it is done
+        """
+        from PIL import Image
+
+        if self.modified_img_surface is None or self.modified_img_path is None:
+            return
+        new_quality = int(self.quality_slider.value)
+
+        # reuse the encoded bytes if this exact image has been encoded before
+        key = make_cache_key(self.img_source_key, self.img_org_res,
+                             new_quality, self.new_img_res,
+                             Image.Resampling.LANCZOS, self.encoder_name,
+                             self.encode_settings)
+        entry = self.preview_cache.get(key)
+        data = entry["data"] if entry is not None else None
+
+        # resizing the decoded image is faster than decoding the file again, unless
+        # libjpeg can decode it straight at half the size or less
+        rgb_buffer, size = None, None
+        if data is None and self.finish_full_decode():
+            resized_buffers = {}  # resolution -> pixels resized by target size mode
+            if self.target_size_solver is not None:
+                resized_buffers = self.target_size_solver.resized_buffers
+            if tuple(self.new_img_res) in resized_buffers:
+                rgb_buffer = resized_buffers[tuple(self.new_img_res)]
+                size = self.new_img_res
+            elif self.new_img_res[0] * 2 > self.img_org_res[0]:
+                rgb_buffer, size = self.orig_rgb_buffer, self.img_org_res
+
+        self.save_worker.submit(key, self.modified_img_path, self.original_img_path,
+                                new_quality, self.new_img_res, rgb_buffer, size, data,
+                                self.encoder_name, self.encode_settings)
+        self.toast.show(f"Saving {os.path.basename(self.modified_img_path)} "
+                        f"({self.save_worker.get_pending_count()} in progress)")
+
+    def apply_save_results(self):
+        """
+        Shows the saves finished by the save worker in the toast
         """
+        for result in self.save_worker.get_results():
+            if "error" in result:
+                self.toast.show(f"Error occurred: {result['error']}")
+                continue
+
+            message = (f"Saved {os.path.basename(result['path'])} "
+                       f"({format_byte_count(result['size'])}"
+                       + (", from the result cache)" if result["cache_hit"] else ")"))
+            if (result.get("cached_meta") is not None
+                    and result["source_digest"] == self.img_source_digest):
+                self.img_cached_results[result["cached_meta"]["params_id"]] = (
+                    result["cached_meta"])
+            pending_count = self.save_worker.get_pending_count()
+            if pending_count > 0:
+                message += f", {pending_count} more in progress"
+            self.toast.show(message)
+
+    def start_target_size(self, max_bytes):
+        """
+        Starts searching in the background for the highest quality and resolution
+        which fit inside max_bytes when saved. apply_target_size_result moves both
+        sliders there once they are found
+        """
+        from processing.target_size import TargetSizeSolver
+
+        message = (f"Searching for the highest quality fitting in "
+                   f"{format_byte_count(max_bytes)}")
+        if not self.finish_full_decode():
+            if self.full_decode_future is not None:
+                self.pending_target_size = max_bytes
+                self.toast.show(message)
+            return
+
+        if self.target_size_solver is None:
+            self.target_size_solver = TargetSizeSolver(self.orig_rgb_buffer,
+                                                       self.img_org_res,
+                                                       encoder=self.encoder_name,
+                                                       settings=self.encode_settings)
+
+        self.target_size_request = (self.img_source_key, self.encoder_name,
+                                    self.encode_settings, max_bytes)
+        self.target_size_future = self.search_executor.submit(
+            self.target_size_solver.solve, max_bytes)
+        self.target_size_future.add_done_callback(lambda _: self.scheduler.wake())
+        self.toast.show(message)
+
+    def apply_target_size_result(self):
+        """
+        Moves both sliders to the quality and resolution found by target size mode
+        once the search is done
+        """
+        from PIL import Image
+
+        future = self.target_size_future
+        if future is None or not future.done():
+            return
+        self.target_size_future = None
+
+        # the search belongs to an image, encoder or settings not used any more
+        image, encoder, settings, max_bytes = self.target_size_request
+        if (image, encoder, settings) != (self.img_source_key, self.encoder_name,
+                                          self.encode_settings):
+            return
         try:
-            if self.orig_img_surface is not None and self.modified_img_path is not None:
-                new_quality = self.quality_slider.value
-                pil_image = Image.open(self.original_img_path)
-                pil_image = pil_image.convert("RGB").resize(self.new_img_res,
-                                                            Image.Resampling.LANCZOS)
-                pil_image.save(self.modified_img_path, format="JPEG", optimized=True,
-                               quality=new_quality)
-                pil_image.close()
-                self.toast.show("Image saved")
+            result = future.result()
         except Exception as ex:
             self.toast.show(f"Error occurred: {str(ex)}")
+            return
+
+        if not result["fits"]:
+            self.toast.show(f"Cannot fit image in {format_byte_count(max_bytes)} "
+                            f"({result['encodes']} encodes)")
+            return
+
+        new_resolution = result["resolution"]
+        self.quality_slider.set_value(result["quality"])
+        self.resolution_slider.set_value_ratio(new_resolution[0] / self.img_org_res[0])
+        self.target_size_result = (result["quality"], new_resolution, result["size"])
+
+        # the search already encoded the image exactly as saving would
+        self.preview_cache.put(make_cache_key(self.img_source_key, self.img_org_res,
+                                              result["quality"], new_resolution,
+                                              Image.Resampling.LANCZOS, encoder,
+                                              settings),
+                               result["data"])
+        self.update_image_quality_and_resolution(result["quality"], new_resolution)
+        self.toast.show(f"Fits in {format_byte_count(result['size'])} at quality "
+                        f"{result['quality']}% ({result['encodes']} encodes)")
+
+    def handle_target_size_key(self, event_data):
+        """
+        Pressing T starts typing a target size like 100KB. Enter finds the quality and
+        resolution for that size and Escape cancels
+        """
+        if self.target_size_text is None:
+            if event_data.key == pygame.K_t and self.modified_img_surface is not None:
+                self.target_size_text = ""
+                self.toast.show("Target size: _ (type a size like 100KB and press Enter)")
+            return
+
+        if event_data.key == pygame.K_ESCAPE:
+            self.target_size_text = None
+            self.toast.hide()
+            return
+
+        if event_data.key in (pygame.K_RETURN, pygame.K_KP_ENTER):
+            max_bytes = parse_byte_count(self.target_size_text)
+            self.target_size_text = None
+            if not max_bytes:
+                self.toast.show("Invalid target size")
+            else:
+                self.start_target_size(max_bytes)
+            return
+
+        if event_data.key == pygame.K_BACKSPACE:
+            self.target_size_text = self.target_size_text[:-1]
+        elif event_data.unicode and event_data.unicode in "0123456789.kKmMgGbB ":
+            self.target_size_text += event_data.unicode
+        self.toast.show(f"Target size: {self.target_size_text}_")
+
+    def handle_quality_target_key(self, event_data):
+        """
+        Pressing Q starts typing a quality target, an SSIM like 0.95 or a PSNR like
+        40dB. Enter searches for the lowest quality which reaches it and Escape
+        cancels. Returns True if the key was used
+        """
+        if self.quality_target_text is None:
+            if event_data.key != pygame.K_q or self.modified_img_surface is None:
+                return False
+            self.quality_target_text = ""
+            self.toast.show("Quality target: _ (type an SSIM like 0.95 or a PSNR like "
+                            "40dB and press Enter)")
+            return True
+
+        if event_data.key == pygame.K_ESCAPE:
+            self.quality_target_text = None
+            self.toast.hide()
+            return True
+
+        if event_data.key in (pygame.K_RETURN, pygame.K_KP_ENTER):
+            from processing.quality_metrics import parse_quality_target
+
+            quality_target = parse_quality_target(self.quality_target_text)
+            self.quality_target_text = None
+            if quality_target is None:
+                self.toast.show("Invalid quality target")
+            else:
+                self.start_quality_target(*quality_target)
+            return True
+
+        if event_data.key == pygame.K_BACKSPACE:
+            self.quality_target_text = self.quality_target_text[:-1]
+        elif event_data.unicode and event_data.unicode in "0123456789.dDbB ":
+            self.quality_target_text += event_data.unicode
+        self.toast.show(f"Quality target: {self.quality_target_text}_")
+        return True
+
+    def start_quality_target(self, metric, target):
+        """
+        Starts searching in the background for the lowest quality whose score on
+        metric reaches target at the current resolution. apply_quality_target_result
+        moves the quality slider there once it is found
+        """
+        from processing.quality_metrics import METRICS, format_score
+        from processing.quality_target import QualityTargetSolver
+
+        message = (f"Searching for the lowest quality reaching "
+                   f"{METRICS[metric][1]} {format_score(metric, target)}")
+        if not self.finish_full_decode():
+            if self.full_decode_future is not None:
+                self.pending_quality_target = (metric, target)
+                self.toast.show(message)
+            return
+
+        solver = self.quality_target_solver
+        if solver is None or solver.metric != metric:
+            solver = QualityTargetSolver(self.orig_rgb_buffer, self.img_org_res, metric,
+                                         self.METRIC_MAX_PIXELS,
+                                         encoder=self.encoder_name,
+                                         settings=self.encode_settings)
+            self.quality_target_solver = solver
+
+        self.quality_target_request = (self.img_source_key, self.encoder_name,
+                                       self.encode_settings, metric, target)
+        self.quality_target_future = self.search_executor.submit(
+            solver.solve, target, self.new_img_res)
+        self.quality_target_future.add_done_callback(lambda _: self.scheduler.wake())
+        self.toast.show(message)
+
+    def start_pending_searches(self):
+        """
+        Starts the target size and quality searches asked for while the full
+        resolution image was still being decoded, once it is. They are dropped if the
+        decode failed
+        """
+        if self.pending_target_size is None and self.pending_quality_target is None:
+            return
+        if not self.finish_full_decode():
+            if self.full_decode_future is None:
+                self.pending_target_size = None
+                self.pending_quality_target = None
+            return
+
+        max_bytes, quality_target = self.pending_target_size, self.pending_quality_target
+        self.pending_target_size = None
+        self.pending_quality_target = None
+        if max_bytes is not None:
+            self.start_target_size(max_bytes)
+        if quality_target is not None:
+            self.start_quality_target(*quality_target)
+
+    def apply_quality_target_result(self):
+        """
+        Moves the sliders to the quality found by quality mode once the search is done
+        and shows its score in the image information
+        """
+        from PIL import Image
+        from processing.quality_metrics import METRICS, format_score
+
+        future = self.quality_target_future
+        if future is None or not future.done():
+            return
+        self.quality_target_future = None
+
+        # the search belongs to an image, encoder or settings not used any more
+        image, encoder, settings, metric, target = self.quality_target_request
+        if (image, encoder, settings) != (self.img_source_key, self.encoder_name,
+                                          self.encode_settings):
+            return
+        try:
+            result = future.result()
+        except Exception as ex:
+            self.toast.show(f"Error occurred: {str(ex)}")
+            return
+
+        label = METRICS[metric][1]
+        score_text = f"{label} {format_score(metric, result['score'])}"
+        self.img_info_dict["Quality score"] = (
+            f"{score_text} at quality {result['quality']}% (target "
+            f"{format_score(metric, target)}, {result['encodes']} encodes, "
+            f"{result['metric_seconds']:.2f}s CPU on scores)")
+        if not result["fits"]:
+            self.toast.show(f"Even quality 100% only reaches {score_text}")
+            return
+
+        new_resolution = result["resolution"]
+        self.quality_slider.set_value(result["quality"])
+        self.resolution_slider.set_value_ratio(new_resolution[0] / self.img_org_res[0])
+        self.target_size_result = (result["quality"], new_resolution, result["size"])
+
+        # the search already encoded the image exactly as saving would
+        self.preview_cache.put(make_cache_key(self.img_source_key, self.img_org_res,
+                                              result["quality"], new_resolution,
+                                              Image.Resampling.LANCZOS, encoder,
+                                              settings),
+                               result["data"])
+        self.update_image_quality_and_resolution(result["quality"], new_resolution)
+        self.toast.show(f"{score_text} at quality {result['quality']}% "
+                        f"({format_byte_count(result['size'])})")
+
+    def get_fast_preview_resolution(self):
+        """
+        Returns the smallest resolution the first preview of the loaded image can have
+        without looking blurry on screen
+        """
+        fit = min(self.screen.get_width() / self.img_org_res[0],
+                  self.screen.get_height() / self.img_org_res[1], 1)
+        return scale_resolution(self.img_org_res, fit)
+
+    def finish_full_decode(self, wait=False):
+        """
+        Starts using the full resolution image once the background decode is done.
+        With wait, it waits for the decode instead. Returns True if the full
+        resolution image is available
+        """
+        if self.orig_rgb_buffer is not None:
+            return True
+        future = self.full_decode_future
+        if future is None or (not wait and not future.done()):
+            return False
+
+        self.full_decode_future = None
+        try:
+            stored_img = future.result()
+        except Exception as ex:
+            self.toast.show(f"Error occurred: {str(ex)}")
+            return False
+        self.install_full_decode(stored_img)
+
+        # the sliders may have been moved while the full image was being decoded
+        if (self.quality_slider.value, self.new_img_res) != (
+                self.quality_slider.max_val, self.img_org_res):
+            self.update_image_quality_and_resolution(self.quality_slider.value,
+                                                     self.new_img_res)
+        return True
+
+    def install_full_decode(self, stored_img):
+        """
+        Makes stored_img, the fully decoded loaded image, the original that every
+        preview and save uses
+        """
+        # PIL and pygame both read the same pixels without copying them. An image kept
+        # on disk is drawn from its proxy so drawing never reads the file
+        self.stored_img = stored_img
+        self.orig_rgb_buffer = stored_img.buffer
+        self.orig_pil_img = buffer_to_pil(self.orig_rgb_buffer, self.img_org_res)
+        self.orig_img_surface = buffer_to_surface(stored_img.proxy_buffer,
+                                                  stored_img.proxy_size)
+        if self.last_preview_request is None:
+            self.modified_img_surface = self.orig_img_surface
+        self.update_memory_info()
+        self.start_size_estimator()
+        self.start_block_cost_map()
+
+    def start_size_estimator(self):
+        """
+        Starts predicting the size of every slider position in the background, with
+        the selected encoder and settings
+        """
+        from PIL import Image
+        from processing.size_estimator import SizeEstimator
+
+        if self.size_estimator is not None:
+            self.size_estimator.cancel()
+        self.size_estimator = SizeEstimator(self.orig_rgb_buffer, self.img_org_res,
+                                            Image.Resampling.NEAREST,
+                                            encoder=self.encoder_name,
+                                            settings=self.encode_settings)
+        self.img_info_dict["Size estimate error"] = ""  # of the previous estimator
+        threading.Thread(target=self.build_size_estimator, args=(self.size_estimator,),
+                         name="size-estimator", daemon=True).start()
+
+    def start_block_cost_map(self):
+        """
+        Starts measuring how many bits each block of the loaded image costs in the
+        background. Images kept on disk are measured on their proxy
+        """
+        from processing.block_costs import BlockCostMap
+
+        rgb_buffer, source_size, _ = self.stored_img.get_preview_source(self.img_org_res)
+        self.block_cost_map = BlockCostMap(rgb_buffer, source_size)
+        threading.Thread(target=self.build_block_cost_map, args=(self.block_cost_map,),
+                         name="block-costs", daemon=True).start()
+
+    def build_block_cost_map(self, block_cost_map):
+        """
+        Builds block_cost_map and wakes the application loop so it is shown
+        """
+        block_cost_map.build()
+        self.scheduler.wake()
+
+    def apply_block_cost_map(self):
+        """
+        Once the block cost map is ready, finds the crop and resolution which save
+        the most and shows them in the image information, or why it failed
+        """
+        cost_map = self.block_cost_map
+        if cost_map is not None and cost_map.error is not None:
+            error_text = f"failed: {cost_map.error}"
+            if self.img_info_dict["Block cost"] != error_text:
+                self.img_info_dict["Block cost"] = error_text
+                self.toast.show(f"Cannot measure the cost of blocks: {cost_map.error}")
+            return
+        if (cost_map is None or not cost_map.is_ready
+                or self.block_cost_suggestions is not None):
+            return
+        crop = cost_map.suggest_crop()
+        scale = cost_map.suggest_scale()
+        self.block_cost_suggestions = {"crop": crop, "scale": scale}
+
+        parts = [f"busiest 10% of blocks cost {cost_map.get_top_share():.0%} of the "
+                 f"bits"]
+        if crop is not None:
+            # the map of an image kept on disk is measured on its proxy
+            ratio = self.img_org_res[0] / cost_map.size[0]
+            left, top, right, bottom = (round(side * ratio) for side in crop["box"])
+            parts.append(f"crop to {right - left} x {bottom - top} at ({left}, {top}) "
+                         f"saves ~{crop['saved']:.0%}")
+        if scale is not None:
+            resolution = scale_resolution(self.img_org_res, scale["scale"])
+            parts.append(f"{resolution[0]} x {resolution[1]} saves ~{scale['saved']:.0%} "
+                         f"and drops detail worth {scale['lost']:.0%}")
+        self.img_info_dict["Block cost"] = (", ".join(parts)
+                                            + f" ({cost_map.seconds:.2f}s, H shows it)")
+
+    def handle_block_cost_key(self, event_data):
+        """
+        Pressing H shows or hides the block cost map over the preview. Returns True
+        if the key was used
+        """
+        if event_data.key != pygame.K_h or self.modified_img_surface is None:
+            return False
+        self.is_heatmap_shown = not self.is_heatmap_shown
+        if self.is_heatmap_shown and self.block_cost_map is not None:
+            if self.block_cost_map.error is not None:
+                self.toast.show(f"Cannot measure the cost of blocks: "
+                                f"{self.block_cost_map.error}")
+            elif self.block_cost_suggestions is None:
+                self.toast.show("Measuring the cost of each block...")
+        return True
+
+    def draw_block_cost_heatmap(self):
+        """
+        Draws the cost of each block over the preview, from transparent blue for
+        the cheapest blocks to red for the busiest, and outlines the suggested crop
+        """
+        cost_map = self.block_cost_map
+        if self.block_cost_suggestions is None:
+            return
+        # blocks as big as the MCUs of the JPEG settings, 16x16 with 4:2:0
+        block_width, block_height = get_jpeg_mcu_size(self.encode_settings)
+        if self.heatmap_key != (id(cost_map), block_width, block_height):
+            data, size = cost_map.make_heatmap((block_width, block_height))
+            self.heatmap_view.set_image(pygame.image.frombuffer(data, size, "RGBA"))
+            self.heatmap_key = (id(cost_map), block_width, block_height)
+
+        # the map covers whole blocks, which go past the right and bottom edges
+        scale_x = self.img_render_size[0] / cost_map.size[0]
+        scale_y = self.img_render_size[1] / cost_map.size[1]
+        map_size = self.heatmap_view.surface.get_size()
+        self.heatmap_view.draw(self.screen, self.img_render_pos,
+                               (round(map_size[0] * block_width * scale_x),
+                                round(map_size[1] * block_height * scale_y)))
+
+        crop = self.block_cost_suggestions["crop"]
+        if crop is not None:
+            left, top, right, bottom = crop["box"]
+            pygame.draw.rect(self.screen, self.img_info_text_color,
+                             (round(self.img_render_pos[0] + left * scale_x),
+                              round(self.img_render_pos[1] + top * scale_y),
+                              round((right - left) * scale_x),
+                              round((bottom - top) * scale_y)), width=2)
+
+    def read_result_cache(self, path):
+        """
+        Hashes the file at path and reads the sizes of its encodes which are in the
+        result cache, then wakes the application loop so they are shown
+        """
+        try:
+            source_digest = hash_file(path)
+            cached_results = self.result_cache.list_meta(source_digest)
+        except OSError:
+            return
+        if path == self.original_img_path:  # a newer image may have been loaded
+            self.img_cached_results = cached_results
+            self.img_source_digest = source_digest
+            self.scheduler.wake()
+
+    def get_cached_size(self, quality, resolution):
+        """
+        Returns the size saving at quality and resolution gives, if the result cache
+        has it, otherwise None
+        """
+        if not self.img_cached_results:
+            return None
+        from PIL import Image
+
+        params = get_encode_params(self.encoder_name, quality, resolution,
+                                   Image.Resampling.LANCZOS, self.encode_settings)
+        meta = self.img_cached_results.get(get_params_id(params))
+        return meta["size"] if meta is not None else None
+
+    def build_size_estimator(self, size_estimator):
+        """
+        Builds size_estimator and wakes the application loop so the predicted sizes
+        are shown on the sliders
+        """
+        size_estimator.build()
+        self.scheduler.wake()
+
+    def show_size_estimator_error(self):
+        """
+        Shows why the size estimator stopped, in place of its error stats, since no
+        sizes will be predicted for the current settings
+        """
+        if self.size_estimator is None or self.size_estimator.error is None:
+            return
+        error_text = f"failed: {self.size_estimator.error}"
+        if self.img_info_dict["Size estimate error"] != error_text:
+            self.img_info_dict["Size estimate error"] = error_text
+            self.toast.show(f"Cannot predict sizes: {self.size_estimator.error}")
 
     def load_img(self, path):
         """
         Used for loading img for first time
         """
+        from PIL import Image
 
         try:
             if not is_valid_img_path(path):
                 self.toast.show(
-                    f"Invalid image: {os.path.basename(path)}. Only JPEGs are supported")
+                    f"Invalid image: {os.path.basename(path)}. Only JPEG, PNG and WebP "
+                    f"images are supported")
                 return
 
             self.original_img_path = path
+            self.img_source_key = (path, os.path.getmtime(path))
 
-            # adds modified_ as suffix for the name the img will be saved as
-            directory = os.path.dirname(self.original_img_path)
-            new_filename = f'modified_{os.path.basename(self.original_img_path)}'
-            self.modified_img_path = os.path.join(directory, new_filename)
+            # adds modified_ as suffix for the name the img will be saved as, with the
+            # extension of the selected encoder
+            self.modified_img_path = get_modified_img_path(
+                self.original_img_path, get_encoder(self.encoder_name).extensions)
 
             # retrieves extension of image
             self.img_extension = os.path.splitext(self.modified_img_path)[1].lower()
-            self.active_img_surface = pygame.image.load(self.original_img_path)
-            self.modified_img_surface = pygame.image.load(self.original_img_path)
-            self.orig_img_surface = pygame.image.load(self.original_img_path)
 
-            self.img_org_res = (
-                self.active_img_surface.get_width(), self.active_img_surface.get_height())
+            # opening only reads the header, which holds the metadata
+            with Image.open(self.original_img_path) as pil_image:
+                self.img_metadata = read_metadata(pil_image)
+            self.encode_settings = resolve_settings(self.encoder_settings,
+                                                    self.img_metadata)
+
+            # forget everything about the previous image
+            self.stored_img = None
+            self.orig_rgb_buffer = None
+            self.orig_pil_img = None
+            self.orig_img_surface = None
+            self.target_size_solver = None
+            self.target_size_result = None
+            self.quality_target_solver = None
+            self.pending_target_size = None
+            self.pending_quality_target = None
+            self.img_cached_results = {}
+            self.img_source_digest = None
+            if self.result_cache is not None:
+                threading.Thread(target=self.read_result_cache, args=(path,),
+                                 name="result-cache", daemon=True).start()
+            self.preview_worker.cancel()
+            self.viewport_worker.cancel()
+            self.encoder_comparison.cancel()
+            self.last_preview_request = None
+            self.shown_preview_key = None
+            self.viewport_key = None
+            self.viewport_preview = None
+            if self.size_estimator is not None:
+                self.size_estimator.cancel()
+                self.size_estimator = None
+            if self.block_cost_map is not None:
+                self.block_cost_map.cancel()
+                self.block_cost_map = None
+            self.block_cost_suggestions = None
+            self.img_info_dict["Block cost"] = ""
+
+            # the full image is decoded in the background, or already has been if it
+            # was prefetched from the queue
+            self.full_decode_future = self.prefetcher.get(path)
+            if self.full_decode_future.done():
+                self.img_org_res = self.full_decode_future.result().size
+                self.modified_img_surface = None
+            else:
+                # decode a small version first so the preview appears quickly. libjpeg
+                # can decode straight to 1/2, 1/4 or 1/8 of the size which skips most
+                # of the work
+                with Image.open(self.original_img_path) as pil_image:
+                    self.img_org_res = pil_image.size
+                    pil_image.draft("RGB", self.get_fast_preview_resolution())
+                    preview_buffer = pil_to_rgb_buffer(pil_image)
+                    preview_size = pil_image.size
+                self.modified_img_surface = buffer_to_surface(preview_buffer,
+                                                              preview_size)
+
+                # no need to wait if the small version already is the full image
+                if preview_size == self.img_org_res:
+                    self.full_decode_future = None
+                    self.install_full_decode(self.image_store.add(
+                        StoredImage(path, preview_size, preview_buffer)))
+
             self.img_render_size = self.img_org_res
-            self.new_img_res = (
-                self.active_img_surface.get_width(), self.active_img_surface.get_height())
+            self.new_img_res = self.img_org_res
 
             self.resolution_slider.set_value(self.resolution_slider.max_val)
             self.img_info_dict["Save path"] = self.modified_img_path
-            self.img_info_dict[
-                "Original Image Resolution"] = f"{self.img_org_res[0]} x {self.img_org_res[1]}"
+            self.img_info_dict["Original Image Resolution"] = (
+                f"{self.img_org_res[0]} x {self.img_org_res[1]}")
             self.img_info_dict[
                 "New Image Resolution"] = f"{self.new_img_res[0]} x {self.new_img_res[1]}"
             self.img_info_dict["Quality"] = "100%"
             self.img_info_dict["Size"] = format_byte_count(os.path.getsize(path))
+            self.img_info_dict["Size estimate error"] = ""
+            self.img_info_dict["Quality score"] = ""
+            self.img_info_dict["Preview cache"] = ""
 
             self.quality_slider.set_value_ratio(1)
             self.resolution_slider.set_value_ratio(1)
             self.toast.show(f"Loaded {self.original_img_path}")
+            self.finish_full_decode()
 
         except Exception as e:
             self.toast.show("Error occurred:" + e.args[0])
 
-    def draw_img_info_text(self):
+    def get_img_info_rect(self):
         """
-        Renders the text in self.img_info_dict
+        Returns the area covered by the background of the info text
         """
-        render_area = (self.screen.get_width() - self.pad * 2, self.screen.get_height())
         total_lines = len(self.img_info_dict)
         bg_height = (self.font.get_height() + 5.5) * total_lines
         bg_width = self.screen.get_width() - 20
-        bg_bounds = (10, 10, bg_width, bg_height)
+        return 10, 10, bg_width, bg_height
+
+    def add_dropped_file(self, path):
+        """
+        Adds a dropped file to the queue. The first file of each drop is opened and
+        the others wait in the queue
+        """
+        if not is_valid_img_path(path):
+            self.toast.show(
+                f"Invalid image: {os.path.basename(path)}. Only JPEG, PNG and WebP "
+                f"images are supported")
+            return
+
+        if path not in self.img_queue:
+            self.img_queue.append(path)
+        if self.is_first_file_of_drop:
+            self.is_first_file_of_drop = False
+            self.open_queued_img(self.img_queue.index(path))
+        else:
+            self.prefetch_queue()
+            self.update_queue_info()
+            self.toast.show(f"{len(self.img_queue)} images in the queue, "
+                            f"use the arrow keys to switch between them")
+
+    def open_queued_img(self, index):
+        """
+        Opens the image at index in the queue. The settings of the image being left
+        are remembered and restored when it is opened again
+        """
+        if self.original_img_path is not None:
+            self.img_settings[self.original_img_path] = {
+                "quality": self.quality_slider.value,
+                "resolution": self.resolution_slider.value,
+                "zoom": self.zoom,
+                "drag_delta": self.drag_delta}
+
+        self.img_queue_index = index
+        path = self.img_queue[index]
+        self.load_img(path)
+
+        settings = self.img_settings.get(path)
+        if settings is not None and path == self.original_img_path:
+            self.quality_slider.set_value(settings["quality"])
+            self.resolution_slider.set_value(settings["resolution"])
+            self.zoom = settings["zoom"]
+            self.drag_delta = settings["drag_delta"]
+            self.update_image_quality_and_resolution(self.quality_slider.value,
+                                                     self.get_slider_resolution())
+
+        self.prefetch_queue()
+        self.update_queue_info()
+
+    def prefetch_queue(self):
+        """
+        Decodes the next images in the queue, and the one before, ahead of time
+        """
+        if self.img_queue_index < 0:
+            return
+        start = self.img_queue_index
+        paths = self.img_queue[start:start + 1 + self.PREFETCH_COUNT]
+        if start > 0:
+            paths.append(self.img_queue[start - 1])
+        self.prefetcher.prefetch(paths)
+
+    def update_queue_info(self):
+        self.img_info_dict["Queue"] = (f"{self.img_queue_index + 1} of "
+                                       f"{len(self.img_queue)}")
+
+    def handle_queue_key(self, event_data):
+        """
+        The right and left arrow keys (or Page Down and Page Up) open the next and
+        previous image in the queue. Returns True if the key was used
+        """
+        if event_data.key in (pygame.K_RIGHT, pygame.K_PAGEDOWN):
+            step = 1
+        elif event_data.key in (pygame.K_LEFT, pygame.K_PAGEUP):
+            step = -1
+        else:
+            return False
+
+        new_index = self.img_queue_index + step
+        if 0 <= new_index < len(self.img_queue):
+            self.open_queued_img(new_index)
+        elif len(self.img_queue) > 0:
+            self.toast.show("No more images in the queue")
+        return True
+
+    def handle_format_key(self, event_data):
+        """
+        Pressing E switches previews and saves to the next encoder. Returns True if
+        the key was used
+        """
+        if event_data.key != pygame.K_e:
+            return False
+
+        names = list(ENCODERS)
+        self.set_encoder(names[(names.index(self.encoder_name) + 1) % len(names)])
+        self.toast.show(f"Saving as {get_encoder(self.encoder_name).label}, "
+                        f"press E for the next format")
+        return True
+
+    def set_encoder(self, name):
+        """
+        Makes previews and saves of the loaded image use the encoder called name
+        """
+        self.encoder_name = name
+        if self.original_img_path is not None:
+            self.modified_img_path = get_modified_img_path(self.original_img_path,
+                                                           get_encoder(name).extensions)
+            self.img_info_dict["Save path"] = self.modified_img_path
+        self.restart_encoding()
+
+    def handle_encoder_setting_key(self, event_data):
+        """
+        O turns Huffman table optimization on or off, P progressive JPEG, S cycles
+        through the color subsamplings and M through the metadata choices. Returns
+        True if the key was used
+        """
+        name = self.SETTING_KEYS.get(event_data.key)
+        if name is None:
+            return False
+
+        value = self.encoder_settings[name]
+        if name == "subsampling":
+            value = SUBSAMPLINGS[(SUBSAMPLINGS.index(value) + 1) % len(SUBSAMPLINGS)]
+        elif name == "metadata":
+            value = METADATA_CHOICES[(METADATA_CHOICES.index(value) + 1)
+                                     % len(METADATA_CHOICES)]
+        else:
+            value = not value
+        self.encoder_settings[name] = value
+        self.encode_settings = resolve_settings(self.encoder_settings, self.img_metadata)
+        self.restart_encoding()
+
+        encoder = get_encoder(self.encoder_name)
+        message = f"Saving with {format_setting(name, value)}"
+        if name not in encoder.setting_names:
+            message += f" (not used by {encoder.label})"
+        self.toast.show(message)
+        return True
+
+    def restart_encoding(self):
+        """
+        Forgets everything measured with the previous encoder or settings and shows
+        the loaded image with the current ones
+        """
+        self.target_size_solver = None  # the sizes it found are for the old settings
+        self.target_size_result = None
+        self.quality_target_solver = None
+        self.encoder_comparison.cancel()
+        if self.original_img_path is None:
+            return
+
+        if self.orig_rgb_buffer is not None:
+            self.start_size_estimator()
+        self.last_preview_request = None
+        self.update_image_quality_and_resolution(self.quality_slider.value, None)
+
+    def update_encoder_comparison(self):
+        """
+        Compares every encoder on the current settings once the sliders are let go,
+        and shows how they did so far in the image information. The selected encoder
+        is also tried with each of its settings changed, to show how many bytes the
+        current choice of each saves
+        """
+        encoder = get_encoder(self.encoder_name)
+        if self.orig_rgb_buffer is None:
+            return
+
+        # wait for the size estimator so that the two do not compete for the CPU
+        is_dragging = self.is_dragging_on_res_slider or self.is_dragging_on_quality_slider
+        if (not is_dragging and self.size_estimator is not None
+                and self.size_estimator.is_finished()):
+            quality = int(self.quality_slider.value)
+            # images kept on disk are compared on their proxy
+            rgb_buffer, source_size, resolution = self.stored_img.get_preview_source(
+                self.new_img_res)
+            variants = {name: (name, self.encode_settings) for name in ENCODERS}
+            for name in encoder.setting_names:
+                other_settings = dict(self.encoder_settings)
+                other_settings[name] = get_other_choice(name, other_settings[name])
+                variants[("setting", name)] = (
+                    self.encoder_name, resolve_settings(other_settings,
+                                                        self.img_metadata))
+            self.encoder_comparison.start(
+                (self.img_source_key, quality, resolution, self.encoder_name,
+                 self.encode_settings),
+                rgb_buffer, source_size, quality, resolution, variants)
+
+        # one row of sizes and one of times, with a column for every encoder
+        results = self.encoder_comparison.get_results()
+        size_cells = []
+        time_cells = []
+        for name, other_encoder in ENCODERS.items():
+            result = results.get(name, {})
+            size_text = time_text = "..." if not result else "failed"
+            if "size" in result:
+                # scaled up from tiles of big images
+                approx = "~" if result["is_estimate"] else ""
+                size_text = approx + format_byte_count(result["size"])
+                time_text = f"{approx}{result['seconds'] * 1000:.0f} ms"
+            label = other_encoder.label
+            if name == self.encoder_name:
+                label = f"[{label}]"
+            size_cells.append(f"{label} {size_text}")
+            time_cells.append(f"{label} {time_text}")
+        self.img_info_dict["Format sizes"] = " | ".join(size_cells)
+        self.img_info_dict["Format encode times"] = " | ".join(time_cells)
+
+        # bytes saved by each setting compared to its other choice, with its key
+        setting_keys = {name: pygame.key.name(key).upper()
+                        for key, name in self.SETTING_KEYS.items()}
+        setting_cells = []
+        current = results.get(self.encoder_name, {})
+        for name in encoder.setting_names:
+            value = self.encoder_settings[name]
+            other = results.get(("setting", name), {})
+            saved_text = "..." if not (current and other) else "failed"
+            if "size" in current and "size" in other:
+                saved = other["size"] - current["size"]
+                approx = "~" if current["is_estimate"] else ""
+                saved_text = (f"saves {approx}{format_byte_count(saved)}" if saved >= 0
+                              else f"costs {approx}{format_byte_count(-saved)}")
+            setting_cells.append(f"{format_setting(name, value)} {saved_text} "
+                                 f"({setting_keys[name]})")
+        self.img_info_dict["Encoder settings"] = " | ".join(setting_cells)
+
+    def handle_profiler_key(self, event_data):
+        """
+        F3 shows or hides the performance overlay and F4 saves the last seconds of
+        timings as a Chrome trace file. Returns True if the key was used
+        """
+        if event_data.key == pygame.K_F3:
+            self.perf_hud.toggle()
+            profiler.set_enabled(self.perf_hud.isShowing or self.always_profile)
+            return True
+
+        if event_data.key == pygame.K_F4:
+            if not profiler.enabled:
+                self.toast.show("Press F3 to start recording timings first")
+                return True
+            path = os.path.abspath(f"trace_{time.strftime('%Y%m%d_%H%M%S')}.json")
+            try:
+                event_count = profiler.export_chrome_trace(path, self.TRACE_SECONDS)
+                self.toast.show(f"Saved {event_count} events of the last "
+                                f"{self.TRACE_SECONDS}s to {path}")
+            except OSError as ex:
+                self.toast.show(f"Error occurred: {str(ex)}")
+            return True
+        return False
+
+    def draw_img_info_text(self):
+        """
+        Renders the text in self.img_info_dict
+        """
+        render_area = (self.screen.get_width() - self.pad * 2, self.screen.get_height())
+        bg_bounds = self.get_img_info_rect()
         pygame.draw.rect(self.screen, self.img_info_text_bg, bg_bounds, border_radius=10)
 
         ty = self.pad  # store y position of line
         for key, value in self.img_info_dict.items():
             text = str(key) + " : " + str(value)
 
-            # Clip the text if it is too long
-            if self.font.size(text)[0] > render_area[0]:
-                while self.font.size(text + "...")[0] > render_area[0]:
-                    text = text[:-1]
-                text += "..."
-
-            # render the text
-            text = self.font.render(text, True, self.img_info_text_color)
+            # render the text, clipped with "..." if it is too long
+            text = render_text(self.font, text, self.img_info_text_color,
+                               max_width=render_area[0])
             self.screen.blit(text, (self.pad, ty))
             ty += text.get_height()
         self.info_text_height = ty
@@ -268,7 +1473,11 @@ class App:
         """
         # ------------------------------- FILE DRAG AND DROP -----------------------------
         if event_data.type == pygame.DROPFILE:
-            self.load_img(event_data.dict["file"])
+            self.add_dropped_file(event_data.dict["file"])
+
+        # files dropped together arrive between one DROPBEGIN and one DROPCOMPLETE
+        elif event_data.type in (pygame.DROPBEGIN, pygame.DROPCOMPLETE):
+            self.is_first_file_of_drop = True
 
         # ---------------------------- MOUSE BUTTON DOWN EVENT ---------------------------
         elif event_data.type == pygame.MOUSEBUTTONDOWN:
@@ -300,9 +1509,9 @@ class App:
                 # get_rel() gives the change in mouse position since last time it was
                 # called as a tuple(dx,dy). It is called here because pressing right
                 # mouse button triggers dragging of image and for that get_rel() gets
-                # called in update(). If not called here pygame.mouse.get_rel() will give
+                # called in update(). If not called here self.mouse.get_rel() will give
                 # correct change in mouse position in update()
-                pygame.mouse.get_rel()
+                self.mouse.get_rel()
 
         # --------------------------- MOUSE BUTTON UP EVENT ------------------------------
         elif event_data.type == pygame.MOUSEBUTTONUP:
@@ -316,11 +1525,8 @@ class App:
                 self.is_dragging_on_res_slider = False
 
                 # calculate new resolution based on ratio and update the image
-                slider_ratio = self.resolution_slider.value / self.resolution_slider.max_val
-                new_resolution = (int(self.img_org_res[0] * slider_ratio),
-                                  int(self.img_org_res[1] * slider_ratio))
                 self.update_image_quality_and_resolution(self.quality_slider.value,
-                                                         new_resolution)
+                                                         self.get_slider_resolution())
 
             # Release quality slider
             if self.is_dragging_on_quality_slider:
@@ -341,15 +1547,29 @@ class App:
             if self.zoom > self.MAX_ZOOM:
                 self.zoom = self.MAX_ZOOM
 
+        # -------- KEYBOARD EVENT (QUEUE, FORMAT, SETTINGS, QUALITY, TARGET SIZE) --------
+        elif event_data.type == pygame.KEYDOWN:
+            if not self.handle_profiler_key(event_data):
+                # keys are typed into the target size or quality while it is entered
+                if self.quality_target_text is not None:
+                    self.handle_quality_target_key(event_data)
+                elif (self.target_size_text is not None
+                      or not (self.handle_queue_key(event_data)
+                              or self.handle_format_key(event_data)
+                              or self.handle_encoder_setting_key(event_data)
+                              or self.handle_block_cost_key(event_data)
+                              or self.handle_quality_target_key(event_data))):
+                    self.handle_target_size_key(event_data)
+
     def update(self):
         """
-        Responsible for updating the logic of the application. It updates the position, size
-        and logic of all components based on how user interacts with app
+        Responsible for updating the logic of the application. It updates the position,
+        size and logic of all components based on how user interacts with app
         """
         pad = self.pad
 
         # ----------- CODE FOR RESOLUTION SLIDER POSITION, SIZE AND DRAGGING -------------
-        mouse_pos = pygame.mouse.get_pos()
+        mouse_pos = self.mouse.pos
         screen_size = self.screen.get_size()
         slider_size = (screen_size[0] - self.save_btn.size[0] - pad * 2,
                        self.resolution_slider.size[1])
@@ -362,19 +1582,23 @@ class App:
         # check if mouse is on resolution slider or user has been dragging on slider
         # if yes then update the value of the slider
         if self.is_dragging_on_res_slider:
-            if pygame.mouse.get_pressed()[0]:
+            if self.mouse.is_pressed(1):
                 # if mouse is on slider and left mouse button is pressed then
                 # set is_dragging_on_slider to True and set the value of the
                 # slider based on position of mouse on slider
                 slider_ratio = (mouse_pos[0] - self.resolution_slider.pos[0]) / \
                                self.resolution_slider.size[0]
                 self.resolution_slider.set_value_ratio(slider_ratio)
+
+                # preview the new resolution while the slider is still being dragged
+                self.update_image_quality_and_resolution(self.quality_slider.value,
+                                                         self.get_slider_resolution())
             else:
                 # set dragging to false because left mouse button has been released
                 self.is_dragging_on_res_slider = False
 
         #  --------------- CODE FOR QUALITY SLIDER POSITION, SIZE, DRAG ------------------
-        mouse_pos = pygame.mouse.get_pos()
+        mouse_pos = self.mouse.pos
         screen_size = self.screen.get_size()
         slider_size = (screen_size[0] - self.save_btn.size[0] - pad * 2,
                        self.quality_slider.size[1])
@@ -387,7 +1611,7 @@ class App:
         # check if mouse is on quality slider or user has been dragging on slider
         # if yes then update the value of the slider
         if self.is_dragging_on_quality_slider:
-            if pygame.mouse.get_pressed()[0]:
+            if self.mouse.is_pressed(1):
                 # if mouse is on slider and left mouse button is pressed  then set
                 # is_dragging_on_slider to True and set the value of the slider based
                 # on position of mouse on slider
@@ -395,18 +1619,53 @@ class App:
                                self.quality_slider.size[0]
                 new_slider_val = int(self.quality_slider.max_val * slider_ratio)
                 self.quality_slider.set_value(new_slider_val)
+
+                # preview the new quality while the slider is still being dragged
+                self.update_image_quality_and_resolution(self.quality_slider.value, None)
             else:
                 # set dragging to false because left mouse button has been released
                 self.is_dragging_on_quality_slider = False
 
+        # ------------- SHOW PREVIEWS AND SAVES FINISHED IN THE BACKGROUND ---------------
+        # nothing runs in the background before start_pipeline
+        if self.is_pipeline_started:
+            self.finish_full_decode()
+            self.apply_preview_result()
+            self.apply_viewport_result()
+            self.apply_save_results()
+            self.start_pending_searches()
+            self.apply_target_size_result()
+            self.apply_quality_target_result()
+            self.show_size_estimator_error()
+            self.update_encoder_comparison()
+            self.apply_block_cost_map()
+
         #  ----------------------- UPDATE TEXT OF BOTH SLIDERS ---------------------------
+        # the predicted size is shown on both sliders so it changes while dragging
+        # without waiting for an encode
+        predicted_size_text = ""
+        cached_size = self.get_cached_size(self.quality_slider.value, self.new_img_res)
+        if cached_size is not None:
+            # saved before, so the exact size is known
+            predicted_size_text = f" ({format_byte_count(cached_size)})"
+        elif self.size_estimator is not None:
+            self.predicted_img_size = self.size_estimator.estimate(
+                self.quality_slider.value, self.new_img_res)
+            if self.predicted_img_size is not None:
+                predicted_size_text = f" (~{format_byte_count(self.predicted_img_size)})"
+
         self.resolution_slider.set_text(
-            f"Resolution: {self.new_img_res[0]} x {self.new_img_res[1]}")
-        self.quality_slider.set_text("Quality : " + str(self.quality_slider.value) + "%")
+            f"Resolution: {self.new_img_res[0]} x {self.new_img_res[1]}"
+            + predicted_size_text)
+        encoder = get_encoder(self.encoder_name)
+        quality_text = "Quality : " + str(self.quality_slider.value) + "%"
+        if not encoder.has_quality:
+            quality_text += f" (not used by {encoder.label})"
+        self.quality_slider.set_text(quality_text + predicted_size_text)
 
         # --------------------- ALIGNMENT AND SIZE OF IMAGE PREVIEW ----------------------
         # without it the alignment of image preview will be wrong
-        if self.active_img_surface is not None:
+        if self.modified_img_surface is not None:
             ratio = self.img_org_res[0] / self.img_org_res[1]
 
             # calculate image preview size in the center
@@ -429,17 +1688,72 @@ class App:
             # finally update the render position
             self.img_render_pos = (x, y)
 
+        # ------------------- ENCODE ONLY THE VISIBLE PART WHEN ZOOMED -------------------
+        self.update_viewport_preview()
+        if not self.is_viewport_mode:
+            self.img_info_dict["Viewport preview"] = ""
+
         # -------------------------- UPDATE SAVE BUTTON POSITION -------------------------
         self.save_btn.set_pos(self.screen.get_width() - self.save_btn.size[0] - pad / 2,
                               self.resolution_slider.pos[1])
 
         # ----------------------------- UPDATE DRAG PARAMETER ----------------------------
         if self.is_right_mouse_btn_pressed_on_window:
-            new_drag_delta = pygame.mouse.get_rel()
+            new_drag_delta = self.mouse.get_rel()
             self.drag_delta = (
                 self.drag_delta[0] + new_drag_delta[0],
                 self.drag_delta[1] + new_drag_delta[1])
 
+    def get_img_border_rect(self, border_width=10):
+        """
+        Returns the area covered by the image preview and its border
+        """
+        return (self.img_render_pos[0] - border_width,
+                self.img_render_pos[1] - border_width,
+                self.img_render_size[0] + 2 * border_width,
+                self.img_render_size[1] + 2 * border_width)
+
+    def track_dirty_regions(self):
+        """
+        Tells the frame scheduler what every part of the window shows, so that only
+        the parts which changed since the last frame are drawn again
+        """
+        img_rect = (0, 0, 0, 0)
+        if self.modified_img_surface is not None:
+            img_rect = self.get_img_border_rect()
+        self.scheduler.track("image", (id(self.modified_img_surface),
+                                       id(self.get_shown_viewport_preview()),
+                                       self.is_heatmap_shown,
+                                       id(self.block_cost_suggestions),
+                                       self.encode_settings["subsampling"]), img_rect)
+
+        for name, slider in (("resolution slider", self.resolution_slider),
+                             ("quality slider", self.quality_slider)):
+            self.scheduler.track(name, (slider.value, slider.text), slider.get_rect())
+
+        mouse_pos = self.mouse.pos
+        self.scheduler.track("save button",
+                             (self.save_btn.contains_point(mouse_pos[0], mouse_pos[1]),
+                              self.was_save_btn_pressed, self.save_btn.text),
+                             self.save_btn.get_rect())
+
+        self.toast.update()
+        self.scheduler.track("toast", (self.toast.isShowing, self.toast.msg),
+                             self.toast.get_rect(self.screen))
+        self.scheduler.track("info text", tuple(self.img_info_dict.items()),
+                             self.get_img_info_rect())
+
+        self.perf_hud.update()
+        self.scheduler.track("perf hud", tuple(self.perf_hud.lines),
+                             self.perf_hud.get_rect(self.screen, self.get_perf_hud_top()))
+
+    def get_perf_hud_top(self):
+        """
+        Returns the y position the performance overlay is drawn at, below the info text
+        """
+        info_rect = self.get_img_info_rect()
+        return info_rect[1] + info_rect[3] + 10
+
     def render(self):
         """
         Handles rendering of every component visible on screen
@@ -448,25 +1762,21 @@ class App:
         self.screen.fill(self.__bg_color)
 
         # ----------------------------- rendering image preview --------------------------
-        border_width = 10
         # draw the image if it has been loaded
-        if self.active_img_surface is not None:
-            # if the expected image size does not match the size of image surface
-            # then resize the surface
-            if (self.img_render_size[0] != self.active_img_surface.get_width()
-                    or self.img_render_size[1] != self.active_img_surface.get_height()):
-                self.active_img_surface = pygame.transform.scale(self.modified_img_surface
-                                                                 , self.img_render_size)
+        if self.modified_img_surface is not None:
+            if self.img_view.surface is not self.modified_img_surface:
+                self.img_view.set_image(self.modified_img_surface)
 
             # draw a border around image
-            img_border = (
-                self.img_render_pos[0] - border_width,
-                self.img_render_pos[1] - border_width,
-                self.img_render_size[0] + 2 * border_width,
-                self.img_render_size[1] + 2 * border_width)
-            pygame.draw.rect(self.screen, (0, 0, 0), img_border, border_radius=10)
-            # draw the image
-            self.screen.blit(self.active_img_surface, self.img_render_pos)
+            pygame.draw.rect(self.screen, (0, 0, 0), self.get_img_border_rect(),
+                             border_radius=10)
+            # draw the image, only the part of it which is inside the window is scaled
+            self.img_view.draw(self.screen, self.img_render_pos, self.img_render_size)
+            viewport_preview = self.get_shown_viewport_preview()
+            if viewport_preview is not None:
+                self.draw_viewport_preview(viewport_preview)
+            if self.is_heatmap_shown:
+                self.draw_block_cost_heatmap()
 
         # ---------------------------------- DRAW SLIDERS --------------------------------
         # draw resolution slider
@@ -479,48 +1789,343 @@ class App:
             self.save_btn.bg_color = self.save_btn_hover_bg
         else:
             self.save_btn.bg_color = self.save_btn_bg
-        self.save_btn.draw(self.screen)
+        self.save_btn.draw(self.screen, self.mouse.pos)
 
         # ---------------------------------- DRAW TOAST ----------------------------------
         self.toast.draw(self.screen)
         # --------------------------- DRAW OVERLAYING INFO TEXT --------------------------
         self.draw_img_info_text()
+        # ----------------------------- DRAW PERFORMANCE HUD -----------------------------
+        if self.perf_hud.isShowing:
+            self.perf_hud.draw(self.screen, self.get_perf_hud_top())
+
+    def draw_frame(self):
+        """
+        Draws the parts of the window which changed and shows them on screen
+        """
+        dirty_rects = self.scheduler.take_dirty_rects(self.screen.get_rect())
+        if dirty_rects is None:
+            with profiler.span("render"):
+                self.render()
+            with profiler.span("present"):
+                pygame.display.update()
+            return
+
+        # everything is drawn once clipped to the area around the dirty rects, so the
+        # rest of the window keeps what was drawn before
+        if len(dirty_rects) > 0:
+            with profiler.span("render"):
+                self.screen.set_clip(dirty_rects[0].unionall(dirty_rects[1:]))
+                self.render()
+                self.screen.set_clip(None)
+        with profiler.span("present"):
+            pygame.display.update(dirty_rects)
+
+    def show_first_frame(self):
+        """
+        Draws the first frame, then starts the workers. They are made in the time left
+        of that frame so the window shows as soon as it can
+        """
+        self.update()
+        self.track_dirty_regions()
+        self.draw_frame()
+        self.startup_timer.mark("first frame")
+        pipeline_start = time.perf_counter()
+        self.start_pipeline()
+        if self.is_startup_printed:
+            print(self.startup_timer.format_phases())
+            print(f"Time to first frame: {self.startup_timer.get_elapsed() * 1000:.1f} ms"
+                  f", then {(time.perf_counter() - pipeline_start) * 1000:.1f} ms "
+                  f"starting the workers")
+        self.scheduler.end_frame()
+
+    def get_timeout_ms(self):
+        """
+        Returns how long the loop may wait for an event before the toast has to
+        disappear or the overlay has to refresh, or None to wait until one arrives
+        """
+        time_lefts = [time_left for time_left in (self.toast.get_time_left(),
+                                                  self.perf_hud.get_time_left())
+                      if time_left is not None]
+        return min(time_lefts) * 1000 if time_lefts else None
+
+    def run_frame(self, events):
+        """
+        Handles the events of one frame, then updates and draws whatever changed.
+        Returns True if a frame was drawn
+        """
+        frame_start_ns = time.perf_counter_ns()
+
+        # process events
+        with profiler.span("events"):
+            for event in events:
+                self.mouse.handle_event(event)
+                if event.type in self.REDRAW_EVENTS:
+                    self.scheduler.invalidate()
+                elif event.type != pygame.QUIT:
+                    self.handle_event(event)
+
+        with profiler.span("update"):
+            self.update()
+            self.track_dirty_regions()
+        if not self.scheduler.has_dirty():
+            return False
+        self.draw_frame()
+        if profiler.enabled:
+            profiler.record("frame", "app", frame_start_ns, time.perf_counter_ns())
+        self.scheduler.end_frame()
+        return True
+
+    def is_background_idle(self):
+        """
+        Checks that no decode, preview, save, search or comparison is running in the
+        background. Replays wait for this after every frame so that they do the same
+        work on every run
+        """
+        futures = (self.full_decode_future, self.target_size_future,
+                   self.quality_target_future)
+        return (all(future is None or future.done() for future in futures)
+                and self.pending_target_size is None
+                and self.pending_quality_target is None
+                and self.preview_worker.is_idle()
+                and self.viewport_worker.is_idle()
+                and self.save_worker.get_pending_count() == 0
+                and self.encoder_comparison.is_idle()
+                and all(worker is None or worker.is_finished()
+                        for worker in (self.size_estimator, self.block_cost_map)))
+
+    def stop_pipeline(self):
+        """
+        Stops the background workers once the window is closed
+        """
+        self.preview_worker.stop()
+        self.viewport_worker.stop()
+        self.prefetcher.stop()
+        self.encoder_comparison.stop()
+        self.search_executor.shutdown(wait=False, cancel_futures=True)
+
+        # saves already asked for are still written after the window closes
+        self.save_worker.stop()
+        self.save_worker.wait()
+        if self.result_cache is not None:
+            print(self.result_cache.format_stats())
 
     def loop(self):
         """
         Application loop which renders components and updates logic
-         at 60 frames per second
-        """
-        max_fps = 60
-        min_frame_time = 1e9 / max_fps
-
-        t1 = time.time_ns()
-        stop = False
-
-        # the application loop, used for updating and rendering at a maximum of 60 fps
-        while not stop:
-            # process events
-            for event in pygame.event.get():
-                # check if user wants to quit and exit if true
-                if event.type == pygame.QUIT:
-                    stop = True
-                else:
-                    self.handle_event(event)
+         at up to 60 frames per second, and only when something changed
+        """
+        self.show_first_frame()
 
-            # code to make sure the application runs at 60 frames per second
-            t2 = time.time_ns()
-            dt = t2 - t1
-            if dt < min_frame_time:
-                continue
-            t1 = t2
+        # the application loop. It sleeps until an event arrives while nothing changes
+        is_closed = False
+        while not is_closed:
+            events = self.scheduler.get_events(self.get_timeout_ms())
+            if self.event_recorder is not None:
+                self.event_recorder.record(events)
+            # check if user wants to quit and exit if true
+            is_closed = any(event.type == pygame.QUIT for event in events)
+            self.run_frame(events)
 
-            # update and then render in every frame
-            self.update()
-            self.render()
-            pygame.display.update()
+        if self.event_recorder is not None:
+            self.event_recorder.close()
+            print(f"Recorded {self.event_recorder.frame_count} frames of events")
+        self.stop_pipeline()
+
+
+def parse_args(argv=None):
+    """
+    Reads the command line options. Without --batch, --watch or --serve the app opens
+    its window
+    """
+    parser = argparse.ArgumentParser(description="Image Quality Modifier")
+    parser.add_argument("--batch", metavar="DIR",
+                        help="compress every image in DIR without opening a window")
+    parser.add_argument("--watch", metavar="DIR",
+                        help="keep compressing images as they appear in DIR without "
+                             "opening a window, until Ctrl+C is pressed")
+    parser.add_argument("--serve", type=int, metavar="PORT", default=None,
+                        help="compress images sent to POST /compress on PORT without "
+                             "opening a window, until Ctrl+C is pressed")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="with --serve, the address to listen on (default: "
+                             "127.0.0.1)")
+    parser.add_argument("--queue-size", type=int, default=16, metavar="COUNT",
+                        help="with --serve, requests which may wait for a worker, more "
+                             "are answered with 503 (default: 16)")
+    parser.add_argument("--settle", type=float, default=2.0, metavar="SECONDS",
+                        help="with --watch, how long a file must stop changing before "
+                             "it is read (default: 2)")
+    parser.add_argument("--metrics-file", metavar="FILE", default=None,
+                        help="with --watch, keep the queue depth and throughput in FILE "
+                             "as JSON")
+    parser.add_argument("--format", choices=list(ENCODERS), default=DEFAULT_ENCODER,
+                        help=f"format images are saved in (default: {DEFAULT_ENCODER}), "
+                             "E switches it in the window")
+    parser.add_argument("--no-optimize", action="store_true",
+                        help="skip optimizing JPEG Huffman tables and PNG compression, "
+                             "which saves time but makes files bigger (O in the window)")
+    parser.add_argument("--progressive", action="store_true",
+                        help="save progressive JPEGs (P in the window)")
+    parser.add_argument("--subsampling", choices=SUBSAMPLINGS,
+                        default=DEFAULT_SETTINGS["subsampling"],
+                        help="resolution of the JPEG color channels (default: "
+                             f"{DEFAULT_SETTINGS['subsampling']}, S in the window)")
+    parser.add_argument("--metadata",
+                        choices=[choice.replace(" ", "-") for choice in METADATA_CHOICES],
+                        default=DEFAULT_SETTINGS["metadata"],
+                        help="EXIF and ICC profile to copy from the original, "
+                             "no-thumbnail keeps EXIF without its preview image "
+                             f"(default: {DEFAULT_SETTINGS['metadata']}, "
+                             "M in the window)")
+    parser.add_argument("--quality", type=int, default=100,
+                        help="quality from 1 to 100 (default: 100)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="resolution scale from 0 to 1 (default: 1.0)")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--target-size", metavar="SIZE", default=None,
+                        help="largest output size like 100KB, quality is then chosen "
+                             "automatically")
+    parser.add_argument("--target-ssim", type=float, default=None, metavar="SSIM",
+                        help="lowest SSIM allowed like 0.95, quality is then the lowest "
+                             "one reaching it")
+    parser.add_argument("--target-psnr", type=float, default=None, metavar="DB",
+                        help="lowest PSNR allowed in dB like 40, quality is then the "
+                             "lowest one reaching it")
+    parser.add_argument("--metric-proxy", type=float, default=None, metavar="MP",
+                        help="measure SSIM and PSNR on a copy of at most MP megapixels, "
+                             "which is faster (default: full resolution)")
+    parser.add_argument("--cache-dir", metavar="DIR", default=None,
+                        help="folder of the result cache, which keeps encoded images "
+                             "so the same encode is never done twice (default: "
+                             f"{get_default_cache_dir()})")
+    parser.add_argument("--cache-size", metavar="SIZE", default=None,
+                        help="disk space the result cache may use (default: "
+                             f"{format_byte_count(DEFAULT_CACHE_MAX_BYTES)})")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not use the result cache")
+    parser.add_argument("--profile", action="store_true",
+                        help="record timings from the start so F4 can save a trace "
+                             "without showing the overlay first")
+    parser.add_argument("--font", metavar="NAME", default=None,
+                        help="name of an installed font to use (default: the font of "
+                             "pygame). Its file is remembered in the cache folder")
+    parser.add_argument("--record", metavar="FILE", default=None,
+                        help="write every event of the session to FILE, which "
+                             "benchmarks/replay.py can replay without a window")
+    parser.add_argument("--measure-startup", action="store_true",
+                        help="print how long each phase took until the window showed "
+                             "its first frame")
+    parser.add_argument("--max-image-memory", metavar="SIZE", default=None,
+                        help="memory decoded images may use, bigger images are kept on "
+                             "disk and edited through a smaller proxy (default: "
+                             f"{format_byte_count(DEFAULT_MAX_BYTES)})")
+    args = parser.parse_args(argv)
+
+    if args.max_image_memory is None:
+        args.max_image_memory = DEFAULT_MAX_BYTES
+    else:
+        args.max_image_memory = parse_byte_count(args.max_image_memory)
+        if not args.max_image_memory:
+            parser.error("--max-image-memory must be a size like 512MB or 2GB")
+
+    if args.cache_size is None:
+        args.cache_size = DEFAULT_CACHE_MAX_BYTES
+    else:
+        args.cache_size = parse_byte_count(args.cache_size)
+        if not args.cache_size:
+            parser.error("--cache-size must be a size like 512MB or 2GB")
+
+    if args.target_size is not None:
+        args.target_size = parse_byte_count(args.target_size)
+        if not args.target_size:
+            parser.error("--target-size must be a size like 100KB, 1.5MB or 20000")
+
+    args.target_score = None
+    if args.target_ssim is not None and args.target_psnr is not None:
+        parser.error("--target-ssim and --target-psnr cannot be used together")
+    if args.target_ssim is not None:
+        if not 0 < args.target_ssim <= 1:
+            parser.error("--target-ssim must be greater than 0 and at most 1")
+        args.target_score = ("ssim", args.target_ssim)
+    if args.target_psnr is not None:
+        if args.target_psnr <= 0:
+            parser.error("--target-psnr must be greater than 0")
+        args.target_score = ("psnr", args.target_psnr)
+    if args.target_score is not None and args.target_size is not None:
+        parser.error("--target-size cannot be used with --target-ssim or --target-psnr")
+
+    args.metric_max_pixels = None
+    if args.metric_proxy is not None:
+        if args.metric_proxy <= 0:
+            parser.error("--metric-proxy must be greater than 0")
+        args.metric_max_pixels = int(args.metric_proxy * 1e6)
+
+    args.encoder_settings = {"optimize": not args.no_optimize,
+                             "progressive": args.progressive,
+                             "subsampling": args.subsampling,
+                             "metadata": args.metadata.replace("-", " ")}
+
+    if sum(mode is not None for mode in (args.batch, args.watch, args.serve)) > 1:
+        parser.error("only one of --batch, --watch and --serve can be used")
+    if args.serve is not None and not 0 <= args.serve <= 65535:
+        parser.error("--serve must be a port from 0 to 65535")
+    if args.queue_size < 0:
+        parser.error("--queue-size cannot be negative")
+    if args.settle < 0:
+        parser.error("--settle cannot be negative")
+
+    if not 1 <= args.quality <= 100:
+        parser.error("--quality must be between 1 and 100")
+    if not 0 < args.scale <= 1:
+        parser.error("--scale must be greater than 0 and at most 1")
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
 
 
 # Start app
 if __name__ == "__main__":
-    app = App()
+    startup_timer = StartupTimer(STARTUP_START)
+    startup_timer.mark("imports")
+    cli_args = parse_args()
+    result_cache = None
+    if not cli_args.no_cache:
+        result_cache = ResultCache(cli_args.cache_dir, cli_args.cache_size)
+
+    if cli_args.batch is not None:
+        # headless mode, pygame is never initialized here
+        from processing.batch import run_batch
+
+        if not os.path.isdir(cli_args.batch):
+            sys.exit(f"Not a directory: {cli_args.batch}")
+        failed_count = run_batch(cli_args.batch, cli_args.quality, cli_args.scale,
+                                 cli_args.jobs, cli_args.target_size, cli_args.format,
+                                 cli_args.target_score, cli_args.metric_max_pixels,
+                                 cli_args.encoder_settings, result_cache)
+        sys.exit(1 if failed_count else 0)
+    if cli_args.watch is not None:
+        from processing.watch_folder import run_watch
+
+        if not os.path.isdir(cli_args.watch):
+            sys.exit(f"Not a directory: {cli_args.watch}")
+        failed_count = run_watch(cli_args.watch, cli_args.quality, cli_args.scale,
+                                 cli_args.jobs, cli_args.target_size, cli_args.format,
+                                 cli_args.target_score, cli_args.metric_max_pixels,
+                                 cli_args.encoder_settings, cli_args.settle,
+                                 cli_args.metrics_file, result_cache)
+        sys.exit(1 if failed_count else 0)
+    if cli_args.serve is not None:
+        from processing.service import run_service
+
+        run_service(cli_args.host, cli_args.serve, cli_args.jobs, cli_args.queue_size,
+                    result_cache)
+        sys.exit(0)
+
+    startup_timer.mark("arguments")
+    app = App(cli_args.max_image_memory, cli_args.profile, cli_args.format,
+              cli_args.encoder_settings, result_cache, cli_args.font,
+              startup_timer if cli_args.measure_startup else None,
+              record_path=cli_args.record)
     app.loop()
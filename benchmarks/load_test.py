@@ -0,0 +1,119 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+from benchmarks.synthetic import get_synthetic_jpeg
+from processing.pipeline import format_byte_count
+from processing.service import DEFAULT_PORT, percentile
+
+
+async def send_request(host, port, path, body):
+    """
+    POSTs body to path on a new connection. Returns the status code and the headers
+    and body of the response
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write((f"POST {path} HTTP/1.1\r\nHost: {host}:{port}\r\n"
+                      f"Content-Type: application/octet-stream\r\n"
+                      f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n")
+                     .encode("latin-1"))
+        writer.write(body)
+        await writer.drain()
+
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        response_body = await reader.readexactly(int(headers.get("content-length", 0)))
+        return status, headers, response_body
+    finally:
+        writer.close()
+
+
+async def run_load(url, body, concurrency, request_count):
+    """
+    Sends request_count requests with concurrency of them in flight at once.
+    Returns the wall time, the latency of each ok request in seconds and the count
+    of each status code
+    """
+    parts = urlsplit(url)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    remaining = iter(range(request_count))
+    latencies = []
+    statuses = {}
+
+    async def client():
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                status, _, _ = await send_request(parts.hostname, parts.port, path, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                status = "connection error"
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return time.perf_counter() - start, latencies, statuses
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of app.py --serve")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{DEFAULT_PORT}/compress",
+                        help="where the service runs, query options like "
+                             "?quality=70&width=800 are sent as they are (default: "
+                             f"http://127.0.0.1:{DEFAULT_PORT}/compress)")
+    parser.add_argument("--image", metavar="FILE",
+                        help="image sent in every request (default: a synthetic JPEG "
+                             "of --megapixels)")
+    parser.add_argument("--megapixels", type=float, default=2, metavar="MP",
+                        help="size of the synthetic JPEG (default: 2)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="requests in flight at once (default: 8)")
+    parser.add_argument("--requests", type=int, default=100,
+                        help="requests sent in total (default: 100)")
+    args = parser.parse_args(argv)
+
+    if args.concurrency < 1 or args.requests < 1:
+        parser.error("--concurrency and --requests must be at least 1")
+    if args.megapixels <= 0:
+        parser.error("--megapixels must be greater than 0")
+    parts = urlsplit(args.url)
+    if parts.scheme != "http" or not parts.hostname or not parts.port:
+        parser.error("--url must be like http://127.0.0.1:8080/compress")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    path = args.image
+    if path is None:
+        directory = os.path.join(tempfile.gettempdir(), "iqm_bench_images")
+        path = get_synthetic_jpeg(directory, args.megapixels)
+    with open(path, "rb") as f:
+        body = f.read()
+
+    print(f"Sending {args.requests} requests of {format_byte_count(len(body))} with "
+          f"{args.concurrency} at once to {args.url}")
+    seconds, latencies, statuses = asyncio.run(
+        run_load(args.url, body, args.concurrency, args.requests))
+
+    print(", ".join(f"{count} x {status}" for status, count in sorted(
+        statuses.items(), key=lambda item: str(item[0]))))
+    print(f"{len(latencies) / seconds:.2f} images/s over {seconds:.2f}s")
+    if latencies:
+        print(f"latency p50 {percentile(latencies, 50) * 1000:.1f} ms, "
+              f"p99 {percentile(latencies, 99) * 1000:.1f} ms, "
+              f"max {max(latencies) * 1000:.1f} ms")
+    return 0 if statuses.get(200) == args.requests else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import pygame
+
+from benchmarks.run import MIN_REGRESSION_BYTES, MIN_REGRESSION_MS, get_peak_memory
+from components.clock import VirtualClock
+from components.event_log import read_event_log
+from components.perf_hud import FRAME_PHASES
+from processing.image_store import get_resident_memory
+from processing.pipeline import format_byte_count
+from processing.profiler import profiler
+from processing.service import percentile
+
+MAX_SETTLE_FRAMES = 100  # frames run after one recorded frame until nothing changes
+SETTLE_TIMEOUT = 300  # seconds the background work of one frame may take
+WORK_NAMES = ("decode", "resize", "encode", "preview decode")  # counted per thread
+
+
+def map_dropped_files(frames, images):
+    """
+    Replaces the files dropped in the recorded session with images: the first file
+    dropped with the first image, the second with the second and so on, starting
+    over once every image was used. If the session never dropped a file, the first
+    image is dropped just before its first frame
+    """
+    mapping = {}
+    is_dropped = False
+    for _, events in frames:
+        for event in events:
+            if event.type == pygame.DROPFILE:
+                is_dropped = True
+                if event.file not in mapping:
+                    mapping[event.file] = images[len(mapping) % len(images)]
+                event.file = mapping[event.file]
+    if not is_dropped:
+        first_time = frames[0][0] if frames else 0.0
+        frames.insert(0, (first_time, [pygame.event.Event(pygame.DROPFILE,
+                                                          file=images[0])]))
+    return frames
+
+
+def get_thread_kind(name):
+    # threads of an executor are called like encoder-comparison_3
+    return re.sub(r"_\d+$", "", name)
+
+
+class Replay:
+    """
+    Replays a recorded session on the app with the SDL dummy driver. Time is a
+    VirtualClock set to the recorded time of every frame, so toasts and the frame
+    rate cap act as they did while recording however fast the frames run. After
+    every frame the replay waits for all background work and runs the frames which
+    show its results, so the same session always does the same work
+    """
+
+    def __init__(self, app, clock):
+        self.app = app
+        self.clock = clock
+        self.frames = []  # one dict per frame which ran
+        self.work = {}  # work name -> thread kind -> [count, total ms]
+        self.peak_resident = 0
+        self.last_ns = time.perf_counter_ns()
+
+    def run(self, frames):
+        """
+        Runs every recorded frame, until the frame the window was closed in
+        """
+        self.app.show_first_frame()
+        for frame_time, events in frames:
+            self.run_timeouts(frame_time)
+            self.clock.advance_to(frame_time)
+            for event in events:
+                if event.type == pygame.VIDEORESIZE:
+                    self.app.screen = pygame.display.set_mode(event.size,
+                                                              pygame.RESIZABLE)
+            self.run_frame(events, "recorded")
+            self.settle()
+            if any(event.type == pygame.QUIT for event in events):
+                break
+        self.app.stop_pipeline()
+
+    def run_timeouts(self, until):
+        """
+        Runs the frames the app would have woken up for by itself before until,
+        when a toast disappears or the overlay refreshes
+        """
+        while True:
+            timeout_ms = self.app.get_timeout_ms()
+            if timeout_ms is None or self.clock.now() + timeout_ms / 1000 >= until:
+                return
+            self.clock.advance_to(self.clock.now() + timeout_ms / 1000)
+            self.run_frame([], "timeout")
+
+    def settle(self):
+        """
+        Waits for the background work and runs frames until they stop changing
+        anything
+        """
+        for _ in range(MAX_SETTLE_FRAMES):
+            deadline = time.perf_counter() + SETTLE_TIMEOUT
+            while not self.app.is_background_idle():
+                if time.perf_counter() > deadline:
+                    raise TimeoutError(f"Background work took over {SETTLE_TIMEOUT}s")
+                time.sleep(0.001)
+            # wake events of the workers, this replay decides when frames run
+            pygame.event.clear()
+            if not self.run_frame([], "settle") and self.app.is_background_idle():
+                return
+
+    def run_frame(self, events, kind):
+        start_ns = time.perf_counter_ns()
+        is_drawn = self.app.run_frame(events)
+        end_ns = time.perf_counter_ns()
+
+        phases = dict.fromkeys(FRAME_PHASES, 0.0)
+        main_thread = threading.main_thread().ident
+        for name, _, tid, event_start_ns, event_end_ns in profiler.get_events_since(
+                self.last_ns):
+            if name in WORK_NAMES:
+                kind_work = self.work.setdefault(name, {}).setdefault(
+                    get_thread_kind(profiler.thread_names.get(tid, "")), [0, 0.0])
+                kind_work[0] += 1
+                kind_work[1] += (event_end_ns - event_start_ns) / 1e6
+            elif name in phases and tid == main_thread and event_start_ns >= start_ns:
+                phases[name] += (event_end_ns - event_start_ns) / 1e6
+        self.last_ns = end_ns
+
+        memory = get_resident_memory()
+        if memory is not None:
+            self.peak_resident = max(self.peak_resident, memory["resident"])
+        self.frames.append({"time": round(self.clock.now(), 6), "kind": kind,
+                            "events": len(events), "drawn": is_drawn,
+                            "frame_ms": (end_ns - start_ns) / 1e6,
+                            **{f"{name}_ms": ms for name, ms in phases.items()}})
+        return is_drawn
+
+    def get_results(self):
+        summary = {"frame_count": len(self.frames),
+                   "drawn_count": sum(frame["drawn"] for frame in self.frames),
+                   "peak_resident_bytes": self.peak_resident or None,
+                   "peak_rss_bytes": get_peak_memory()}
+        for name in ("frame",) + FRAME_PHASES:
+            values = [frame[f"{name}_ms"] for frame in self.frames]
+            summary[f"{name}_ms"] = {"p50": percentile(values, 50),
+                                     "p95": percentile(values, 95),
+                                     "max": max(values)}
+        summary["work"] = {name: {kind: {"count": count, "total_ms": total_ms}
+                                  for kind, (count, total_ms) in sorted(kinds.items())}
+                           for name, kinds in self.work.items()}
+        return {"summary": summary, "frames": self.frames}
+
+
+def run_replay(log_path, images):
+    """
+    Replays the session recorded in log_path on copies of images, so saves made in
+    the session do not land next to the originals. Returns the results as a dict
+    """
+    # the app draws into memory instead of opening a window
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    import app as app_module
+
+    header, frames = read_event_log(log_path)
+    with tempfile.TemporaryDirectory(prefix="iqm_replay_") as directory:
+        copies = []
+        for i, path in enumerate(images):
+            copies.append(os.path.join(directory, f"{i}_{os.path.basename(path)}"))
+            shutil.copyfile(path, copies[-1])
+        frames = map_dropped_files(frames, copies)
+
+        # without a result cache every run encodes the same. Timings are recorded
+        # from the start, the per frame times and work counts are read from them
+        clock = VirtualClock()
+        app = app_module.App(profile=True, clock=clock)
+        app.screen = pygame.display.set_mode(header["window_size"], pygame.RESIZABLE)
+        replay = Replay(app, clock)
+        start = time.perf_counter()
+        replay.run(frames)
+        wall_seconds = time.perf_counter() - start
+        pygame.quit()
+
+    results = replay.get_results()
+    results["meta"] = {"python": platform.python_version(),
+                       "pygame": pygame.version.ver,
+                       "recorded_pygame": header["pygame"],
+                       "platform": platform.platform(),
+                       "cpu_count": os.cpu_count(),
+                       "log": os.path.basename(log_path),
+                       "images": [os.path.basename(path) for path in images],
+                       "recorded_frames": len(frames),
+                       "wall_seconds": wall_seconds}
+    return results
+
+
+def format_results(results):
+    summary = results["summary"]
+    lines = [f"{summary['frame_count']} frames ({summary['drawn_count']} drawn) in "
+             f"{results['meta']['wall_seconds']:.2f}s, peak memory "
+             f"{format_byte_count(summary['peak_rss_bytes'] or 0)}",
+             f"  {'':<10}{'p50':>10}{'p95':>10}{'max':>10}"]
+    for name in ("frame",) + FRAME_PHASES:
+        stat = summary[f"{name}_ms"]
+        lines.append(f"  {name:<10}{stat['p50']:>7.2f} ms{stat['p95']:>7.2f} ms"
+                     f"{stat['max']:>7.2f} ms")
+    for name, kinds in summary["work"].items():
+        counts = ", ".join(f"{kind or 'unnamed'} {work['count']}"
+                           for kind, work in kinds.items())
+        lines.append(f"  {name}: {sum(work['count'] for work in kinds.values())} "
+                     f"({counts})")
+    return "\n".join(lines)
+
+
+def get_work_count(summary, name):
+    return sum(work["count"] for work in summary["work"].get(name, {}).values())
+
+
+def compare(results, baseline, threshold, out=print):
+    """
+    Prints how the replay changed since baseline and returns the number of values
+    which got worse by more than threshold (0.1 is 10%). The work done is the same
+    on every run of a session, so any extra decode or encode counts
+    """
+    summary = results["summary"]
+    base_summary = baseline["summary"]
+    rows = []
+    for name in ("frame", "update", "render"):
+        for stat in ("p50", "p95"):
+            rows.append((f"{name} {stat}", base_summary[f"{name}_ms"][stat],
+                         summary[f"{name}_ms"][stat], threshold, MIN_REGRESSION_MS,
+                         "ms"))
+    if summary["peak_rss_bytes"] and base_summary["peak_rss_bytes"]:
+        rows.append(("peak memory", base_summary["peak_rss_bytes"] / 2 ** 20,
+                     summary["peak_rss_bytes"] / 2 ** 20, threshold,
+                     MIN_REGRESSION_BYTES / 2 ** 20, "MB"))
+    for name in sorted(set(summary["work"]) | set(base_summary["work"])):
+        rows.append((f"{name} count", get_work_count(base_summary, name),
+                     get_work_count(summary, name), 0.0, 0, ""))
+
+    regressions = 0
+    out(f"{'value':<22}{'baseline':>12}{'now':>12}{'change':>9}")
+    for name, before, now, max_change, min_difference, unit in rows:
+        change = (now - before) / before if before > 0 else float(now > 0)
+        is_regression = change > max_change and now - before > min_difference
+        regressions += is_regression
+        out(f"{name:<22}{before:>9.2f} {unit:<2}{now:>9.2f} {unit:<2}{change:>+9.1%}"
+            + ("  REGRESSION" if is_regression else ""))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay a session recorded with app.py --record without a window")
+    parser.add_argument("log", help="file written by app.py --record")
+    parser.add_argument("--image", nargs="+", required=True, metavar="FILE",
+                        help="images dropped instead of the ones of the recording, in "
+                             "the order they were dropped")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the results and the times of every frame to FILE "
+                             "as JSON")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare with results written earlier with --output")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="slowdown counted as a regression (default: 0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    for path in [args.log] + args.image:
+        if not os.path.isfile(path):
+            parser.error(f"not a file: {path}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = run_replay(args.log, args.image)
+    print(format_results(results))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{regressions} regressions over {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
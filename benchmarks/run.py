@@ -0,0 +1,292 @@
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pygame
+from PIL import Image
+
+from benchmarks.synthetic import get_synthetic_jpeg
+from processing.image_store import get_resident_memory
+from processing.pipeline import (buffer_to_pil, decode_to_rgb_buffer, format_byte_count,
+                                 resize_and_encode, scale_resolution)
+from processing.surfaces import buffer_to_surface
+
+DEFAULT_SIZES = (0.3, 2, 12, 24, 100)  # megapixels
+MIN_REGRESSION_MS = 2.0  # differences smaller than this are treated as noise
+MIN_REGRESSION_BYTES = 16 * 1024 * 1024
+
+
+def time_runs(func, repeats, setup=None):
+    """
+    Calls func repeats times and returns the time of each call in milliseconds. The
+    value returned by setup, if given, is passed to func and is not timed. One more
+    call is made first, untimed, so that caches and lazy imports are warm
+    """
+    runs = []
+    for i in range(repeats + 1):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        func(arg) if setup is not None else func()
+        if i > 0:
+            runs.append((time.perf_counter() - start) * 1000)
+    return runs
+
+
+def summarize(runs):
+    return {"median_ms": statistics.median(runs),
+            "min_ms": min(runs),
+            "runs_ms": [round(run, 3) for run in runs]}
+
+
+def get_peak_memory():
+    """
+    Returns the highest resident memory of this process so far in bytes, or None if
+    the platform does not tell
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # kB on Linux
+
+
+def bench_pipeline(path, repeats):
+    """
+    Times the processing stages one by one, outside of the app
+    """
+    stages = {}
+    buffer, size = decode_to_rgb_buffer(path)
+    half = scale_resolution(size, 0.5)
+
+    stages["decode"] = time_runs(lambda: decode_to_rgb_buffer(path), repeats)
+    stages["resize"] = time_runs(
+        lambda: buffer_to_pil(buffer, size).resize(half, Image.Resampling.LANCZOS),
+        repeats)
+    stages["encode"] = time_runs(
+        lambda: resize_and_encode(buffer_to_pil(buffer, size), None, 80), repeats)
+    stages["surface"] = time_runs(lambda: buffer_to_surface(buffer, size), repeats)
+
+    data = resize_and_encode(buffer_to_pil(buffer, size), None, 80)
+    stages["preview_decode"] = time_runs(
+        lambda f: pygame.image.load(f, "JPEG"), repeats, setup=lambda: io.BytesIO(data))
+    return stages
+
+
+def wait_for_thread(name):
+    for thread in threading.enumerate():
+        if thread.name == name:
+            thread.join()
+
+
+def bench_app(path, repeats, frames):
+    """
+    Times the app itself: loading, previews, saving and drawing frames
+    """
+    import app as app_module
+
+    stages = {}
+    app = app_module.App()
+    app.start_pipeline()  # done by App.loop after the first frame
+
+    # the UI thread part of loading, then until the full resolution image is ready
+    start = time.perf_counter()
+    app.load_img(path)
+    stages["load"] = [(time.perf_counter() - start) * 1000]
+    app.finish_full_decode(wait=True)
+    stages["load_full"] = [(time.perf_counter() - start) * 1000]
+
+    # the size estimator and the block cost map would compete with everything timed
+    # below
+    app.size_estimator.cancel()
+    app.block_cost_map.cancel()
+    wait_for_thread("size-estimator")
+    wait_for_thread("block-costs")
+    app.toast.hide()
+
+    def preview(quality):
+        app.update_image_quality_and_resolution(quality, app.img_org_res)
+        while app.preview_worker.get_result() is None:
+            time.sleep(0.0005)
+
+    qualities = iter(range(90, 0, -1))
+    stages["preview"] = time_runs(preview, repeats, setup=lambda: next(qualities))
+
+    def save(quality):
+        app.quality_slider.set_value(quality)
+        app.save_img()
+        while app.save_worker.get_pending_count() > 0:
+            time.sleep(0.0005)
+        for result in app.save_worker.get_results():
+            if "error" in result:
+                raise RuntimeError(result["error"])
+
+    stages["save"] = time_runs(save, repeats, setup=lambda: next(qualities))
+    os.remove(app.modified_img_path)
+
+    def full_frame():
+        app.update()
+        app.render()
+        pygame.display.update()
+
+    # the first frame starts the encoder comparison of the settings, which would
+    # compete with the frames timed below. The frames keep the same settings so it
+    # is not started again
+    full_frame()
+    while not app.encoder_comparison.is_idle():
+        time.sleep(0.001)
+    stages["frame_full"] = time_runs(full_frame, frames)
+
+    def slider_frame(value):
+        app.resolution_slider.set_value(value)
+        app.update()
+        app.track_dirty_regions()
+        app.draw_frame()
+
+    values = iter(range(frames * 2))
+    stages["frame_slider"] = time_runs(slider_frame, frames,
+                                       setup=lambda: 100 - next(values) % 50)
+    pygame.quit()
+    return stages
+
+
+def bench_size(megapixels, image_dir, repeats, frames):
+    """
+    Runs every benchmark on one image size. Meant to run in its own process
+    """
+    path = get_synthetic_jpeg(image_dir, megapixels)
+    with Image.open(path) as pil_img:
+        resolution = pil_img.size
+    start_memory = get_resident_memory()
+
+    stages = bench_pipeline(path, repeats)
+    stages.update(bench_app(path, repeats, frames))
+    return {"resolution": list(resolution),
+            "file_bytes": os.path.getsize(path),
+            "start_rss_bytes": start_memory["resident"] if start_memory else None,
+            "peak_rss_bytes": get_peak_memory(),
+            "stages": {name: summarize(runs) for name, runs in stages.items()}}
+
+
+def run_benchmarks(sizes, image_dir, repeats, frames, out=print):
+    """
+    Runs the benchmarks on every size in sizes (in megapixels), each in a new
+    process so that the peak memory of one size does not hide the next one
+    """
+    # the app draws into memory instead of opening a window
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    results = {"meta": {"python": platform.python_version(),
+                        "pillow": Image.__version__,
+                        "pygame": pygame.version.ver,
+                        "platform": platform.platform(),
+                        "cpu_count": os.cpu_count(),
+                        "repeats": repeats,
+                        "frames": frames},
+               "sizes": {}}
+    for megapixels in sizes:
+        out(f"{megapixels} MP...")
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(bench_size, megapixels, image_dir, repeats,
+                                     frames).result()
+        results["sizes"][f"{megapixels}MP"] = result
+        out(format_size_result(result))
+    return results
+
+
+def format_size_result(result):
+    lines = [f"  {result['resolution'][0]}x{result['resolution'][1]}, "
+             f"peak memory {format_byte_count(result['peak_rss_bytes'] or 0)}"]
+    for name, stage in result["stages"].items():
+        lines.append(f"  {name:<16}{stage['median_ms']:>10.2f} ms")
+    return "\n".join(lines)
+
+
+def compare(results, baseline, threshold, out=print):
+    """
+    Prints how every stage changed since baseline and returns the number of stages
+    which got slower, or used more memory, by more than threshold (0.1 is 10%).
+    The fastest run of each stage is compared because other work on the machine
+    only ever makes a run slower
+    """
+    regressions = 0
+    out(f"{'size':<8}{'stage':<16}{'baseline':>12}{'now':>12}{'change':>9}")
+    for size_name, result in results["sizes"].items():
+        base_result = baseline["sizes"].get(size_name)
+        if base_result is None:
+            continue
+
+        rows = [(name, base_result["stages"][name]["min_ms"], stage["min_ms"],
+                 MIN_REGRESSION_MS, "ms")
+                for name, stage in result["stages"].items()
+                if name in base_result["stages"]]
+        if result["peak_rss_bytes"] and base_result["peak_rss_bytes"]:
+            rows.append(("peak memory", base_result["peak_rss_bytes"] / 2 ** 20,
+                         result["peak_rss_bytes"] / 2 ** 20,
+                         MIN_REGRESSION_BYTES / 2 ** 20, "MB"))
+
+        for name, before, now, min_difference, unit in rows:
+            change = (now - before) / before if before > 0 else 0.0
+            is_regression = change > threshold and now - before > min_difference
+            regressions += is_regression
+            out(f"{size_name:<8}{name:<16}{before:>9.2f} {unit}{now:>9.2f} {unit}"
+                f"{change:>+9.1%}" + ("  REGRESSION" if is_regression else ""))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Image Quality Modifier benchmarks")
+    parser.add_argument("--sizes", type=float, nargs="+", default=DEFAULT_SIZES,
+                        metavar="MP", help="image sizes in megapixels (default: "
+                                           f"{' '.join(map(str, DEFAULT_SIZES))})")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="times each stage runs, the median is kept (default: 3)")
+    parser.add_argument("--frames", type=int, default=30,
+                        help="frames drawn for the frame time stages (default: 30)")
+    parser.add_argument("--image-dir",
+                        default=os.path.join(tempfile.gettempdir(), "iqm_bench_images"),
+                        help="where the synthetic JPEGs are made and kept")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the results to FILE as JSON")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare with results written earlier with --output")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="slowdown counted as a regression (default: 0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    if args.repeats < 1 or args.frames < 1:
+        parser.error("--repeats and --frames must be at least 1")
+    if any(size <= 0 for size in args.sizes):
+        parser.error("--sizes must be greater than 0")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = run_benchmarks(args.sizes, args.image_dir, args.repeats, args.frames)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{regressions} regressions over {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
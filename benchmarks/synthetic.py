@@ -0,0 +1,68 @@
+import io
+import math
+import os
+import random
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from processing.pipeline import write_file_atomic
+
+
+def get_megapixel_resolution(megapixels, aspect_ratio=4 / 3):
+    """
+    Returns the resolution with the given aspect ratio closest to megapixels million
+    pixels
+    """
+    width = round(math.sqrt(megapixels * 1e6 * aspect_ratio))
+    return width, max(1, round(width / aspect_ratio))
+
+
+def make_synthetic_image(resolution, seed=0):
+    """
+    Returns a PIL image which looks enough like a photo to compress like one: smooth
+    gradients, blurred shapes with sharp edges on top and fine grain. The same
+    resolution and seed always give the same pixels
+    """
+    rng = random.Random(seed)
+    width, height = resolution
+
+    # smooth background from a few random colors scaled up
+    background = Image.frombytes("RGB", (4, 3), rng.randbytes(4 * 3 * 3))
+    img = background.resize(resolution, Image.Resampling.BICUBIC)
+
+    # shapes of every size, the small ones give the encoder detail to keep
+    draw = ImageDraw.Draw(img)
+    shape_count = max(20, width * height // 20000)
+    for _ in range(shape_count):
+        size = max(2, int(min(width, height) * rng.random() ** 3 * 0.5))
+        x = rng.randrange(width)
+        y = rng.randrange(height)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.ellipse((x, y, x + size, y + size), fill=color)
+        else:
+            draw.rectangle((x, y, x + size, y + size // 2 + 1), fill=color)
+    img = img.filter(ImageFilter.GaussianBlur(max(1, width // 2000)))
+
+    # sensor-like grain, made small and scaled up so large images stay fast to make
+    grain_size = (max(1, width // 2), max(1, height // 2))
+    grain = Image.frombytes("L", grain_size, rng.randbytes(grain_size[0] * grain_size[1]))
+    grain = grain.resize(resolution, Image.Resampling.BILINEAR).convert("RGB")
+    return Image.blend(img, grain, 0.08)
+
+
+def get_synthetic_jpeg(directory, megapixels, seed=0, quality=92):
+    """
+    Returns the path of a synthetic JPEG of megapixels million pixels in directory,
+    making it first if it does not exist yet
+    """
+    resolution = get_megapixel_resolution(megapixels)
+    path = os.path.join(directory, f"synthetic_{resolution[0]}x{resolution[1]}_"
+                                   f"seed{seed}_q{quality}.jpg")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        buffer = io.BytesIO()
+        make_synthetic_image(resolution, seed).save(buffer, format="JPEG",
+                                                    quality=quality)
+        write_file_atomic(path, buffer.getvalue())
+    return path
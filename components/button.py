@@ -1,5 +1,7 @@
 import pygame
 
+from components.text_cache import render_text
+
 
 # Button class for creating interactive buttons
 class Button:
@@ -16,9 +18,8 @@ class Button:
     def set_pos(self, x, y):
         self.pos = (x, y)
 
-    # Draw button on surface
-    def draw(self, surface):
-        mouse_pos = pygame.mouse.get_pos()
+    # Draw button on surface, in its hover color if mouse_pos is on it
+    def draw(self, surface, mouse_pos):
         if self.contains_point(mouse_pos[0], mouse_pos[1]):
             bg_color = self.hover_color
         else:
@@ -29,12 +30,15 @@ class Button:
         pygame.draw.rect(surface, bg_color, bounds, border_radius=10)
 
         # draw text
-        txt_size = self.font.size(self.text)
-        txt_surface = self.font.render(self.text, True, self.text_color)
-        txt_pos = (self.pos[0] + (self.size[0] - txt_size[0]) / 2,
-                   self.pos[1] + (self.size[1] - txt_size[1]) / 2)
+        txt_surface = render_text(self.font, self.text, self.text_color)
+        txt_pos = (self.pos[0] + (self.size[0] - txt_surface.get_width()) / 2,
+                   self.pos[1] + (self.size[1] - txt_surface.get_height()) / 2)
         surface.blit(txt_surface, txt_pos)
 
+    # Get the area the button covers
+    def get_rect(self):
+        return self.pos[0], self.pos[1], self.size[0], self.size[1]
+
     # Set button text
     def set_text(self, text):
         self.text = text
@@ -0,0 +1,31 @@
+import time
+
+
+# Clock is where the window gets the time from, in seconds: toast durations, overlay
+# refreshes and the frame rate cap all read it. It is the real time, replays of
+# recorded sessions use a VirtualClock instead
+class Clock:
+    def now(self):
+        return time.perf_counter()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+# VirtualClock only moves forward when it is told to, or when something sleeps on it.
+# Timeouts in a replay then depend on the recorded times, not on how fast the machine
+# runs the frames
+class VirtualClock:
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.time += max(0.0, seconds)
+
+    # Move to time, unless the clock is already past it
+    def advance_to(self, time):
+        self.time = max(self.time, time)
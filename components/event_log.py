@@ -0,0 +1,74 @@
+import json
+
+import pygame
+
+EVENT_LOG_VERSION = 1
+
+
+# Convert an event to a dict which can be written as JSON. Attributes JSON cannot
+# hold, like the window object of window events, are left out
+def event_to_dict(event):
+    attrs = {}
+    for name, value in event.dict.items():
+        if isinstance(value, tuple):
+            value = list(value)
+        if is_json_value(value):
+            attrs[name] = value
+    return {"type": event.type, "name": pygame.event.event_name(event.type),
+            "attrs": attrs}
+
+
+def is_json_value(value):
+    if isinstance(value, list):
+        return all(is_json_value(item) for item in value)
+    return value is None or isinstance(value, (bool, int, float, str))
+
+
+# Convert a dict made by event_to_dict back to an event. Lists become tuples again,
+# like the positions pygame gives
+def dict_to_event(event_dict):
+    attrs = {name: tuple(value) if isinstance(value, list) else value
+             for name, value in event_dict["attrs"].items()}
+    return pygame.event.Event(event_dict["type"], attrs)
+
+
+# EventRecorder writes the events the app gets to a file, one line of JSON per frame
+# which had any, with the time since recording started. The first line holds the
+# window size and the pygame version. Events the app posts to itself, like the wake
+# events of background workers, are not recorded since a replay makes its own
+class EventRecorder:
+    def __init__(self, path, window_size, clock):
+        self.file = open(path, "w")
+        self.clock = clock
+        self.start_time = clock.now()
+        self.frame_count = 0
+        self.write_line({"version": EVENT_LOG_VERSION, "pygame": pygame.version.ver,
+                         "window_size": list(window_size)})
+
+    # Record the events of one frame
+    def record(self, events):
+        event_dicts = [event_to_dict(event) for event in events
+                       if pygame.NOEVENT < event.type < pygame.USEREVENT]
+        if event_dicts:
+            self.write_line({"time": round(self.clock.now() - self.start_time, 6),
+                             "events": event_dicts})
+            self.frame_count += 1
+
+    def write_line(self, value):
+        self.file.write(json.dumps(value) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+# Read a file written by EventRecorder. Returns its first line as a dict and a list
+# of (time, events) for each recorded frame. Raises ValueError if it is not an event
+# log
+def read_event_log(path):
+    with open(path) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    if not lines or lines[0].get("version") != EVENT_LOG_VERSION:
+        raise ValueError(f"{path} is not an event log of version {EVENT_LOG_VERSION}")
+    frames = [(line["time"], [dict_to_event(event) for event in line["events"]])
+              for line in lines[1:]]
+    return lines[0], frames
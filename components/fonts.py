@@ -0,0 +1,52 @@
+import json
+import os
+
+import pygame
+
+
+# Load the font called name at size. pygame.font.SysFont finds named fonts by listing
+# every font installed on the system, which takes a noticeable part of startup, so
+# the path a name resolves to is kept in the JSON file at cache_path and reused on the
+# next runs. None is the font bundled with pygame, which needs no search at all
+def load_font(name, size, cache_path=None):
+    if name is None:
+        return pygame.font.Font(None, size)
+
+    key = f"{name}|{pygame.version.ver}"
+    cached_paths = read_cached_paths(cache_path)
+    path = cached_paths.get(key)
+    if path is None or not os.path.isfile(path):
+        # not resolved yet, or the font was uninstalled since
+        path = pygame.font.match_font(name)
+        if path is None:
+            return pygame.font.Font(None, size)
+        cached_paths[key] = path
+        write_cached_paths(cache_path, cached_paths)
+    return pygame.font.Font(path, size)
+
+
+# Read the name -> path dict from cache_path. A missing or broken file is empty
+def read_cached_paths(cache_path):
+    if cache_path is None:
+        return {}
+    try:
+        with open(cache_path) as f:
+            cached_paths = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cached_paths if isinstance(cached_paths, dict) else {}
+
+
+# Write the name -> path dict to cache_path. The cache only saves time, so failing to
+# write it is ignored
+def write_cached_paths(cache_path, cached_paths):
+    if cache_path is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(cached_paths, f)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        pass
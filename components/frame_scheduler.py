@@ -0,0 +1,90 @@
+import pygame
+
+from components.clock import Clock
+
+
+# FrameScheduler decides when the application loop draws a frame. When nothing on
+# screen changes it sleeps in pygame.event.wait until an event arrives, it keeps
+# track of the parts of the window which changed (dirty rects) so only those are
+# drawn and presented, and it sleeps between frames to stay under max_fps
+class FrameScheduler:
+    def __init__(self, max_fps=60, idle_timeout_ms=1000, max_dirty_rects=8, clock=None):
+        self.min_frame_time = 1 / max_fps
+        self.idle_timeout_ms = idle_timeout_ms
+        self.max_dirty_rects = max_dirty_rects
+        self.clock = clock or Clock()
+        self.last_frame_time = self.clock.now()
+
+        self.regions = {}  # region name -> (state, rect) drawn in the last frame
+        self.dirty_rects = []
+        self.is_full_redraw = True
+
+        # posted from background threads to wake the loop up when they have a result
+        self.WAKE_EVENT = pygame.event.custom_type()
+
+    # Wake the loop up from another thread
+    def wake(self):
+        try:
+            pygame.event.post(pygame.event.Event(self.WAKE_EVENT))
+        except pygame.error:  # the window has already been closed
+            pass
+
+    # Mark the whole window as changed
+    def invalidate(self):
+        self.is_full_redraw = True
+
+    # Mark a part of the window as changed
+    def mark_dirty(self, rect):
+        rect = pygame.Rect(rect)
+        if rect.width > 0 and rect.height > 0:
+            self.dirty_rects.append(rect)
+
+    # Compare the state of a region with the last frame and mark it dirty if it
+    # changed. Both the old and the new rect are redrawn so nothing is left behind
+    def track(self, name, state, rect):
+        rect = pygame.Rect(rect)
+        old = self.regions.get(name)
+        if old is None or old[0] != state or old[1] != rect:
+            if old is not None:
+                self.mark_dirty(old[1])
+            self.mark_dirty(rect)
+            self.regions[name] = (state, rect)
+
+    # Check if anything needs to be drawn
+    def has_dirty(self):
+        return self.is_full_redraw or len(self.dirty_rects) > 0
+
+    # Get the events of this frame. Waits up to timeout_ms for one if nothing needs
+    # to be drawn, so an idle window does not use the CPU
+    def get_events(self, timeout_ms=None):
+        if self.has_dirty():
+            return pygame.event.get()
+
+        if timeout_ms is None:
+            timeout_ms = self.idle_timeout_ms
+        event = pygame.event.wait(max(1, int(timeout_ms)))
+        events = [] if event.type == pygame.NOEVENT else [event]
+        return events + pygame.event.get()
+
+    # Get the rects to draw this frame, or None if the whole window has to be drawn
+    def take_dirty_rects(self, screen_rect):
+        if self.is_full_redraw:
+            rects = None
+        else:
+            rects = [rect.clip(screen_rect) for rect in self.dirty_rects]
+            rects = [rect for rect in rects if rect.width > 0 and rect.height > 0]
+
+            # many small rects cost more to draw than one rect around all of them
+            if len(rects) > self.max_dirty_rects:
+                rects = [rects[0].unionall(rects[1:])]
+
+        self.dirty_rects = []
+        self.is_full_redraw = False
+        return rects
+
+    # Sleep for the rest of the frame so that no more than max_fps frames are drawn
+    def end_frame(self):
+        remaining = self.min_frame_time - (self.clock.now() - self.last_frame_time)
+        if remaining > 0:
+            self.clock.sleep(remaining)
+        self.last_frame_time = self.clock.now()
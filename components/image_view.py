@@ -0,0 +1,98 @@
+import math
+
+import pygame
+
+from processing.profiler import profiler
+
+
+# ImageView draws an image at any zoom level while only scaling the part of it which
+# is visible on screen. Smaller copies of the image (mip levels, each half the size
+# of the previous one) are made when first needed so that zoomed out views scale
+# from a copy close to the size they are drawn at
+class ImageView:
+    def __init__(self, margin=256):
+        self.surface = None
+        self.levels = {}  # level number -> surface, level 0 is the image itself
+        self.margin = margin  # pixels scaled around the visible area
+
+        # the last scaled part of the image, reused while the view does not change
+        self.cached_key = None
+        self.cached_surface = None
+        self.cached_pos = (0, 0)  # position of cached_surface inside the drawn image
+        self.cached_area = pygame.Rect(0, 0, 0, 0)  # area cached_surface covers
+
+    # Set the image to draw
+    def set_image(self, surface):
+        self.surface = surface
+        self.levels = {0: surface}
+        self.cached_key = None
+        self.cached_surface = None
+
+    # Get the smallest mip level which is still at least as big as the drawn image
+    def get_level(self, draw_width):
+        level = 0
+        if draw_width > 0:
+            level = max(0, int(math.log2(self.surface.get_width() / draw_width)))
+
+        if level not in self.levels:
+            size = (max(1, self.surface.get_width() >> level),
+                    max(1, self.surface.get_height() >> level))
+            self.levels[level] = pygame.transform.scale(self.surface, size)
+        return self.levels[level]
+
+    # Get the number of bytes used by the image and its mip levels
+    def get_memory_size(self):
+        total = 0
+        for level in self.levels.values():
+            total += level.get_width() * level.get_height() * level.get_bytesize()
+        return total
+
+    # Draw the image as if the whole image was drawn at pos with size, clipped to the
+    # visible part of the surface
+    def draw(self, surface, pos, size):
+        if self.surface is None or size[0] <= 0 or size[1] <= 0:
+            return
+
+        dest = pygame.Rect(round(pos[0]), round(pos[1]), size[0], size[1])
+        visible = dest.clip(surface.get_clip())
+        if visible.width == 0 or visible.height == 0:
+            return
+
+        # visible part relative to the top left corner of the image
+        visible_in_img = visible.move(-dest.left, -dest.top)
+        key = (id(self.surface), tuple(size))
+        if key != self.cached_key or not self.cached_area.contains(visible_in_img):
+            with profiler.span("rescale", "render"):
+                self.scale_area(visible_in_img, size)
+            self.cached_key = key
+
+        old_clip = surface.get_clip()
+        surface.set_clip(visible)
+        surface.blit(self.cached_surface, (dest.left + self.cached_pos[0],
+                                           dest.top + self.cached_pos[1]))
+        surface.set_clip(old_clip)
+
+    # Scale the part of the image around area (in drawn image coordinates). A margin
+    # around the visible area is scaled too so that small pans reuse the result
+    def scale_area(self, area, size):
+        area = area.inflate(2 * self.margin, 2 * self.margin).clip(
+            pygame.Rect(0, 0, size[0], size[1]))
+
+        level = self.get_level(size[0])
+        scale_x = level.get_width() / size[0]
+        scale_y = level.get_height() / size[1]
+
+        # part of the mip level which covers the area, rounded outwards to whole
+        # pixels so that no gap appears at the edges
+        left = math.floor(area.left * scale_x)
+        top = math.floor(area.top * scale_y)
+        right = min(level.get_width(), math.ceil(area.right * scale_x))
+        bottom = min(level.get_height(), math.ceil(area.bottom * scale_y))
+        src_rect = pygame.Rect(left, top, max(1, right - left), max(1, bottom - top))
+
+        # where that part ends up relative to the top left corner of the image
+        self.cached_pos = (round(src_rect.left / scale_x), round(src_rect.top / scale_y))
+        out_size = (max(1, round(src_rect.width / scale_x)),
+                    max(1, round(src_rect.height / scale_y)))
+        self.cached_surface = pygame.transform.scale(level.subsurface(src_rect), out_size)
+        self.cached_area = area
@@ -0,0 +1,31 @@
+import pygame
+
+
+# MouseState follows the mouse position and buttons from the events it is given
+# instead of asking pygame.mouse. The app then only acts on events, so a recorded
+# session replays the same way without a real mouse
+class MouseState:
+    def __init__(self):
+        self.pos = (0, 0)
+        self.pressed_buttons = set()
+        self.rel_origin = (0, 0)  # position get_rel was last called at
+
+    # Update the state from a pygame event, other events are ignored
+    def handle_event(self, event):
+        if event.type in (pygame.MOUSEMOTION, pygame.MOUSEBUTTONDOWN,
+                          pygame.MOUSEBUTTONUP):
+            self.pos = tuple(event.pos)
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            self.pressed_buttons.add(event.button)
+        elif event.type == pygame.MOUSEBUTTONUP:
+            self.pressed_buttons.discard(event.button)
+
+    # Check if button is held down, 1 is the left button and 3 the right one
+    def is_pressed(self, button=1):
+        return button in self.pressed_buttons
+
+    # Get how far the mouse moved since the last call, like pygame.mouse.get_rel
+    def get_rel(self):
+        rel = (self.pos[0] - self.rel_origin[0], self.pos[1] - self.rel_origin[1])
+        self.rel_origin = self.pos
+        return rel
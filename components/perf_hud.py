@@ -0,0 +1,85 @@
+import pygame
+
+from components.clock import Clock
+
+# phases of one frame of the application loop, in the order they run
+FRAME_PHASES = ("events", "update", "render", "present")
+# background work which is shown with its last duration
+WORK_NAMES = ("decode", "resize", "encode", "preview decode", "rescale", "text")
+
+
+# PerfHud is an overlay showing frame times and how long recent work took, read from
+# a Profiler. Its text is refreshed a few times per second instead of every frame so
+# that showing it does not keep the window redrawing
+class PerfHud:
+    def __init__(self, profiler, font, text_color, bg_color, refresh_secs=0.25,
+                 window_secs=1.0, clock=None):
+        self.profiler = profiler
+        self.clock = clock or Clock()
+        self.font = font
+        self.text_color = text_color
+        self.bg_color = bg_color
+        self.refresh_secs = refresh_secs
+        self.window_secs = window_secs  # stats are over this many recent seconds
+        self.isShowing = False
+        self.lines = []
+        self.last_refresh_time = float("-inf")  # refreshed on the next update
+
+    # Show or hide the overlay
+    def toggle(self):
+        self.isShowing = not self.isShowing
+        self.lines = []
+        self.last_refresh_time = float("-inf")  # refreshed on the next update
+
+    # Get seconds left until the text is refreshed, or None if it is not showing
+    def get_time_left(self):
+        if not self.isShowing:
+            return None
+        return max(0.0, self.last_refresh_time + self.refresh_secs - self.clock.now())
+
+    # Refresh the text from the profiler when it is due
+    def update(self):
+        if not self.isShowing or self.get_time_left() > 0:
+            return
+        self.last_refresh_time = self.clock.now()
+
+        stats = self.profiler.get_stats(self.window_secs)
+        frame = stats.get("frame")
+        if frame is None:
+            self.lines = ["Frame: idle"]
+        else:
+            self.lines = [f"Frame: {frame['average_ms']:.2f} ms avg, "
+                          f"{frame['max_ms']:.2f} ms max, {frame['count']} drawn "
+                          f"in {self.window_secs:g}s"]
+        self.lines.append("  ".join(f"{phase} {stats[phase]['average_ms']:.2f}"
+                                    for phase in FRAME_PHASES if phase in stats)
+                          + " ms avg")
+
+        last_durations = self.profiler.get_last_durations(WORK_NAMES)
+        self.lines.append("Last: " + "  ".join(f"{name} {last_durations[name]:.1f}"
+                                               for name in WORK_NAMES
+                                               if name in last_durations) + " ms")
+        self.lines.append("F3 hide  F4 save trace")
+
+    # Get the area the overlay covers when drawn on surface with its top at top
+    def get_rect(self, surface, top, pad=10):
+        if not self.isShowing or not self.lines:
+            return 0, 0, 0, 0
+        width = max(self.font.size(line)[0] for line in self.lines) + pad * 2
+        height = self.font.get_height() * len(self.lines) + pad * 2
+        return surface.get_width() - width - pad, top, width, height
+
+    # Draw the overlay in the top right corner of surface, starting at top
+    def draw(self, surface, top):
+        rect = self.get_rect(surface, top)
+        if rect[2] == 0:
+            return
+        pygame.draw.rect(surface, self.bg_color, rect, border_radius=10)
+
+        # text changes every refresh so it is not kept in the text cache
+        pad = 10
+        y = rect[1] + pad
+        for line in self.lines:
+            text_surface = self.font.render(line, True, self.text_color)
+            surface.blit(text_surface, (rect[0] + pad, y))
+            y += self.font.get_height()
@@ -1,5 +1,7 @@
 import pygame
 
+from components.text_cache import render_text
+
 
 # Slider class for interactive sliders
 class Slider:
@@ -34,6 +36,12 @@ class Slider:
     def set_text(self, text):
         self.text = text
 
+    # Get the area the slider covers, the knob reaches a little outside the slider
+    def get_rect(self):
+        knob_overflow = 6
+        return (self.pos[0] - knob_overflow, self.pos[1] - knob_overflow,
+                self.size[0] + 2 * knob_overflow, self.size[1] + 2 * knob_overflow)
+
     # Get the slider's value ratio between min and max
     def get_ratio(self):
         return (self.value - self.min_val) / (self.max_val - self.min_val)
@@ -64,10 +72,9 @@ class Slider:
         pygame.draw.circle(surface, self.slider_color, (center_x, center_y), radius)
 
         # draw text
-        txt_rect = self.font.size(self.text)
-        x = self.pos[0] + (self.size[0] - txt_rect[0]) / 2
-        y = self.pos[1] + (self.size[1] - txt_rect[1]) / 2
-        text_surface = self.font.render(self.text, True, self.text_color)
+        text_surface = render_text(self.font, self.text, self.text_color)
+        x = self.pos[0] + (self.size[0] - text_surface.get_width()) / 2
+        y = self.pos[1] + (self.size[1] - text_surface.get_height()) / 2
         surface.blit(text_surface, (x, y))
 
     # Set slider value within min-max range
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+
+from processing.profiler import profiler
+
+ELLIPSIS = "..."
+
+
+# TextCache keeps rendered text so that text which does not change between frames is
+# only rasterized once. Text wider than max_width is cut short and ends with "...".
+# The least recently used surfaces are removed once more than max_entries are stored
+class TextCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.surfaces = OrderedDict()  # (font, text, color, bg, max_width) -> surface
+        self.hits = 0
+        self.misses = 0
+
+    # Get the longest start of text which fits in max_width with "..." after it.
+    # Text width only grows with more characters, so the length is binary searched
+    @staticmethod
+    def truncate(font, text, max_width):
+        if max_width is None or font.size(text)[0] <= max_width:
+            return text
+
+        low, high = 0, len(text) - 1  # low always fits, high + 1 never does
+        while low < high:
+            mid = (low + high + 1) // 2
+            if font.size(text[:mid] + ELLIPSIS)[0] <= max_width:
+                low = mid
+            else:
+                high = mid - 1
+        return text[:low] + ELLIPSIS
+
+    # Get a surface with text rendered in font, truncated to max_width
+    def render(self, font, text, color, bg=None, max_width=None):
+        # pygame colors can change after being used so their values are used instead
+        key = (font, text, tuple(color), None if bg is None else tuple(bg),
+               None if max_width is None else int(max_width))
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            self.hits += 1
+            return surface
+
+        self.misses += 1
+        with profiler.span("text", "render"):
+            surface = font.render(self.truncate(font, text, key[4]), True, color, bg)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_entries:
+            self.surfaces.popitem(last=False)
+        return surface
+
+    # Remove every stored surface
+    def clear(self):
+        self.surfaces.clear()
+
+    # Get the number of stored surfaces, hits and misses
+    def get_stats(self):
+        return {"entries": len(self.surfaces), "hits": self.hits, "misses": self.misses}
+
+
+# Shared by every component so the same text is only rendered once
+text_cache = TextCache()
+
+
+# Render text with the shared cache
+def render_text(font, text, color, bg=None, max_width=None):
+    return text_cache.render(font, text, color, bg, max_width)
@@ -1,12 +1,14 @@
-import time
-
 import pygame
 
+from components.clock import Clock
+from components.text_cache import render_text
+
 
 # Toast class for displaying temporary messages on screen
 class Toast:
-    def __init__(self, msg, font, duration_secs, text_color, bg_color):
-        self.start_time_ns = None
+    def __init__(self, msg, font, duration_secs, text_color, bg_color, clock=None):
+        self.clock = clock or Clock()
+        self.start_time = None
         self.msg = msg
         self.font = font
         self.text_color = text_color
@@ -18,7 +20,7 @@ class Toast:
     def show(self, msg=None):
         if msg:
             self.set_message(msg)
-        self.start_time_ns = time.time_ns()
+        self.start_time = self.clock.now()
         self.isShowing = True
 
     # Hide toast message
@@ -29,33 +31,48 @@ class Toast:
     def set_message(self, msg):
         self.msg = msg
 
+    # Get seconds left until the toast hides itself, or None if it is not showing
+    def get_time_left(self):
+        if not self.isShowing:
+            return None
+        return max(0.0, self.dur_secs - (self.clock.now() - self.start_time))
+
+    # Hide the toast once its duration has passed
+    def update(self):
+        if self.isShowing and self.get_time_left() <= 0:
+            self.hide()
+
+    # Get the message rendered and trimmed to fit the width of surface
+    def get_text_surface(self, surface, pad):
+        return render_text(self.font, self.msg, self.text_color, self.bg_color,
+                           surface.get_width() - pad * 2)
+
+    # Get the area the toast covers when drawn on surface
+    def get_rect(self, surface, pad=10):
+        if not self.isShowing:
+            return 0, 0, 0, 0
+        # get size of text so that the size of background can be determined
+        text_size = self.get_text_surface(surface, pad).get_size()
+
+        # code to center align the text
+        t_x = surface.get_width() / 2 - text_size[0] / 2
+        t_y = surface.get_height() / 2 - text_size[1] / 2
+        return (t_x - pad, t_y - pad,
+                text_size[0] + pad * 2, text_size[1] + pad * 2)
+
     # Draw toast message on the surface
     def draw(self, surface):
-        if self.isShowing and (
-                time.time_ns() - self.start_time_ns) * 1e-9 >= self.dur_secs:
-            self.hide()
+        self.update()
 
         if self.isShowing:
             pad = 10
-            text = self.msg
-            # Trim message to fit width
-            if self.font.size(text)[0] > surface.get_width() - pad * 2:
-                while self.font.size(text + "...")[0] > surface.get_width() - pad * 2:
-                    text = text[:-1]
-                text += "..."
-
-            # get size of text so that the size of background can be determined
-            text_size = self.font.size(text)
-
-            # code to center align the text
-            t_x = surface.get_width() / 2 - text_size[0] / 2
-            t_y = surface.get_height() / 2 - text_size[1] / 2
-            toast_bg_rect = (t_x - pad, t_y - pad,
-                             text_size[0] + pad * 2, text_size[1] + pad * 2)
+            toast_bg_rect = self.get_rect(surface, pad)
+            t_x = toast_bg_rect[0] + pad
+            t_y = toast_bg_rect[1] + pad
 
             # draw background of toast
             pygame.draw.rect(surface, self.bg_color, toast_bg_rect, border_radius=10)
 
             # draw text
-            font_surface = self.font.render(text, True, self.text_color, self.bg_color)
+            font_surface = self.get_text_surface(surface, pad)
             surface.blit(font_surface, (t_x, t_y))
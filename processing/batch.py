@@ -0,0 +1,194 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from processing.encoders import (DEFAULT_ENCODER, DEFAULT_SETTINGS, format_setting,
+                                 get_encoder)
+from processing.pipeline import (compress_file, format_byte_count, get_modified_img_path,
+                                 is_valid_img_path)
+from processing.quality_metrics import METRICS, format_score
+from processing.quality_target import compress_file_to_quality
+from processing.result_cache import run_cached
+from processing.target_size import compress_file_to_size
+
+
+def list_batch_files(directory):
+    """
+    Returns every image inside directory which has not already been modified
+    """
+    paths = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if is_valid_img_path(path) and not name.startswith("modified_"):
+            paths.append(path)
+    return paths
+
+
+def compress_job(path, dst_path, quality, scale, target_size, target_score,
+                 metric_max_pixels, encoder, encoder_settings, cache=None):
+    """
+    Compresses one file the way batch and watch mode do, reusing the output of an
+    earlier run from cache, a ResultCache, if it has one. Runs inside a worker
+    process. Errors are returned instead of raised so that one bad file does not
+    stop the others
+    """
+    settings = tuple(sorted(encoder_settings.items()))
+    try:
+        if target_score is not None:
+            metric, target = target_score
+            params = ("quality target", metric, target, scale, metric_max_pixels,
+                      encoder, settings)
+            return run_cached(cache, path, dst_path, params,
+                              lambda: compress_file_to_quality(
+                                  path, dst_path, metric, target, scale,
+                                  metric_max_pixels, encoder, encoder_settings))
+        if target_size is not None:
+            params = ("target size", target_size, scale, encoder, settings)
+            return run_cached(cache, path, dst_path, params,
+                              lambda: compress_file_to_size(
+                                  path, dst_path, target_size, scale,
+                                  encoder=encoder, settings=encoder_settings))
+        params = ("compress", quality, scale, encoder, settings)
+        return run_cached(cache, path, dst_path, params,
+                          lambda: compress_file(path, dst_path, quality, scale, encoder,
+                                                encoder_settings))
+    except Exception as ex:
+        return {"path": path, "error": str(ex)}
+
+
+def describe_settings(quality, scale, target_size, encoder, target_score,
+                      encoder_settings):
+    """
+    Returns the settings of a batch as shown before it starts
+    """
+    if target_score is not None:
+        metric, target = target_score
+        settings = (f"target {METRICS[metric][1]} {format_score(metric, target)}, "
+                    f"scale {scale}")
+    elif target_size is None:
+        settings = f"quality {quality}%, scale {scale}"
+    else:
+        settings = f"target size {format_byte_count(target_size)}, max scale {scale}"
+    encoder_text = ", ".join(format_setting(name, encoder_settings[name])
+                             for name in get_encoder(encoder).setting_names)
+    return f"{get_encoder(encoder).label} ({encoder_text}), {settings}"
+
+
+def describe_result(result, target_size=None, target_score=None):
+    """
+    Returns (done, text) for a result of compress_job, where done is False if the
+    file failed or did not reach its target and text is the line shown for it
+    """
+    name = os.path.basename(result["path"])
+    if "error" in result:
+        return False, f"{name}: failed ({result['error']})"
+    if not result.get("fits", True):
+        if target_score is not None:
+            metric = target_score[0]
+            reason = (f"quality 100% only reaches {METRICS[metric][1]} "
+                      f"{format_score(metric, result['score'])}")
+        else:
+            reason = f"cannot fit in {format_byte_count(target_size)}"
+        return False, f"{name}: failed ({reason}, {result['encodes']} encodes)"
+
+    details = f"{result['seconds']:.2f}s"
+    if result.get("cache_hit"):
+        details += ", from cache"
+    if "encodes" in result:
+        res = result["resolution"]
+        details += (f", quality {result['quality']}%, {res[0]} x {res[1]}, "
+                    f"{result['encodes']} encodes")
+    if "score" in result:
+        metric = target_score[0]
+        details += (f", {METRICS[metric][1]} {format_score(metric, result['score'])}, "
+                    f"metric {result['metric_seconds']:.2f}s")
+    return True, (f"{name}: {format_byte_count(result['input_bytes'])} -> "
+                  f"{format_byte_count(result['output_bytes'])} ({details})")
+
+
+def run_batch(directory, quality, scale, jobs=None, target_size=None,
+              encoder=DEFAULT_ENCODER, target_score=None, metric_max_pixels=None,
+              encoder_settings=DEFAULT_SETTINGS, cache=None, out=print):
+    """
+    Compresses every image in directory across a pool of jobs processes, writing
+    them with the encoder of that name and encoder_settings. Results are written
+    with out as soon as each file finishes, followed by the throughput of the
+    whole batch. If target_size is given, quality is ignored and each image is
+    made as large as possible while staying under target_size bytes. If
+    target_score, a (metric, target) pair like ("ssim", 0.95), is given instead,
+    each image gets the lowest quality which still reaches the target, with scores
+    measured on at most metric_max_pixels pixels. With cache, a ResultCache, files
+    compressed with the same settings before are not compressed again.
+    Returns the number of files that failed or were skipped
+    """
+    paths = list_batch_files(directory)
+    if not paths:
+        out(f"No images found in {directory}")
+        return 0
+
+    # photo.jpg and photo.png would both be saved as modified_photo.webp, only the
+    # first of them is compressed
+    dst_paths = {}  # output path -> input path
+    skipped = 0
+    for path in list(paths):
+        dst_path = get_modified_img_path(path, get_encoder(encoder).extensions)
+        if dst_path in dst_paths:
+            skipped += 1
+            paths.remove(path)
+            out(f"{os.path.basename(path)}: skipped, "
+                f"{os.path.basename(dst_paths[dst_path])} is saved to the same file")
+        else:
+            dst_paths[dst_path] = path
+
+    jobs = jobs or os.cpu_count() or 1
+    settings = describe_settings(quality, scale, target_size, encoder, target_score,
+                                 encoder_settings)
+    out(f"Compressing {len(paths)} images with {jobs} workers ({settings})")
+
+    total_in = 0
+    total_out = 0
+    total_encodes = 0
+    total_metric_seconds = 0.0
+    failed = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(compress_job, path, dst_path, quality, scale,
+                                   target_size, target_score, metric_max_pixels,
+                                   encoder, encoder_settings, cache)
+                   for dst_path, path in dst_paths.items()]
+        for done, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            is_done, text = describe_result(result, target_size, target_score)
+            out(f"[{done}/{len(paths)}] {text}")
+            if cache is not None:
+                cache.count_result(result)
+            if not is_done:
+                failed += 1
+                continue
+
+            total_in += result["input_bytes"]
+            total_out += result["output_bytes"]
+            total_encodes += result.get("encodes", 0)
+            total_metric_seconds += result.get("metric_seconds", 0.0)
+
+    elapsed = time.perf_counter() - start
+    processed = len(paths) - failed
+    out(f"Done: {processed} images in {elapsed:.2f}s, {failed} failed"
+        + (f", {skipped} skipped" if skipped else ""))
+    if target_size is not None and processed:
+        out(f"Target size search: {total_encodes} encodes, "
+            f"{total_encodes / processed:.1f} per image")
+    if target_score is not None and processed:
+        metric_label = METRICS[target_score[0]][1]
+        out(f"Quality search: {total_encodes} encodes, "
+            f"{total_encodes / processed:.1f} per image, {metric_label} took "
+            f"{total_metric_seconds:.2f}s CPU, "
+            f"{total_metric_seconds / processed:.2f}s per image")
+    out(f"Throughput: {processed / elapsed:.2f} images/s, "
+        f"{total_in / (1024 * 1024) / elapsed:.2f} MB/s "
+        f"({format_byte_count(total_in)} -> {format_byte_count(total_out)})")
+    if cache is not None:
+        cache.trim()
+        out(cache.format_stats())
+    return failed + skipped
@@ -0,0 +1,251 @@
+import math
+import time
+
+import numpy as np
+
+from processing.pipeline import buffer_to_pil, scale_resolution
+
+DCT_SIZE = 8  # JPEG transforms blocks of 8x8 pixels
+# quantization table for brightness from the JPEG standard (Annex K), which libjpeg
+# uses at quality 50. Dividing by it weighs each frequency like an encoder does
+JPEG_LUMA_QUANTIZATION = np.array([
+    [16, 11, 10, 16, 24, 40, 51, 61],
+    [12, 12, 14, 19, 26, 58, 60, 55],
+    [14, 13, 16, 24, 40, 57, 69, 56],
+    [14, 17, 22, 29, 51, 87, 80, 62],
+    [18, 22, 37, 56, 68, 109, 103, 77],
+    [24, 35, 55, 64, 81, 104, 113, 92],
+    [49, 64, 78, 87, 103, 121, 120, 101],
+    [72, 92, 95, 98, 112, 100, 103, 99]], dtype=np.float32)
+BLOCK_OVERHEAD_BITS = 6.0  # DC difference and end of block code of every block
+COLORMAP_STOPS = np.array([  # cost from 0 to 1 -> red, green, blue, alpha
+    [0.0, 40, 60, 200, 0],
+    [0.25, 40, 160, 220, 70],
+    [0.5, 120, 220, 80, 110],
+    [0.75, 250, 200, 40, 150],
+    [1.0, 240, 40, 30, 190]], dtype=np.float32)
+
+
+def get_dct_matrix(size=DCT_SIZE):
+    """
+    Returns the orthonormal DCT-II matrix. matrix @ block @ matrix.T transforms a
+    block the way JPEG does
+    """
+    k = np.arange(size)
+    matrix = np.cos(np.pi * (2 * k[np.newaxis, :] + 1) * k[:, np.newaxis] / (2 * size))
+    matrix *= math.sqrt(2 / size)
+    matrix[0] /= math.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+class BlockCostMap:
+    """
+    Estimates how many bits JPEG spends on every 8x8 block of an image's brightness,
+    without encoding it. The blocks are transformed with the DCT like JPEG does, and
+    each coefficient costs about log2(1 + |coefficient| / quantization step) bits,
+    so busy blocks with strong high frequencies cost the most. The costs are relative:
+    they rank the blocks and predict how much a crop or a smaller resolution saves,
+    not the size of the file. The bits are also summed per frequency, which tells how
+    much detail a smaller resolution drops, and the image is measured resized to each
+    of scales, which tells how much it saves.
+
+    The brightness is transformed strip_rows block rows at a time, so the memory used
+    stays small even on a 24 MP image
+    """
+
+    def __init__(self, rgb_buffer, size, scales=(0.9, 0.8, 0.7, 0.6, 0.5),
+                 strip_rows=64):
+        self.rgb_buffer = rgb_buffer
+        self.size = tuple(size)
+        self.scales = scales
+        self.strip_rows = strip_rows
+        self.costs = None  # bits of every 8x8 block, one row of blocks per array row
+        self.frequency_bits = None  # bits of all blocks for each of the 8x8 frequencies
+        self.scaled_shares = {}  # scale -> share of the bits left at that scale
+        self.seconds = None
+        self.is_ready = False
+        self.is_cancelled = False
+        self.error = None  # message of the exception which stopped build
+
+    def cancel(self):
+        self.is_cancelled = True
+
+    def is_finished(self):
+        """
+        Returns True once build is over: ready, cancelled or stopped by an error
+        """
+        return self.is_ready or self.is_cancelled or self.error is not None
+
+    def build(self):
+        """
+        Measures the cost of every block, and of the image at every scale. Meant to
+        run on a background thread, is_ready is set once it is done. If it fails,
+        error is set instead
+        """
+        try:
+            self.measure_all()
+        except Exception as ex:
+            self.error = str(ex)
+
+    def measure_all(self):
+        from PIL import Image
+
+        start = time.perf_counter()
+        # the same brightness JPEG encodes, from the same BT.601 weights
+        luma_img = buffer_to_pil(self.rgb_buffer, self.size).convert("L")
+        self.frequency_bits = np.zeros((DCT_SIZE, DCT_SIZE))
+        self.costs = self.measure(np.asarray(luma_img), self.frequency_bits)
+        if self.costs is None:
+            return
+        total = float(self.costs.sum())
+        for scale in self.scales:
+            resized = luma_img.resize(scale_resolution(self.size, scale),
+                                      Image.Resampling.LANCZOS)
+            costs = self.measure(np.asarray(resized))
+            if costs is None:
+                return
+            self.scaled_shares[scale] = float(costs.sum()) / total
+        self.seconds = time.perf_counter() - start
+        self.is_ready = not self.is_cancelled
+
+    def measure(self, luma, frequency_bits=None):
+        """
+        Returns the bits of every 8x8 block of the 2D array luma, or None if cancelled.
+        The bits of every frequency are added to the 8x8 array frequency_bits if given
+        """
+        height, width = luma.shape
+        block_rows = math.ceil(height / DCT_SIZE)
+        block_cols = math.ceil(width / DCT_SIZE)
+        dct = get_dct_matrix()
+        quantization = JPEG_LUMA_QUANTIZATION[np.newaxis, :, np.newaxis, :]
+        costs = np.empty((block_rows, block_cols), dtype=np.float32)
+
+        for first_row in range(0, block_rows, self.strip_rows):
+            if self.is_cancelled:
+                return None
+            rows = min(self.strip_rows, block_rows - first_row)
+            top = first_row * DCT_SIZE
+            strip = luma[top:top + rows * DCT_SIZE].astype(np.float32)
+            # JPEG repeats the last row and column to fill partial blocks
+            strip = np.pad(strip, ((0, rows * DCT_SIZE - strip.shape[0]),
+                                   (0, block_cols * DCT_SIZE - width)), mode="edge")
+
+            # both passes of the DCT run on the whole strip at once: down the columns
+            # of each block row, then along the rows of every block
+            blocks = dct @ strip.reshape(rows, DCT_SIZE, block_cols * DCT_SIZE)
+            blocks = blocks.reshape(rows, DCT_SIZE, block_cols, DCT_SIZE) @ dct.T
+            bits = np.log2(1 + np.abs(blocks) / quantization)
+            bits[:, 0, :, 0] = 0  # the DC coefficient is paid for in the overhead
+            costs[first_row:first_row + rows] = bits.sum(axis=(1, 3))
+            if frequency_bits is not None:
+                frequency_bits += bits.sum(axis=(0, 2))
+        return costs + BLOCK_OVERHEAD_BITS
+
+    def get_grid(self, block_size):
+        """
+        Returns the costs summed into blocks of block_size (width, height) pixels, the
+        MCU size of the JPEG settings like (16, 16) with 4:2:0
+        """
+        factor_x, factor_y = (side // DCT_SIZE for side in block_size)
+        if factor_x == factor_y == 1:
+            return self.costs
+        rows = math.ceil(self.costs.shape[0] / factor_y) * factor_y
+        cols = math.ceil(self.costs.shape[1] / factor_x) * factor_x
+        padded = np.zeros((rows, cols), dtype=np.float32)
+        padded[:self.costs.shape[0], :self.costs.shape[1]] = self.costs
+        return padded.reshape(rows // factor_y, factor_y, cols // factor_x,
+                              factor_x).sum(axis=(1, 3))
+
+    def get_top_share(self, fraction=0.1):
+        """
+        Returns the share of all bits which the most expensive fraction of the blocks
+        costs
+        """
+        ordered = np.sort(self.costs, axis=None)[::-1]
+        top_count = max(1, int(len(ordered) * fraction))
+        return float(ordered[:top_count].sum() / ordered.sum())
+
+    def suggest_crop(self, max_trim=0.25, min_ratio=1.5):
+        """
+        Trims the edge row or column of blocks which costs the most, one at a time,
+        for as long as it costs at least min_ratio times the average block and at most
+        max_trim of the rows and of the columns have been trimmed. Returns {"box":
+        (left, top, right, bottom) in pixels, "saved": share of the bits removed,
+        "kept": share of the pixels kept}, or None if no edge is busy enough
+        """
+        costs = self.costs
+        rows, cols = costs.shape
+        top, bottom, left, right = 0, rows, 0, cols
+        threshold = float(costs.mean()) * min_ratio
+        max_rows = int(rows * max_trim)
+        max_cols = int(cols * max_trim)
+        while True:
+            edges = []
+            if top + (rows - bottom) < max_rows:
+                edges.append((costs[top, left:right].mean(), "top"))
+                edges.append((costs[bottom - 1, left:right].mean(), "bottom"))
+            if left + (cols - right) < max_cols:
+                edges.append((costs[top:bottom, left].mean(), "left"))
+                edges.append((costs[top:bottom, right - 1].mean(), "right"))
+            if not edges:
+                break
+            edge_cost, edge = max(edges)
+            if edge_cost < threshold:
+                break
+            if edge == "top":
+                top += 1
+            elif edge == "bottom":
+                bottom -= 1
+            elif edge == "left":
+                left += 1
+            else:
+                right -= 1
+
+        if (top, bottom, left, right) == (0, rows, 0, cols):
+            return None
+        width, height = self.size
+        box = (left * DCT_SIZE, top * DCT_SIZE,
+               min(width, right * DCT_SIZE), min(height, bottom * DCT_SIZE))
+        return {"box": box,
+                "saved": 1 - float(costs[top:bottom, left:right].sum() / costs.sum()),
+                "kept": (box[2] - box[0]) * (box[3] - box[1]) / (width * height)}
+
+    def get_lost_share(self, scale):
+        """
+        Returns the share of the bits spent on frequencies which the image resized by
+        scale cannot hold. Each direction of a block has frequencies 0 to 7, and
+        resizing keeps the ones below 8 * scale
+        """
+        frequencies = np.maximum(*np.indices((DCT_SIZE, DCT_SIZE)))
+        lost_parts = np.clip(frequencies + 1 - DCT_SIZE * scale, 0, 1)
+        return float((self.frequency_bits * lost_parts).sum() / self.costs.sum())
+
+    def suggest_scale(self, max_lost=0.1):
+        """
+        Finds the smallest of scales which drops detail costing at most max_lost of
+        the bits, so that the image holds little more than a smaller one would. The
+        total bits do not tell this since they shrink with the pixel count anyway.
+        Returns {"scale", "saved": share of the bits saved, "lost": share of the bits
+        spent on the detail dropped}, or None if every scale drops more
+        """
+        for scale in sorted(self.scaled_shares):
+            lost = self.get_lost_share(scale)
+            if lost <= max_lost:
+                return {"scale": scale, "saved": 1 - self.scaled_shares[scale],
+                        "lost": lost}
+        return None
+
+    def make_heatmap(self, block_size):
+        """
+        Returns the costs of blocks of block_size (width, height) as RGBA bytes with
+        one pixel per block, and the size of that image. Costs are colored from
+        transparent blue for the cheapest blocks to red for the ones at the 99th
+        percentile and above
+        """
+        grid = self.get_grid(block_size)
+        limit = float(np.percentile(grid, 99)) or 1.0
+        values = np.clip(grid / limit, 0, 1)
+        channels = [np.interp(values, COLORMAP_STOPS[:, 0], COLORMAP_STOPS[:, i])
+                    for i in range(1, 5)]
+        rgba = np.stack(channels, axis=-1).astype(np.uint8)
+        return rgba.tobytes(), (grid.shape[1], grid.shape[0])
@@ -0,0 +1,156 @@
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from processing.encoders import ENCODERS
+from processing.pipeline import buffer_to_pil, pil_to_rgb_buffer, resize_and_encode
+from processing.size_estimator import make_mosaic
+
+
+class EncoderComparison:
+    """
+    Encodes an image with every encoder at the same quality and resolution, all of
+    them at the same time on their own threads, and records how big each output is
+    and how long it took. Only the newest comparison matters: encodes of an older
+    one which have not started yet are skipped and results of older ones are thrown
+    away. on_done is called from a worker thread after every finished encode.
+
+    Resolutions over max_pixels are compared on a mosaic of tiles of tile_size spread
+    over the image, like SizeEstimator measures them, and the sizes and times are
+    scaled up to the whole image. Their results are marked as estimates
+    """
+
+    def __init__(self, encoder_names=None, on_done=None, max_pixels=1_000_000,
+                 tile_size=64):
+        self.encoder_names = list(encoder_names or ENCODERS)
+        self.on_done = on_done
+        self.max_pixels = max_pixels
+        self.tile_size = tile_size
+        self.lock = threading.Lock()
+        self.key = None  # identifies the settings of the newest comparison
+        self.generation = 0
+        # variant name -> {"size", "seconds", "is_estimate"} or {"error"}
+        self.results = {}
+        self.task_count = 0  # resizes and encodes submitted which have not finished
+
+        # one thread resizes, then one thread per encoder. Extra variants wait for a
+        # free thread
+        self.executor = ThreadPoolExecutor(max_workers=len(self.encoder_names) + 1,
+                                           thread_name_prefix="encoder-comparison")
+
+    def start(self, key, rgb_buffer, size, quality, resolution, variants=None,
+              resample=Image.Resampling.LANCZOS):
+        """
+        Compares the encoders on the image in rgb_buffer at quality and resolution,
+        unless the comparison for key is already running or done. variants is a dict
+        of name -> (encoder name, settings) to encode, by default every encoder with
+        the default settings. Variants are started in the order of the dict
+        """
+        if variants is None:
+            variants = {name: (name, None) for name in self.encoder_names}
+        with self.lock:
+            if key == self.key:
+                return
+            self.key = key
+            self.generation += 1
+            self.results = {}
+            generation = self.generation
+        self.submit(self.run, generation, rgb_buffer, size, quality,
+                    tuple(resolution), variants, resample)
+
+    def cancel(self):
+        with self.lock:
+            self.key = None
+            self.generation += 1
+            self.results = {}
+
+    def get_results(self):
+        """
+        Returns the results of the newest comparison finished so far, keyed by
+        variant name
+        """
+        with self.lock:
+            return dict(self.results)
+
+    def is_idle(self):
+        with self.lock:
+            return self.task_count == 0
+
+    def submit(self, func, *args):
+        """
+        Runs func on the executor, counted in task_count until it returns
+        """
+        with self.lock:
+            self.task_count += 1
+        self.executor.submit(self.run_task, func, *args)
+
+    def run_task(self, func, *args):
+        try:
+            func(*args)
+        finally:
+            with self.lock:
+                self.task_count -= 1
+
+    def stop(self):
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def is_current(self, generation):
+        with self.lock:
+            return generation == self.generation
+
+    def run(self, generation, rgb_buffer, size, quality, resolution, variants,
+            resample):
+        if not self.is_current(generation):
+            return
+        # resize once here so the encoders do not all resize the same image
+        pixel_count = resolution[0] * resolution[1]
+        sample_size = resolution
+        if pixel_count > self.max_pixels:
+            # only tiles of the image are resized
+            tiles_per_side = max(1, math.isqrt(self.max_pixels) // self.tile_size)
+            mosaic = make_mosaic(buffer_to_pil(rgb_buffer, size), resolution[0] / size[0],
+                                 self.tile_size, tiles_per_side, resample)
+            rgb_buffer = pil_to_rgb_buffer(mosaic)
+            sample_size = mosaic.size
+        elif resolution != tuple(size):
+            resized_img = buffer_to_pil(rgb_buffer, size).resize(resolution, resample)
+            rgb_buffer = pil_to_rgb_buffer(resized_img)
+        for name, (encoder, settings) in variants.items():
+            self.submit(self.encode, generation, name, encoder, settings, rgb_buffer,
+                        sample_size, quality, pixel_count)
+
+    def encode(self, generation, name, encoder, settings, rgb_buffer, sample_size,
+               quality, pixel_count):
+        if not self.is_current(generation):
+            return
+
+        start = time.perf_counter()
+        try:
+            # every encode gets its own image object because PIL keeps the save
+            # options on it
+            data = resize_and_encode(buffer_to_pil(rgb_buffer, sample_size), None,
+                                     quality, encoder=encoder, settings=settings)
+            result = {"size": len(data), "seconds": time.perf_counter() - start,
+                      "is_estimate": False}
+            ratio = pixel_count / (sample_size[0] * sample_size[1])
+            if ratio > 1:
+                # the headers are the same size whatever the resolution, so only the
+                # rest grows with the pixel count
+                header_size = len(resize_and_encode(Image.new("RGB", (8, 8)), None,
+                                                    quality, encoder=encoder,
+                                                    settings=settings))
+                result = {"size": round(header_size + (len(data) - header_size) * ratio),
+                          "seconds": result["seconds"] * ratio, "is_estimate": True}
+        except Exception as ex:
+            result = {"error": str(ex)}
+
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.results[name] = result
+        if self.on_done is not None:
+            self.on_done()
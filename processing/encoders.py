@@ -0,0 +1,239 @@
+import io
+import threading
+from contextlib import contextmanager
+
+from processing.profiler import profiler
+
+# Settings which change the size of the output without touching quality or
+# resolution. Encoders only use the ones listed in their setting_names
+DEFAULT_SETTINGS = {"optimize": True,  # optimized Huffman tables (JPEG), smaller PNG
+                    "progressive": False,  # progressive scans (JPEG)
+                    "subsampling": "4:2:0",  # resolution of the color channels (JPEG)
+                    "metadata": "strip"}  # one of METADATA_CHOICES
+SUBSAMPLINGS = ("4:4:4", "4:2:2", "4:2:0")
+# "no thumbnail" keeps the EXIF data without the small preview image stored in it
+METADATA_CHOICES = ("strip", "keep", "no thumbnail")
+# size of a JPEG MCU for each subsampling, the pixels JPEG compresses together
+JPEG_MCU_SIZES = {"4:4:4": (8, 8), "4:2:2": (16, 8), "4:2:0": (16, 16)}
+
+# output buffers bigger than PIL's own which encodes running now need, see
+# raise_output_buffer
+output_buffer_lock = threading.Lock()
+output_buffer_sizes = []
+
+
+class Encoder:
+    """
+    One way of encoding an image, like baseline JPEG or lossless WebP. Files it writes
+    get the first of extensions. options is a function which gets the quality from
+    1 to 100 and the settings, and returns the options passed to PIL's save.
+    Encoders without has_quality give the same output at every quality. Images in a
+    mode outside modes are converted to RGB first. tile_size is a function which gets
+    the settings and returns the size of the blocks the encoder compresses
+    separately, or None if the pixels of a block also depend on the blocks around it.
+    buffer_size is a function which gets the image and the options and returns the
+    bytes the encoder has to be able to write at once, or None if PIL's buffer does
+    """
+
+    def __init__(self, name, label, pil_format, extensions, options, setting_names,
+                 has_quality=True, modes=("RGB", "RGBX"), tile_size=None,
+                 buffer_size=None):
+        self.name = name  # used on the command line and in cache keys
+        self.label = label  # shown in the window
+        self.pil_format = pil_format
+        self.extensions = extensions
+        self.options = options
+        self.setting_names = setting_names  # settings which change the output
+        self.has_quality = has_quality
+        self.modes = modes
+        self.tile_size = tile_size
+        self.buffer_size = buffer_size
+
+    def get_settings_key(self, settings):
+        """
+        Returns the part of settings this encoder uses, in a form usable as a dict key
+        """
+        settings = settings or NO_METADATA_SETTINGS
+        return tuple((name, settings[name]) for name in self.setting_names)
+
+    def get_tile_size(self, settings):
+        """
+        Returns (width, height) of the blocks this encoder compresses separately, so
+        that a crop aligned to them decodes to the same pixels as the whole image, or
+        None if crops never do
+        """
+        if self.tile_size is None:
+            return None
+        return self.tile_size(settings or NO_METADATA_SETTINGS)
+
+    def encode(self, pil_img, quality, settings=None):
+        """
+        Returns pil_img encoded at quality as bytes. settings come from
+        resolve_settings, by default DEFAULT_SETTINGS are used
+        """
+        settings = settings or NO_METADATA_SETTINGS
+        if pil_img.mode not in self.modes:
+            pil_img = pil_img.convert("RGB")
+        options = self.options(quality, settings)
+        options.update(settings["metadata"])
+
+        buffer_size = None
+        if self.buffer_size is not None:
+            buffer_size = self.buffer_size(pil_img, options)
+        buffer = io.BytesIO()
+        with profiler.span("encode", "pipeline"), raise_output_buffer(buffer_size):
+            pil_img.save(buffer, format=self.pil_format, **options)
+        return buffer.getvalue()
+
+
+@contextmanager
+def raise_output_buffer(size):
+    """
+    Makes PIL give encoders an output buffer of at least size bytes while inside.
+    PIL reads the size from ImageFile.MAXBLOCK, which all threads share, so it is
+    kept at the biggest size any encode running now needs and goes back to PIL's
+    default once none needs more
+    """
+    if size is None:
+        yield
+        return
+    from PIL import ImageFile
+
+    with output_buffer_lock:
+        if not output_buffer_sizes:
+            output_buffer_sizes.append(ImageFile.MAXBLOCK)  # PIL's default
+        output_buffer_sizes.append(size)
+        ImageFile.MAXBLOCK = max(output_buffer_sizes)
+    try:
+        yield
+    finally:
+        with output_buffer_lock:
+            output_buffer_sizes.remove(size)
+            ImageFile.MAXBLOCK = max(output_buffer_sizes)
+            if len(output_buffer_sizes) == 1:
+                output_buffer_sizes.clear()
+
+
+def read_metadata(pil_img):
+    """
+    Returns the EXIF and ICC profile of the opened image pil_img, the ones it has
+    """
+    return {name: pil_img.info[name] for name in ("exif", "icc_profile")
+            if pil_img.info.get(name)}
+
+
+def resolve_settings(settings, metadata):
+    """
+    Returns a copy of settings where the metadata choice is replaced by the part of
+    metadata, from read_metadata, which is kept. The result is what the encoders
+    take, and it can be used in dict keys
+    """
+    kept = {}
+    if settings["metadata"] != "strip":
+        kept = dict(metadata)
+    if settings["metadata"] == "no thumbnail" and "exif" in kept:
+        from PIL import Image
+
+        # the thumbnail is in a second EXIF directory which PIL does not write back
+        exif = Image.Exif()
+        exif.load(kept["exif"])
+        kept["exif"] = exif.tobytes()
+    return dict(settings, metadata=tuple(sorted(kept.items())))
+
+
+NO_METADATA_SETTINGS = resolve_settings(DEFAULT_SETTINGS, {})
+
+
+def format_setting(name, value):
+    """
+    Returns the value of the setting called name as it is shown to the user
+    """
+    if isinstance(value, bool):
+        return f"{name} {'on' if value else 'off'}"
+    if name == "metadata":
+        return f"metadata {value}"
+    return value
+
+
+def get_other_choice(name, value):
+    """
+    Returns the choice for the setting called name which is compared with value to
+    show how many bytes value saves: the opposite for on and off settings, full
+    color resolution against subsampled color, and kept metadata against stripped
+    """
+    if name == "subsampling":
+        return "4:2:0" if value == "4:4:4" else "4:4:4"
+    if name == "metadata":
+        return "keep" if value == "strip" else "strip"
+    return not value
+
+
+# every encoder by name, in the order they are shown and cycled through
+ENCODERS = {}
+DEFAULT_ENCODER = "jpeg"
+
+# files which can be opened
+INPUT_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def register_encoder(encoder):
+    ENCODERS[encoder.name] = encoder
+
+
+def get_encoder(name):
+    """
+    Returns the encoder called name. Raises ValueError if there is none
+    """
+    try:
+        return ENCODERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown format: {name}") from None
+
+
+def get_jpeg_mcu_size(settings):
+    return JPEG_MCU_SIZES[settings["subsampling"]]
+
+
+def get_jpeg_buffer_size(pil_img, options):
+    # with optimized Huffman tables or progressive scans libjpeg writes the whole file
+    # at once. PIL makes room for one byte per pixel, or two at quality 95 and up,
+    # which noisy images at 4:4:4 pass. Even those stay under twice the raw pixels
+    if not (options.get("optimize") or options.get("progressive")):
+        return None
+    metadata_size = sum(len(options.get(name) or b"") for name in ("exif", "icc_profile"))
+    return 2 * pil_img.width * pil_img.height * len(pil_img.getbands()) + metadata_size
+
+
+register_encoder(Encoder("jpeg", "JPEG", "JPEG", (".jpg", ".jpeg"),
+                         lambda quality, settings: {
+                             "quality": quality,
+                             "optimize": settings["optimize"],
+                             "progressive": settings["progressive"],
+                             "subsampling": settings["subsampling"]},
+                         ("optimize", "progressive", "subsampling", "metadata"),
+                         tile_size=get_jpeg_mcu_size, buffer_size=get_jpeg_buffer_size))
+register_encoder(Encoder("jpeg-progressive", "JPEG progressive", "JPEG",
+                         (".jpg", ".jpeg"),
+                         lambda quality, settings: {
+                             "quality": quality,
+                             "optimize": settings["optimize"],
+                             "progressive": True,
+                             "subsampling": settings["subsampling"]},
+                         ("optimize", "subsampling", "metadata"),
+                         tile_size=get_jpeg_mcu_size, buffer_size=get_jpeg_buffer_size))
+# lossy WebP has no tile size, its blocks are predicted from the ones around them
+# and smoothed across their edges
+register_encoder(Encoder("webp", "WebP", "WEBP", (".webp",),
+                         lambda quality, settings: {"quality": quality, "method": 4},
+                         ("metadata",)))
+# for lossless WebP the quality is how hard it tries, so it is fixed to a middle value
+register_encoder(Encoder("webp-lossless", "WebP lossless", "WEBP", (".webp",),
+                         lambda quality, settings: {"lossless": True, "quality": 50,
+                                                    "method": 2},
+                         ("metadata",), has_quality=False,
+                         tile_size=lambda settings: (1, 1)))
+# PNG has no RGBX mode
+register_encoder(Encoder("png", "PNG", "PNG", (".png",),
+                         lambda quality, settings: {"optimize": settings["optimize"]},
+                         ("optimize", "metadata"), has_quality=False, modes=("RGB",),
+                         tile_size=lambda settings: (1, 1)))
@@ -0,0 +1,187 @@
+import math
+import mmap
+import tempfile
+import threading
+import weakref
+
+from processing.pipeline import pil_to_rgb_buffer, scale_resolution
+from processing.profiler import profiler
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+BYTES_PER_PIXEL = 4  # pixels are stored as RGBX, see pil_to_rgb_buffer
+STRIP_BYTES = 16 * 1024 * 1024  # rows copied at once into a memory mapped buffer
+
+
+def get_resident_memory():
+    """
+    Returns a dict with the bytes of this process which are in RAM ("resident") and
+    how many of them are pages of files like memory mapped images ("file"), which the
+    OS can drop when it needs memory. Returns None if the platform does not tell
+    """
+    fields = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "RssFile"):
+                    fields[name] = int(value.split()[0]) * 1024  # values are in kB
+    except (OSError, ValueError, IndexError):
+        return None
+    if "VmRSS" not in fields:
+        return None
+    return {"resident": fields["VmRSS"], "file": fields.get("RssFile", 0)}
+
+
+class StoredImage:
+    """
+    The decoded pixels of one image as a single RGBX buffer which PIL images and
+    pygame surfaces use without copying. A mapped image keeps its full resolution
+    pixels in a memory mapped file on disk which the OS pages in only when they are
+    read, and a smaller proxy of the image in memory for drawing and previews
+    """
+
+    def __init__(self, path, size, buffer, proxy_buffer=None, proxy_size=None,
+                 is_mapped=False):
+        self.path = path
+        self.size = tuple(size)
+        self.buffer = buffer
+        self.is_mapped = is_mapped
+        # images which are not mapped are their own proxy
+        self.proxy_buffer = buffer if proxy_buffer is None else proxy_buffer
+        self.proxy_size = self.size if proxy_size is None else tuple(proxy_size)
+
+    def get_full_bytes(self):
+        return self.size[0] * self.size[1] * BYTES_PER_PIXEL
+
+    def get_memory_size(self):
+        """
+        Returns the number of bytes this image keeps in memory. The pages of a mapped
+        buffer are not counted because the OS can drop them at any time
+        """
+        if not self.is_mapped:
+            return self.get_full_bytes()
+        return self.proxy_size[0] * self.proxy_size[1] * BYTES_PER_PIXEL
+
+    def get_preview_source(self, resolution):
+        """
+        Returns (rgb_buffer, size, resolution) to make a preview of the image at
+        resolution from. Mapped images use the proxy so that previews never read the
+        file on disk, and previews bigger than the proxy are made at the proxy size
+        """
+        resolution = tuple(resolution)
+        if not self.is_mapped:
+            return self.buffer, self.size, resolution
+        if resolution[0] > self.proxy_size[0] or resolution[1] > self.proxy_size[1]:
+            resolution = self.proxy_size
+        return self.proxy_buffer, self.proxy_size, resolution
+
+
+class ImageStore:
+    """
+    Decodes images into StoredImage objects while keeping the memory used by all
+    images that are still in use below max_bytes. An image whose pixels do not fit
+    is written to a memory mapped file in spill_dir instead (the system temporary
+    folder by default), with an in-memory proxy of at most proxy_fraction of
+    max_bytes. Images are forgotten as soon as nothing uses them anymore
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, spill_dir=None, proxy_fraction=0.25):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.proxy_fraction = proxy_fraction
+        self.images = weakref.WeakSet()
+        self.reserved_bytes = 0  # bytes of images being decoded, not added yet
+        self.lock = threading.Lock()
+
+    def get_memory_size(self):
+        """
+        Returns the number of bytes all images still in use keep in memory
+        """
+        with self.lock:
+            return sum(image.get_memory_size() for image in self.images)
+
+    def get_mapped_size(self):
+        """
+        Returns the number of bytes of full resolution pixels kept on disk
+        """
+        with self.lock:
+            return sum(image.get_full_bytes() for image in self.images
+                       if image.is_mapped)
+
+    def load(self, path):
+        """
+        Decodes the image at path once and returns it as a StoredImage. Can be called
+        from any thread
+        """
+        from PIL import Image  # imported here so the window can open without Pillow
+
+        with profiler.span("decode", "pipeline"), Image.open(path) as pil_img:
+            full_bytes = pil_img.size[0] * pil_img.size[1] * BYTES_PER_PIXEL
+            reserved_bytes = full_bytes if self.reserve(full_bytes) else 0
+            try:
+                if reserved_bytes:
+                    image = StoredImage(path, pil_img.size, pil_to_rgb_buffer(pil_img))
+                else:
+                    image = self.load_mapped(path, pil_img)
+            except BaseException:
+                self.release(reserved_bytes)
+                raise
+        return self.add(image, reserved_bytes)
+
+    def reserve(self, byte_count):
+        """
+        Sets aside byte_count bytes of max_bytes for an image about to be decoded, so
+        that images decoded at the same time on other threads cannot take them too.
+        Returns False, reserving nothing, if they do not fit
+        """
+        with self.lock:
+            used = sum(image.get_memory_size() for image in self.images)
+            if used + self.reserved_bytes + byte_count > self.max_bytes:
+                return False
+            self.reserved_bytes += byte_count
+            return True
+
+    def release(self, byte_count):
+        """
+        Gives back bytes set aside by reserve for an image which was not decoded
+        """
+        with self.lock:
+            self.reserved_bytes -= byte_count
+
+    def add(self, image, reserved_bytes=0):
+        """
+        Counts image, decoded somewhere else, in the memory used by the store. The
+        reserved_bytes set aside for it by reserve are given back at the same time
+        """
+        with self.lock:
+            self.images.add(image)
+            self.reserved_bytes -= reserved_bytes
+        return image
+
+    def load_mapped(self, path, pil_img):
+        from PIL import Image
+
+        # the file is deleted by the OS once the map and the file are both closed
+        full_bytes = pil_img.size[0] * pil_img.size[1] * BYTES_PER_PIXEL
+        with tempfile.TemporaryFile(dir=self.spill_dir) as f:
+            f.truncate(full_bytes)
+            buffer = mmap.mmap(f.fileno(), full_bytes)
+
+        # copy a few rows at a time so only the decoded image itself is in memory.
+        # pil_to_rgb_buffer converts each strip, as converting the whole image to
+        # RGB first would keep a second full copy of it in memory
+        width, height = pil_img.size
+        row_bytes = width * BYTES_PER_PIXEL
+        rows_per_strip = max(1, STRIP_BYTES // row_bytes)
+        for top in range(0, height, rows_per_strip):
+            bottom = min(height, top + rows_per_strip)
+            strip = pil_img.crop((0, top, width, bottom))
+            buffer[top * row_bytes:bottom * row_bytes] = pil_to_rgb_buffer(strip)
+
+        # biggest proxy which fits in its share of the memory ceiling
+        proxy_scale = min(1.0, math.sqrt(self.max_bytes * self.proxy_fraction
+                                         / full_bytes))
+        proxy_size = scale_resolution(pil_img.size, proxy_scale)
+        proxy = pil_img.resize(proxy_size, Image.Resampling.BILINEAR, reducing_gap=3.0)
+        return StoredImage(path, pil_img.size, buffer, pil_to_rgb_buffer(proxy),
+                           proxy_size, is_mapped=True)
@@ -0,0 +1,235 @@
+import math
+import os
+import re
+import threading
+import time
+
+from processing.encoders import (DEFAULT_ENCODER, DEFAULT_SETTINGS, INPUT_EXTENSIONS,
+                                 get_encoder, read_metadata, resolve_settings)
+from processing.profiler import profiler
+
+
+def is_valid_img_path(im_path):
+    """
+    Validate img path and file type
+    """
+    return (os.path.exists(im_path)
+            and os.path.isfile(im_path)
+            and os.path.splitext(im_path)[1].lower() in INPUT_EXTENSIONS)
+
+
+def format_byte_count(total_bytes):
+    """
+    Format byte size to human-readable format
+    """
+    if total_bytes == 0:
+        return "0B"
+    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+
+    # store the power of 1024 which is nearest to total bytes,
+    # this power will be the index of size_name
+    power_of_1024 = int(math.floor(math.log(total_bytes, 1024)))
+    converted_bytes = round(total_bytes / (1024 ** power_of_1024), 2)
+
+    return f"{converted_bytes} {size_name[power_of_1024]}"
+
+
+def parse_byte_count(text):
+    """
+    Converts a size like "100KB", "1.5 MB" or "20000" into a number of bytes.
+    Uses powers of 1024 just like format_byte_count. Returns None if text is invalid
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmg]?)b?\s*", text.lower())
+    if match is None:
+        return None
+    power_of_1024 = " kmg".index(match.group(2) or " ")
+    return int(float(match.group(1)) * 1024 ** power_of_1024)
+
+
+def get_modified_img_path(path, extensions=None):
+    """
+    Returns the path a modified image is saved to. It is the same folder as the
+    original image with modified_ added in front of the filename. If the extension
+    of the original is not one of extensions, it is replaced by the first of them
+    """
+    directory = os.path.dirname(path)
+    new_filename = f'modified_{os.path.basename(path)}'
+    name, extension = os.path.splitext(new_filename)
+    if extensions is not None and extension.lower() not in extensions:
+        new_filename = name + extensions[0]
+    return os.path.join(directory, new_filename)
+
+
+def scale_resolution(resolution, scale):
+    """
+    Multiplies both sides of resolution by scale. Sides never go below 1 pixel
+    """
+    return (max(1, int(resolution[0] * scale)),
+            max(1, int(resolution[1] * scale)))
+
+
+def write_file_atomic(path, data):
+    """
+    Writes data to a temporary file in the folder of path and renames it to path once
+    it is complete, so a crash while writing never leaves a half written file behind
+    """
+    temp_path = os.path.join(os.path.dirname(path),
+                             f".{os.path.basename(path)}.{os.getpid()}."
+                             f"{threading.get_ident()}.tmp")
+    try:
+        with open(temp_path, "xb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def pil_to_rgb_buffer(pil_img):
+    """
+    Returns the pixels of pil_img as raw bytes with 4 bytes per pixel (R, G, B and an
+    unused byte). This is the layout both PIL and pygame can use without copying
+    """
+    if pil_img.mode == "RGBX":
+        return pil_img.tobytes()
+    if pil_img.mode != "RGB":
+        pil_img = pil_img.convert("RGB")
+    return pil_img.tobytes("raw", "RGBX")
+
+
+def open_draft(path, min_resolution):
+    """
+    Opens the JPEG at path and asks libjpeg to decode it at the smallest DCT scale
+    (1/1, 1/2, 1/4 or 1/8) which is still at least min_resolution. Decoding at a
+    smaller scale skips most of the decoding work, so resizing afterwards is much
+    faster than decoding everything and then resizing. Other formats are always
+    decoded at full size
+    """
+    from PIL import Image
+
+    pil_img = Image.open(path)
+    if min_resolution is not None:
+        pil_img.draft("RGB", tuple(min_resolution))
+    return pil_img
+
+
+def decode_to_rgb_buffer(path, min_resolution=None):
+    """
+    Decodes the image at path once and returns its raw RGB bytes and its size. With
+    min_resolution the image may be decoded smaller, but never below min_resolution
+    """
+    with profiler.span("decode", "pipeline"), open_draft(path, min_resolution) as pil_img:
+        return pil_to_rgb_buffer(pil_img), pil_img.size
+
+
+def buffer_to_pil(rgb_buffer, size):
+    """
+    Returns a read only PIL image which uses rgb_buffer as its pixels without copying
+    it. Each thread should use its own image from this function because PIL stores
+    the save options on the image object while it is being saved
+    """
+    from PIL import Image
+
+    return Image.frombuffer("RGBX", size, rgb_buffer, "raw", "RGBX", 0, 1)
+
+
+def resize_and_encode(pil_img, new_resolution, quality, resample=None,
+                      encoder=DEFAULT_ENCODER, settings=None):
+    """
+    Resizes pil_img to new_resolution with resample (LANCZOS by default) and encodes
+    it with the encoder of that name (see processing.encoders) at the given quality
+    and settings from resolve_settings. Returns the encoded bytes. This is the
+    pipeline used by the previews, the save button and the headless batch mode so
+    that all of them give the same output
+    """
+    if pil_img.mode not in ("RGB", "RGBX"):
+        pil_img = pil_img.convert("RGB")
+    if new_resolution is not None and tuple(new_resolution) != pil_img.size:
+        with profiler.span("resize", "pipeline"):
+            pil_img = pil_img.resize(new_resolution, get_resample(resample))
+    return get_encoder(encoder).encode(pil_img, quality, settings)
+
+
+def get_resample(resample):
+    """
+    Returns resample, or LANCZOS if it is None. Functions here take None instead of
+    defaulting to Image.Resampling.LANCZOS so that importing this module does not
+    import Pillow, which the window does not need before an image is loaded
+    """
+    if resample is not None:
+        return resample
+    from PIL import Image
+
+    return Image.Resampling.LANCZOS
+
+
+def get_tile_aligned_box(region, resolution, tile_size):
+    """
+    Returns region (left, top, right, bottom) grown to whole tiles of tile_size and
+    by one more tile on each side, inside resolution. Decoders blend the colors of
+    neighboring JPEG blocks, so the extra tiles keep that from changing region
+    """
+    tile_width, tile_height = tile_size
+    left, top, right, bottom = region
+    return (max(0, (left // tile_width - 1) * tile_width),
+            max(0, (top // tile_height - 1) * tile_height),
+            min(resolution[0], (math.ceil(right / tile_width) + 1) * tile_width),
+            min(resolution[1], (math.ceil(bottom / tile_height) + 1) * tile_height))
+
+
+def encode_region(pil_img, new_resolution, region, quality, resample=None,
+                  encoder=DEFAULT_ENCODER, settings=None):
+    """
+    Encodes only the part region of pil_img resized to new_resolution, grown with
+    get_tile_aligned_box so that region decodes to exactly the pixels it has when
+    the whole image is encoded by resize_and_encode. Only that part is resized too,
+    which with filters other than NEAREST can be off by one level of rounding.
+    Returns the encoded bytes and the box of the resized image they cover. Raises
+    ValueError for encoders without a tile size
+    """
+    encoder = get_encoder(encoder)
+    tile_size = encoder.get_tile_size(settings)
+    if tile_size is None:
+        raise ValueError(f"{encoder.label} cannot encode part of an image")
+    box = get_tile_aligned_box(region, new_resolution, tile_size)
+
+    if pil_img.mode not in ("RGB", "RGBX"):
+        pil_img = pil_img.convert("RGB")
+    # the part of the original which becomes box once resized
+    scale_x = pil_img.width / new_resolution[0]
+    scale_y = pil_img.height / new_resolution[1]
+    with profiler.span("resize", "pipeline"):
+        pil_img = pil_img.resize((box[2] - box[0], box[3] - box[1]),
+                                 get_resample(resample),
+                                 (box[0] * scale_x, box[1] * scale_y,
+                                  box[2] * scale_x, box[3] * scale_y))
+    return encoder.encode(pil_img, quality, settings), box
+
+
+def compress_file(src_path, dst_path, quality, scale, encoder=DEFAULT_ENCODER,
+                  settings=DEFAULT_SETTINGS):
+    """
+    Opens src_path, resizes it by scale, encodes it with quality and settings (see
+    DEFAULT_SETTINGS) and writes it to dst_path. Returns a dict with the sizes and
+    time taken
+    """
+    from PIL import Image
+
+    start = time.perf_counter()
+    with Image.open(src_path) as pil_img:
+        settings = resolve_settings(settings, read_metadata(pil_img))
+        new_resolution = scale_resolution(pil_img.size, scale)
+        pil_img.draft("RGB", new_resolution)
+        data = resize_and_encode(pil_img, new_resolution, quality, encoder=encoder,
+                                 settings=settings)
+    write_file_atomic(dst_path, data)
+
+    return {"path": src_path,
+            "output_path": dst_path,
+            "input_bytes": os.path.getsize(src_path),
+            "output_bytes": len(data),
+            "resolution": new_resolution,
+            "seconds": time.perf_counter() - start}
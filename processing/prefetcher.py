@@ -0,0 +1,79 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from processing.image_store import BYTES_PER_PIXEL
+
+
+class ImagePrefetcher:
+    """
+    Decodes images on a pool of threads before they are opened, so that switching to
+    them does not wait for a decode. The caller lists the paths it wants kept ready
+    with prefetch. Decoded images are kept until they are no longer listed, and
+    images past max_bytes of decoded pixels are not decoded at all. on_ready is
+    called from a worker thread whenever an image has been decoded
+    """
+
+    def __init__(self, image_store, max_bytes, workers=2, on_ready=None):
+        self.image_store = image_store
+        self.max_bytes = max_bytes
+        self.on_ready = on_ready
+        self.futures = {}  # path -> Future of the StoredImage of path
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="prefetch")
+
+    @staticmethod
+    def get_decoded_size(path):
+        """
+        Returns the number of bytes path takes once decoded. Only the header of the
+        file is read. Files which cannot be opened count as 0 bytes, the decode
+        reports their error
+        """
+        try:
+            with Image.open(path) as pil_img:
+                return pil_img.size[0] * pil_img.size[1] * BYTES_PER_PIXEL
+        except Exception:
+            return 0
+
+    def decode(self, path):
+        image = self.image_store.load(path)
+        if self.on_ready is not None:
+            self.on_ready()
+        return image
+
+    def get(self, path):
+        """
+        Returns the Future of the decode of path, starting the decode first if it
+        was not prefetched or failed before
+        """
+        with self.lock:
+            future = self.futures.get(path)
+            if future is None or future.cancelled() or (
+                    future.done() and future.exception() is not None):
+                future = self.executor.submit(self.decode, path)
+                self.futures[path] = future
+            return future
+
+    def prefetch(self, paths):
+        """
+        Makes sure the images in paths are decoded, in the order given, and forgets
+        every other image. Paths stop being decoded once their decoded pixels would
+        use more than max_bytes in total
+        """
+        paths = list(dict.fromkeys(paths))
+        with self.lock:
+            for path in list(self.futures):
+                if path not in paths:
+                    self.futures.pop(path).cancel()  # only cancels a decode not started
+
+        used_bytes = 0
+        for path in paths:
+            used_bytes += self.get_decoded_size(path)
+            if used_bytes > self.max_bytes and path != paths[0]:
+                break
+            self.get(path)
+
+    def stop(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+
+from processing.encoders import DEFAULT_ENCODER, get_encoder
+
+
+def make_cache_key(source, source_size, quality, resolution, resample,
+                   encoder=DEFAULT_ENCODER, settings=None):
+    """
+    Returns the key an encode is stored under. When the image is not resized the
+    resampling filter does not change the output, so it is left out of the key and
+    previews and saves at full resolution share the same entry. The quality, and
+    settings, are left out too for encoders which do not use them
+    """
+    resolution = tuple(resolution)
+    if resolution == tuple(source_size):
+        resample = None
+    encoder = get_encoder(encoder)
+    quality = int(quality) if encoder.has_quality else None
+    return (source, encoder.name, quality, resolution, resample,
+            encoder.get_settings_key(settings))
+
+
+class PreviewCache:
+    """
+    Least recently used cache of encoded images. Each entry holds the encoded bytes,
+    their count and optionally the decoded pygame surface. The total memory of all
+    entries is kept below max_bytes by removing the least recently used ones.
+    It is used by both the UI thread and the preview worker thread
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def get_entry_cost(data, surface):
+        cost = len(data)
+        if surface is not None:
+            cost += surface.get_width() * surface.get_height() * surface.get_bytesize()
+        return cost
+
+    def get(self, key, needs_surface=False):
+        """
+        Returns the entry for key as a dict, or None if it is not cached. With
+        needs_surface, entries without a decoded surface count as a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (needs_surface and entry["surface"] is None):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, data, surface=None):
+        cost = self.get_entry_cost(data, surface)
+        if cost > self.max_bytes:
+            return
+
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.used_bytes -= old_entry["cost"]
+                if surface is None:  # keep the surface an earlier entry already had
+                    surface = old_entry["surface"]
+                    cost = self.get_entry_cost(data, surface)
+
+            self.entries[key] = {"data": data, "size": len(data), "surface": surface,
+                                 "cost": cost}
+            self.used_bytes += cost
+
+            while self.used_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.used_bytes -= evicted["cost"]
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used_bytes = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "used_bytes": self.used_bytes,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
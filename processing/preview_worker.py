@@ -0,0 +1,143 @@
+import io
+import threading
+import time
+
+import pygame
+from PIL import Image
+
+from processing.encoders import DEFAULT_ENCODER, get_encoder
+from processing.pipeline import buffer_to_pil, encode_region, resize_and_encode
+from processing.profiler import profiler
+
+
+class PreviewWorker:
+    """
+    Encodes image previews on a background thread so the application loop never
+    waits for an encode. Only the newest request is kept: requests made while the
+    worker is busy replace each other, so at most one encode runs at a time.
+    A result which was replaced by a newer request while encoding is still shown
+    while the newer one is encoding, which lets a slider drag stream previews.
+    Results older than the one already shown, or made before cancel was called,
+    are thrown away. on_result is called from the worker thread whenever a result
+    is ready to be collected
+    """
+
+    def __init__(self, cache, on_result=None):
+        self.cache = cache  # finished previews are stored here
+        self.on_result = on_result
+        self.condition = threading.Condition()
+        self.generation = 0  # increases with every request, identifies the newest one
+        self.cancelled_generation = 0  # requests up to this one belong to an old image
+        self.pending_request = None
+        self.result = None
+        self.is_busy = False
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.run, name="preview-worker",
+                                       daemon=True)
+        self.thread.start()
+
+    def submit(self, key, rgb_buffer, size, quality, resolution, data=None,
+               encoder=DEFAULT_ENCODER, settings=None, region=None):
+        """
+        Asks for a preview of the image in rgb_buffer at quality and resolution,
+        encoded with encoder and settings. If the encoded data is already known, it
+        is only decoded. With region (left, top, right, bottom) only that part of the
+        resized image is encoded, see encode_region. The preview is cached under key.
+        Any request which has not started yet is replaced by this one
+        """
+        with self.condition:
+            self.generation += 1
+            self.pending_request = (self.generation, key, rgb_buffer, size, quality,
+                                    resolution, data, encoder, settings, region)
+            self.condition.notify()
+
+    def cancel(self):
+        """
+        Drops the pending request and any result which has not been collected
+        """
+        with self.condition:
+            self.generation += 1
+            self.cancelled_generation = self.generation
+            self.pending_request = None
+            self.result = None
+
+    def get_result(self):
+        """
+        Returns the newest finished preview as a dict, or None if there is nothing new
+        """
+        with self.condition:
+            result = self.result
+            self.result = None
+        return result
+
+    def is_idle(self):
+        with self.condition:
+            return not self.is_busy and self.pending_request is None
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def is_stale(self, generation):
+        with self.condition:
+            return generation <= self.cancelled_generation
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending_request is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                request = self.pending_request
+                self.pending_request = None
+                self.is_busy = True
+
+            try:
+                result = self.encode_preview(*request)
+            except Exception as ex:
+                result = {"generation": request[0], "error": str(ex)}
+
+            with self.condition:
+                self.is_busy = False
+                is_published = (result is not None and
+                                result["generation"] > self.cancelled_generation)
+                if is_published:
+                    self.result = result
+            if is_published and self.on_result is not None:
+                self.on_result()
+
+    def encode_preview(self, generation, key, rgb_buffer, size, quality, resolution,
+                       data, encoder, settings, region):
+        start = time.perf_counter()
+        if data is None:
+            pil_img = buffer_to_pil(rgb_buffer, size)
+            if region is None:
+                data = resize_and_encode(pil_img, resolution, quality,
+                                         Image.Resampling.NEAREST, encoder, settings)
+            else:
+                data, box = encode_region(pil_img, resolution, region, quality,
+                                          Image.Resampling.NEAREST, encoder, settings)
+            if self.is_stale(generation):
+                return None
+
+        # decode the encoded image so that the preview shows its compression artifacts
+        with profiler.span("preview decode", "pipeline"):
+            surface = pygame.image.load(io.BytesIO(data),
+                                        get_encoder(encoder).pil_format)
+        if region is not None:
+            # drop the tiles around region which were only encoded to keep it exact
+            surface = surface.subsurface((region[0] - box[0], region[1] - box[1],
+                                          region[2] - region[0],
+                                          region[3] - region[1])).copy()
+        self.cache.put(key, data, surface)
+        return {"generation": generation,
+                "key": key,
+                "quality": quality,
+                "resolution": resolution,
+                "region": region,
+                "size": len(data),
+                "surface": surface,
+                "seconds": time.perf_counter() - start}
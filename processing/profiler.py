@@ -0,0 +1,153 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import deque
+
+NULL_SPAN = contextlib.nullcontext()  # returned by span while disabled, does nothing
+
+
+class Profiler:
+    """
+    Records how long named pieces of work take, from any thread, into a ring buffer
+    holding the last max_events of them. Work is timed with span. While the
+    profiler is disabled span does nothing, so it can stay in code that runs every
+    frame. The recorded events can be written as a Chrome trace-event file which
+    chrome://tracing and ui.perfetto.dev open
+    """
+
+    def __init__(self, max_events=100_000):
+        self.enabled = False
+        self.events = deque(maxlen=max_events)  # (name, category, thread id, start, end)
+        self.thread_names = {}  # thread id -> thread name
+        self.origin_ns = time.perf_counter_ns()
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        if not enabled:
+            self.events.clear()
+
+    def span(self, name, category="app"):
+        """
+        Returns a context manager which records the time spent inside it as name
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return self.record_span(name, category)
+
+    @contextlib.contextmanager
+    def record_span(self, name, category):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(name, category, start, time.perf_counter_ns())
+
+    def record(self, name, category, start_ns, end_ns):
+        thread = threading.current_thread()
+        self.thread_names[thread.ident] = thread.name
+        # appending to a deque is atomic, so no lock is needed between threads
+        self.events.append((name, category, thread.ident, start_ns, end_ns))
+
+    def get_recent_events(self, seconds):
+        """
+        Returns the events which ended in the last seconds, oldest first
+        """
+        return self.get_events_since(time.perf_counter_ns() - int(seconds * 1e9))
+
+    def get_events_since(self, since_ns):
+        """
+        Returns the events which ended at since_ns (a time.perf_counter_ns value) or
+        later, oldest first
+        """
+        recent = []
+        for event in reversed(list(self.events)):  # list() so other threads can append
+            if event[4] < since_ns:
+                break
+            recent.append(event)
+        recent.reverse()
+        return recent
+
+    def get_stats(self, seconds):
+        """
+        Returns a dict of name -> {"count", "average_ms", "max_ms", "last_ms"} for the
+        events which ended in the last seconds
+        """
+        stats = {}
+        for name, _, _, start_ns, end_ns in self.get_recent_events(seconds):
+            duration_ms = (end_ns - start_ns) / 1e6
+            stat = stats.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stat["count"] += 1
+            stat["total_ms"] += duration_ms
+            stat["max_ms"] = max(stat["max_ms"], duration_ms)
+            stat["last_ms"] = duration_ms
+        for stat in stats.values():
+            stat["average_ms"] = stat.pop("total_ms") / stat["count"]
+        return stats
+
+    def get_last_durations(self, names):
+        """
+        Returns a dict of name -> duration in milliseconds of the last event with that
+        name, for every name in names that has been recorded
+        """
+        durations = {}
+        for name, _, _, start_ns, end_ns in reversed(list(self.events)):
+            if name in names and name not in durations:
+                durations[name] = (end_ns - start_ns) / 1e6
+                if len(durations) == len(names):
+                    break
+        return durations
+
+    def export_chrome_trace(self, path, seconds):
+        """
+        Writes the events of the last seconds to path in the Chrome trace-event
+        format. Returns the number of events written
+        """
+        pid = os.getpid()
+        trace_events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                         "args": {"name": name}}
+                        for tid, name in list(self.thread_names.items())]
+        events = self.get_recent_events(seconds)
+        for name, category, tid, start_ns, end_ns in events:
+            trace_events.append({"name": name, "cat": category, "ph": "X",
+                                 "pid": pid, "tid": tid,
+                                 "ts": (start_ns - self.origin_ns) / 1000,
+                                 "dur": (end_ns - start_ns) / 1000})
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+        return len(events)
+
+
+class StartupTimer:
+    """
+    Measures how long each phase of starting the app takes. mark ends the phase
+    running since the previous mark (or since start, a time.perf_counter value)
+    """
+
+    def __init__(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.phases = []  # (name, seconds)
+        self.last = self.start
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def get_elapsed(self):
+        return self.last - self.start
+
+    def format_phases(self):
+        """
+        Returns one line per phase with its time and share of the total
+        """
+        total = self.get_elapsed() or 1
+        width = max((len(name) for name, _ in self.phases), default=0)
+        return "\n".join(f"{name:<{width}} {seconds * 1000:8.1f} ms "
+                         f"{seconds / total:6.1%}" for name, seconds in self.phases)
+
+
+# Shared by the app and every worker thread
+profiler = Profiler()
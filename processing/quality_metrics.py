@@ -0,0 +1,127 @@
+import math
+import re
+
+import numpy as np
+from PIL import Image
+
+# BT.601 weights, the same ones PIL uses to convert to "L"
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+MAX_VALUE = 255.0
+
+
+def get_luma(pil_img, max_pixels=None):
+    """
+    Returns the brightness of pil_img as a 2D float32 array. With max_pixels, images
+    with more pixels are averaged down to about max_pixels first, which makes the
+    metrics much faster while still seeing most compression artifacts
+    """
+    if max_pixels is not None and pil_img.width * pil_img.height > max_pixels:
+        scale = math.sqrt(max_pixels / (pil_img.width * pil_img.height))
+        pil_img = pil_img.resize((max(1, int(pil_img.width * scale)),
+                                  max(1, int(pil_img.height * scale))),
+                                 Image.Resampling.BOX)
+    if pil_img.mode not in ("RGB", "RGBX"):
+        pil_img = pil_img.convert("RGB")
+    pixels = np.asarray(pil_img)[:, :, :3]
+    return pixels.astype(np.float32) @ LUMA_WEIGHTS
+
+
+def psnr(reference, test):
+    """
+    Peak signal to noise ratio of test against reference in dB, infinite if they are
+    the same
+    """
+    mse = float(np.mean(np.square(reference - test)))
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(MAX_VALUE ** 2 / mse)
+
+
+def get_gaussian_kernel(size=11, sigma=1.5):
+    x = np.arange(size, dtype=np.float32) - size // 2
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def blur(values, kernel):
+    """
+    Gaussian blur of the 2D array values, only where the kernel fits inside it. The
+    kernel is applied along each axis in turn as a sum of shifted slices, so every
+    step works on the whole image at once
+    """
+    height = values.shape[0] - len(kernel) + 1
+    rows = kernel[0] * values[:height]
+    for i in range(1, len(kernel)):
+        rows += kernel[i] * values[i:i + height]
+
+    width = values.shape[1] - len(kernel) + 1
+    blurred = kernel[0] * rows[:, :width]
+    for i in range(1, len(kernel)):
+        blurred += kernel[i] * rows[:, i:i + width]
+    return blurred
+
+
+def ssim(reference, test):
+    """
+    Mean structural similarity of test against reference with the usual 11x11
+    Gaussian window (Wang et al. 2004). 1.0 means they are the same
+    """
+    kernel = get_gaussian_kernel()
+    if min(reference.shape) < len(kernel):
+        return ssim_global(reference, test)
+
+    c1 = (0.01 * MAX_VALUE) ** 2
+    c2 = (0.03 * MAX_VALUE) ** 2
+    mean_ref = blur(reference, kernel)
+    mean_test = blur(test, kernel)
+    mean_ref_sq = mean_ref * mean_ref
+    mean_test_sq = mean_test * mean_test
+    mean_both = mean_ref * mean_test
+    var_ref = blur(reference * reference, kernel) - mean_ref_sq
+    var_test = blur(test * test, kernel) - mean_test_sq
+    covariance = blur(reference * test, kernel) - mean_both
+
+    ssim_map = ((2 * mean_both + c1) * (2 * covariance + c2) /
+                ((mean_ref_sq + mean_test_sq + c1) * (var_ref + var_test + c2)))
+    return float(ssim_map.mean())
+
+
+def ssim_global(reference, test):
+    """
+    SSIM with the whole image as one window, for images smaller than the window
+    """
+    c1 = (0.01 * MAX_VALUE) ** 2
+    c2 = (0.03 * MAX_VALUE) ** 2
+    mean_ref = reference.mean()
+    mean_test = test.mean()
+    covariance = ((reference - mean_ref) * (test - mean_test)).mean()
+    return float((2 * mean_ref * mean_test + c1) * (2 * covariance + c2) /
+                 ((mean_ref ** 2 + mean_test ** 2 + c1) *
+                  (reference.var() + test.var() + c2)))
+
+
+# metric name -> (function, label)
+METRICS = {"ssim": (ssim, "SSIM"),
+           "psnr": (psnr, "PSNR")}
+
+
+def format_score(metric, score):
+    if metric == "psnr":
+        return "lossless" if math.isinf(score) else f"{score:.2f} dB"
+    return f"{score:.4f}"
+
+
+def parse_quality_target(text):
+    """
+    Reads a target like "0.95" (SSIM) or "40dB" (PSNR). Numbers up to 1 are SSIM and
+    bigger ones are PSNR in dB. Returns (metric, target) or None if text is invalid
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*(db)?\s*", text.lower())
+    if match is None:
+        return None
+    value = float(match.group(1))
+    if match.group(2) or value > 1:
+        return "psnr", value
+    if value <= 0:
+        return None
+    return "ssim", value
@@ -0,0 +1,173 @@
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from processing.encoders import (DEFAULT_ENCODER, DEFAULT_SETTINGS, get_encoder,
+                                 read_metadata, resolve_settings)
+from processing.pipeline import (buffer_to_pil, pil_to_rgb_buffer, resize_and_encode,
+                                 scale_resolution, write_file_atomic)
+from processing.quality_metrics import METRICS, get_luma
+
+
+class QualityTargetSolver:
+    """
+    Finds the lowest quality, and so the smallest file, whose encode still scores at
+    least a target SSIM or PSNR against the original resized to the same resolution.
+    Scores are measured on brightness only, on a copy averaged down to max_pixels if
+    it is given. Every probe is a real encode, decode and comparison, and its score
+    is remembered so later searches on the same image can reuse it
+    """
+
+    def __init__(self, rgb_buffer, size, metric="ssim", max_pixels=None,
+                 resample=Image.Resampling.LANCZOS, probes_per_round=3,
+                 encoder=DEFAULT_ENCODER, settings=None):
+        self.size = tuple(size)
+        self.metric = metric
+        self.metric_function = METRICS[metric][0]
+        self.max_pixels = max_pixels
+        self.resample = resample
+        self.probes_per_round = probes_per_round
+        self.encoder = encoder
+        self.settings = settings
+
+        self.probes = {}  # (quality, resolution) -> (score, encoded size)
+        # resolution -> RGB pixels resized once and reused by every probe
+        self.resized_buffers = {self.size: rgb_buffer}
+        self.reference_lumas = {}  # resolution -> brightness the probes are compared to
+        self.encode_count = 0
+        # CPU time spent measuring scores, summed over threads. CPU time is used so
+        # that probes running at the same time do not count each other's work
+        self.metric_seconds = 0.0
+
+    def get_resized_buffer(self, resolution):
+        if resolution not in self.resized_buffers:
+            pil_img = buffer_to_pil(self.resized_buffers[self.size], self.size)
+            resized_img = pil_img.resize(resolution, self.resample)
+            self.resized_buffers[resolution] = pil_to_rgb_buffer(resized_img)
+        return self.resized_buffers[resolution]
+
+    def get_reference_luma(self, resolution):
+        if resolution not in self.reference_lumas:
+            pil_img = buffer_to_pil(self.get_resized_buffer(resolution), resolution)
+            start = time.thread_time()
+            self.reference_lumas[resolution] = get_luma(pil_img, self.max_pixels)
+            self.metric_seconds += time.thread_time() - start
+        return self.reference_lumas[resolution]
+
+    def probe(self, quality, resolution):
+        """
+        Encodes the image at quality and returns its score, encoded data and the CPU
+        seconds the score took
+        """
+        # a new image object every time so that parallel encodes do not share one
+        pil_img = buffer_to_pil(self.get_resized_buffer(resolution), resolution)
+        data = resize_and_encode(pil_img, None, quality, encoder=self.encoder,
+                                 settings=self.settings)
+
+        start = time.thread_time()
+        with Image.open(io.BytesIO(data)) as decoded_img:
+            test_luma = get_luma(decoded_img, self.max_pixels)
+        score = self.metric_function(self.get_reference_luma(resolution), test_luma)
+        return score, data, time.thread_time() - start
+
+    def probe_all(self, executor, qualities, resolution):
+        """
+        Probes every quality which has not been tried yet, in parallel. Returns the
+        data of each new encode keyed by quality
+        """
+        new_qualities = [q for q in qualities if (q, resolution) not in self.probes]
+        # resize and measure the reference in this thread so it is only done once
+        self.get_reference_luma(resolution)
+        results = executor.map(lambda q: self.probe(q, resolution), new_qualities)
+
+        encoded = {}
+        for quality, (score, data, metric_seconds) in zip(new_qualities, results):
+            self.probes[(quality, resolution)] = (score, len(data))
+            self.metric_seconds += metric_seconds
+            encoded[quality] = data
+        self.encode_count += len(new_qualities)
+        return encoded
+
+    def solve(self, target, resolution=None):
+        """
+        Returns a dict with the lowest quality scoring at least target at resolution
+        (the full resolution by default), its score, size and encoded data, along
+        with the number of encodes and the seconds spent on scores. "fits" is False
+        if even quality 100 scores below target
+        """
+        resolution = tuple(resolution or self.size)
+        encodes_before = self.encode_count
+        metric_seconds_before = self.metric_seconds
+        # only quality 100 is tried for encoders which ignore the quality
+        passes = 100  # lowest quality known to reach the target, once 100 is checked
+        too_low = 99 if not get_encoder(self.encoder).has_quality else 0
+
+        with ThreadPoolExecutor(max_workers=self.probes_per_round) as executor:
+            # the first round always finds out if quality 100 reaches the target
+            encoded = self.probe_all(executor, [100], resolution)
+            best_data = encoded.get(100)
+            if self.probes[(100, resolution)][0] < target:
+                passes = None
+
+            # bisection over quality, each round splits the unknown range with
+            # probes_per_round encodes running at the same time
+            while passes is not None and passes - too_low > 1:
+                gap = passes - too_low
+                count = min(self.probes_per_round, gap - 1)
+                qualities = sorted({too_low + max(1, round(gap * i / (count + 1)))
+                                    for i in range(1, count + 1)})
+                encoded = self.probe_all(executor, qualities, resolution)
+                for quality in qualities:
+                    if self.probes[(quality, resolution)][0] >= target:
+                        if quality < passes:
+                            passes = quality
+                            best_data = encoded.get(quality)
+                    else:
+                        too_low = max(too_low, quality)
+
+        quality = passes if passes is not None else 100
+        if passes is not None and best_data is None:
+            # the score came from an earlier search so the bytes have to be made again
+            best_data = self.probe(quality, resolution)[1]
+            self.encode_count += 1
+
+        score, size = self.probes[(quality, resolution)]
+        return {"fits": passes is not None,
+                "quality": quality,
+                "resolution": resolution,
+                "score": score,
+                "size": size,
+                "data": best_data if passes is not None else None,
+                "encodes": self.encode_count - encodes_before,
+                "metric_seconds": self.metric_seconds - metric_seconds_before}
+
+
+def compress_file_to_quality(src_path, dst_path, metric, target, scale=1.0,
+                             max_pixels=None, encoder=DEFAULT_ENCODER,
+                             settings=DEFAULT_SETTINGS):
+    """
+    Same as compress_file but the lowest quality scoring at least target on metric
+    ("ssim" or "psnr") is searched for
+    """
+    start = time.perf_counter()
+    with Image.open(src_path) as pil_img:
+        resolution = scale_resolution(pil_img.size, scale)
+        pil_img.draft("RGB", resolution)
+        settings = resolve_settings(settings, read_metadata(pil_img))
+        solver = QualityTargetSolver(pil_to_rgb_buffer(pil_img), pil_img.size, metric,
+                                     max_pixels, encoder=encoder, settings=settings)
+    result = solver.solve(target, resolution)
+
+    data = result.pop("data")
+    if data is not None:
+        write_file_atomic(dst_path, data)
+
+    result.update(path=src_path,
+                  output_path=dst_path,
+                  input_bytes=os.path.getsize(src_path),
+                  output_bytes=result["size"],
+                  seconds=time.perf_counter() - start)
+    return result
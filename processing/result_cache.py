@@ -0,0 +1,302 @@
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+
+import PIL
+
+from processing.encoders import get_encoder
+from processing.pipeline import format_byte_count, write_file_atomic
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# bump when the output for the same parameters changes, so old entries are not used
+CACHE_VERSION = 1
+TRIM_RATIO = 0.9  # trimming deletes down to this part of max_bytes
+
+
+def get_default_cache_dir():
+    """
+    Returns the folder the result cache is kept in by default, the usual cache folder
+    of the platform
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.environ.get("LOCALAPPDATA")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "image-quality-modifier")
+
+
+@functools.lru_cache(maxsize=256)
+def hash_file_contents(path, size, mtime_ns):
+    # size and mtime_ns are only part of the arguments so that a changed file is
+    # hashed again instead of coming from the lru_cache
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_file(path):
+    """
+    Returns the SHA-256 of the bytes in the file at path as hex. Files which did not
+    change since they were last hashed are not read again
+    """
+    stat = os.stat(path)
+    return hash_file_contents(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def get_params_id(params):
+    """
+    Returns a short hash of params, a tuple of everything which changes the output
+    made from a source file, like (encoder, quality, resolution, ...)
+    """
+    text = repr((CACHE_VERSION, PIL.__version__) + tuple(params))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+def get_encode_params(encoder, quality, resolution, resample, settings):
+    """
+    Returns the params of a plain encode with the encoder called encoder, keyed the
+    same way as make_cache_key so that the quality is left out when it is not used
+    """
+    encoder = get_encoder(encoder)
+    quality = int(quality) if encoder.has_quality else None
+    return ("encode", encoder.name, quality, tuple(resolution), int(resample),
+            encoder.get_settings_key(settings))
+
+
+class ResultCache:
+    """
+    Keeps encoded outputs on disk across runs, keyed by a hash of the bytes of the
+    source file and of every parameter of the encode, so an output is found again
+    even if the file was renamed or moved. Each entry is one file holding a line of
+    JSON metadata, like the output size, followed by the output bytes. Entries of
+    the same source share a folder so their sizes can be listed at once. Once the
+    entries take more than max_bytes the least recently used ones are deleted.
+    Safe to use from several threads and several processes at once
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or get_default_cache_dir()
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = None  # bytes of all entries, counted on the first write
+        self.trims = True  # if writes delete old entries once max_bytes is reached
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0,
+                      "seconds_saved": 0.0}
+
+    def __getstate__(self):
+        # sent to worker processes which only read and add entries, trimming is left
+        # to the process which made the cache
+        state = self.__dict__.copy()
+        del state["lock"]
+        state.update(total_bytes=None, trims=False)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_source_dir(self, source_digest):
+        return os.path.join(self.directory, source_digest[:2], source_digest)
+
+    def get_entry_path(self, source_digest, params):
+        return os.path.join(self.get_source_dir(source_digest),
+                            get_params_id(params) + ".bin")
+
+    def get(self, source_digest, params):
+        """
+        Returns (data, meta) stored for params of the source with source_digest, or
+        None. data is None for results which had no output
+        """
+        path = self.get_entry_path(source_digest, params)
+        try:
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline())
+                data = f.read()
+            os.utime(path)  # the modification time is when the entry was last used
+        except (OSError, ValueError):
+            with self.lock:
+                self.stats["misses"] += 1
+            return None
+
+        with self.lock:
+            self.stats["hits"] += 1
+            self.stats["seconds_saved"] += meta.get("seconds", 0.0)
+        return (data if meta.get("has_data", True) else None), meta
+
+    def put(self, source_digest, params, data, meta):
+        """
+        Stores data, which may be None, with meta, a dict which can be written as
+        JSON. The time the output took to make should be in meta["seconds"].
+        Returns the stored meta, or None if it could not be written
+        """
+        meta = dict(meta, params_id=get_params_id(params), has_data=data is not None)
+        entry = json.dumps(meta).encode("utf-8") + b"\n" + (data or b"")
+        path = self.get_entry_path(source_digest, params)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_file_atomic(path, entry)
+        except OSError:  # a full or read only disk only makes the cache useless
+            return None
+
+        with self.lock:
+            self.stats["writes"] += 1
+            if self.total_bytes is not None:
+                self.total_bytes += len(entry)
+            should_trim = self.trims and (self.total_bytes is None
+                                          or self.total_bytes > self.max_bytes)
+        if should_trim:
+            self.trim()
+        return meta
+
+    def list_meta(self, source_digest):
+        """
+        Returns the metadata of every entry of the source with source_digest, keyed
+        by params_id. Only the first line of each entry is read
+        """
+        metas = {}
+        try:
+            names = os.listdir(self.get_source_dir(source_digest))
+        except OSError:
+            return metas
+        for name in names:
+            if not name.endswith(".bin"):
+                continue
+            try:
+                with open(os.path.join(self.get_source_dir(source_digest), name),
+                          "rb") as f:
+                    meta = json.loads(f.readline())
+            except (OSError, ValueError):
+                continue
+            metas[meta["params_id"]] = meta
+        return metas
+
+    def get_entries(self):
+        """
+        Returns (modification time, size, path) of every entry, least recently used
+        first
+        """
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".bin"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # deleted by another process
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def trim(self):
+        """
+        If the entries take more than max_bytes, deletes the least recently used ones
+        until they take at most TRIM_RATIO of it. Returns the number of entries
+        deleted
+        """
+        entries = self.get_entries()
+        total_bytes = sum(size for _, size, _ in entries)
+        if total_bytes <= self.max_bytes:
+            entries = []
+        evictions = 0
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes * TRIM_RATIO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            evictions += 1
+            try:
+                os.rmdir(os.path.dirname(path))  # only works once the folder is empty
+            except OSError:
+                pass
+
+        with self.lock:
+            self.total_bytes = total_bytes
+            self.stats["evictions"] += evictions
+        return evictions
+
+    def count_result(self, result):
+        """
+        Adds a result of run_cached which ran in another process to the stats
+        """
+        if "cache_hit" not in result:
+            return
+        with self.lock:
+            if result["cache_hit"]:
+                self.stats["hits"] += 1
+                self.stats["seconds_saved"] += result["seconds_saved"]
+            else:
+                self.stats["misses"] += 1
+                self.stats["writes"] += 1
+
+    def get_stats(self):
+        if self.total_bytes is None:
+            total_bytes = sum(size for _, size, _ in self.get_entries())
+            with self.lock:
+                self.total_bytes = total_bytes
+        with self.lock:
+            return dict(self.stats, total_bytes=self.total_bytes)
+
+    def format_stats(self, stats=None):
+        """
+        Returns stats, by default the ones of this process, as one line of text
+        """
+        stats = stats or self.get_stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = f" ({stats['hits'] / lookups:.0%})" if lookups else ""
+        return (f"Result cache: {stats['hits']} hits{hit_rate}, {stats['misses']} "
+                f"misses, {stats['writes']} written, {stats['evictions']} evicted, "
+                f"{stats['seconds_saved']:.2f}s of encoding saved, "
+                f"{format_byte_count(stats['total_bytes'])} of "
+                f"{format_byte_count(self.max_bytes)} in {self.directory}")
+
+
+def run_cached(cache, src_path, dst_path, params, compress):
+    """
+    Calls compress(), which writes dst_path and returns a result dict like
+    compress_file does, unless a result for src_path and params is in cache, in
+    which case its output is written to dst_path instead. The result has
+    "cache_hit" set to whether the cache was used
+    """
+    if cache is None:
+        return compress()
+
+    start = time.perf_counter()
+    source_digest = hash_file(src_path)
+    cached = cache.get(source_digest, params)
+    if cached is not None:
+        data, meta = cached
+        if data is not None:
+            write_file_atomic(dst_path, data)
+        result = dict(meta["result"], path=src_path, output_path=dst_path,
+                      input_bytes=os.path.getsize(src_path),
+                      seconds=time.perf_counter() - start, cache_hit=True,
+                      seconds_saved=meta["seconds"])
+        # the searches did not run this time
+        if "encodes" in result:
+            result["encodes"] = 0
+        if "metric_seconds" in result:
+            result["metric_seconds"] = 0.0
+        return result
+
+    result = compress()
+    data = None
+    if result.get("fits", True):
+        # read back the written output, it is still in the OS file cache
+        with open(dst_path, "rb") as f:
+            data = f.read()
+    stored = {key: value for key, value in result.items()
+              if key not in ("path", "output_path", "input_bytes", "seconds")}
+    cache.put(source_digest, params, data,
+              {"result": stored, "size": None if data is None else len(data),
+               "seconds": result["seconds"]})
+    result["cache_hit"] = False
+    return result
@@ -0,0 +1,125 @@
+import queue
+import threading
+import time
+
+from PIL import Image
+
+from processing.encoders import DEFAULT_ENCODER
+from processing.pipeline import (buffer_to_pil, open_draft, resize_and_encode,
+                                 write_file_atomic)
+from processing.result_cache import get_encode_params, hash_file
+
+
+class SaveWorker:
+    """
+    Saves images on a background thread so the window keeps responding while an
+    image is encoded and written. Saves run one at a time in the order they were
+    asked for, and more can be asked for while one is running. Every file is written
+    atomically with write_file_atomic. on_done is called from the worker thread
+    after each save, whose result is then collected with get_results. With a
+    result_cache, encodes are also kept on disk so they are reused by later runs
+    """
+
+    def __init__(self, cache, on_done=None, result_cache=None):
+        self.cache = cache  # encoded images are stored here so saving again is instant
+        self.result_cache = result_cache
+        self.on_done = on_done
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending_count = 0  # saves asked for which have not finished yet
+        self.results = []
+
+        self.thread = threading.Thread(target=self.run, name="save-worker", daemon=True)
+        self.thread.start()
+
+    def submit(self, key, dst_path, src_path, quality, resolution, rgb_buffer=None,
+               size=None, data=None, encoder=DEFAULT_ENCODER, settings=None):
+        """
+        Asks for the image to be saved to dst_path at quality and resolution,
+        encoded with encoder and settings. The pixels come from rgb_buffer of the
+        given size if it is passed, otherwise src_path is decoded again. If the
+        encoded data is already known it is only written. The encoded image is
+        cached under key
+        """
+        with self.lock:
+            self.pending_count += 1
+        self.jobs.put((key, dst_path, src_path, quality, resolution, rgb_buffer, size,
+                       data, encoder, settings))
+
+    def get_pending_count(self):
+        with self.lock:
+            return self.pending_count
+
+    def get_results(self):
+        """
+        Returns a list with a dict for every save which finished since the last call
+        """
+        with self.lock:
+            results = self.results
+            self.results = []
+        return results
+
+    def stop(self):
+        """
+        Stops the worker once the saves already asked for are written
+        """
+        self.jobs.put(None)
+
+    def wait(self):
+        self.thread.join()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            try:
+                result = self.save(*job)
+            except Exception as ex:
+                result = {"path": job[1], "error": str(ex)}
+
+            with self.lock:
+                self.pending_count -= 1
+                self.results.append(result)
+            if self.on_done is not None:
+                self.on_done()
+
+    def save(self, key, dst_path, src_path, quality, resolution, rgb_buffer, size, data,
+             encoder, settings):
+        start = time.perf_counter()
+        params = get_encode_params(encoder, quality, resolution,
+                                   Image.Resampling.LANCZOS, settings)
+        source_digest = None
+        cache_hit = False
+        if self.result_cache is not None:
+            source_digest = hash_file(src_path)
+            if data is None:
+                cached = self.result_cache.get(source_digest, params)
+                if cached is not None:
+                    data = cached[0]
+                    cache_hit = True
+                    self.cache.put(key, data)
+
+        if data is None:
+            if rgb_buffer is not None:
+                data = resize_and_encode(buffer_to_pil(rgb_buffer, size), resolution,
+                                         quality, encoder=encoder, settings=settings)
+            else:
+                # decode at a smaller DCT scale if the image is made much smaller
+                with open_draft(src_path, resolution) as pil_img:
+                    data = resize_and_encode(pil_img, resolution, quality,
+                                             encoder=encoder, settings=settings)
+            self.cache.put(key, data)
+
+        write_file_atomic(dst_path, data)
+        result = {"path": dst_path,
+                  "size": len(data),
+                  "seconds": time.perf_counter() - start,
+                  "cache_hit": cache_hit}
+        if source_digest is not None and not cache_hit:
+            result["cached_meta"] = self.result_cache.put(
+                source_digest, params, data, {"size": len(data),
+                                              "seconds": result["seconds"]})
+        result["source_digest"] = source_digest
+        return result
@@ -0,0 +1,486 @@
+import asyncio
+import functools
+import hashlib
+import io
+import json
+import math
+import os
+import signal
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+from processing.encoders import (DEFAULT_ENCODER, DEFAULT_SETTINGS, ENCODERS,
+                                 METADATA_CHOICES, SUBSAMPLINGS, get_encoder,
+                                 read_metadata, resolve_settings)
+from processing.pipeline import (format_byte_count, parse_byte_count, pil_to_rgb_buffer,
+                                 resize_and_encode, scale_resolution)
+from processing.target_size import TargetSizeSolver
+
+DEFAULT_PORT = 8080
+DEFAULT_MAX_BODY_BYTES = 64 * 1024 * 1024
+CHUNK_BYTES = 64 * 1024  # request and response bodies are read and written this much
+MAX_LATENCIES = 10_000  # the percentiles are over this many of the last requests
+STATUS_TEXTS = {100: "Continue", 200: "OK", 400: "Bad Request", 404: "Not Found",
+                405: "Method Not Allowed", 411: "Length Required",
+                413: "Content Too Large", 422: "Unprocessable Content",
+                500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class HttpError(Exception):
+    """
+    Ends a request with status and message as a plain text response
+    """
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+def percentile(values, percent):
+    """
+    Returns the value percent % of values are at or below (nearest rank), or None if
+    values is empty
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * percent / 100) - 1)]
+
+
+def parse_bool(name, text):
+    if text.lower() in ("1", "true", "yes", "on"):
+        return True
+    if text.lower() in ("0", "false", "no", "off"):
+        return False
+    raise HttpError(400, f"{name} must be true or false")
+
+
+def parse_compress_params(query):
+    """
+    Reads the options of POST /compress from its query string, like
+    "quality=80&width=800" or "target_size=100KB&format=webp". Raises HttpError if
+    one is invalid. Returns the keyword arguments of compress_bytes
+    """
+    values = {name: items[-1] for name, items in parse_qs(query).items()}
+    unknown = set(values) - {"quality", "scale", "width", "height", "target_size",
+                             "format", "optimize", "progressive", "subsampling",
+                             "metadata"}
+    if unknown:
+        raise HttpError(400, f"Unknown parameter: {sorted(unknown)[0]}")
+
+    params = {"quality": 85, "scale": 1.0, "width": None, "height": None,
+              "target_size": None, "encoder": values.get("format", DEFAULT_ENCODER),
+              "encoder_settings": dict(DEFAULT_SETTINGS)}
+    try:
+        for name in ("quality", "width", "height"):
+            if name in values:
+                params[name] = int(values[name])
+        if "scale" in values:
+            params["scale"] = float(values["scale"])
+    except ValueError:
+        raise HttpError(400, "quality, width and height must be whole numbers and "
+                             "scale a number") from None
+
+    if not 1 <= params["quality"] <= 100:
+        raise HttpError(400, "quality must be between 1 and 100")
+    if not 0 < params["scale"] <= 1:
+        raise HttpError(400, "scale must be greater than 0 and at most 1")
+    if any(params[name] is not None and params[name] < 1 for name in ("width", "height")):
+        raise HttpError(400, "width and height must be at least 1")
+    if "target_size" in values:
+        params["target_size"] = parse_byte_count(values["target_size"])
+        if not params["target_size"]:
+            raise HttpError(400, "target_size must be a size like 100KB or 20000")
+    if params["encoder"] not in ENCODERS:
+        raise HttpError(400, f"format must be one of {', '.join(ENCODERS)}")
+
+    settings = params["encoder_settings"]
+    for name in ("optimize", "progressive"):
+        if name in values:
+            settings[name] = parse_bool(name, values[name])
+    if "subsampling" in values:
+        if values["subsampling"] not in SUBSAMPLINGS:
+            raise HttpError(400, f"subsampling must be one of {', '.join(SUBSAMPLINGS)}")
+        settings["subsampling"] = values["subsampling"]
+    if "metadata" in values:
+        metadata = values["metadata"].replace("-", " ")
+        if metadata not in METADATA_CHOICES:
+            raise HttpError(400, "metadata must be strip, keep or no-thumbnail")
+        settings["metadata"] = metadata
+    return params
+
+
+def ignore_interrupts():
+    # Ctrl+C reaches the worker processes too, the server stops them itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def compress_bytes(data, quality, scale, width, height, target_size, encoder,
+                   encoder_settings, cache=None):
+    """
+    Runs inside a worker process. Decodes the image in data, resizes it to width and
+    height (the other one keeps the aspect ratio if only one is given) or by scale,
+    and encodes it at quality, or at the highest quality and resolution fitting
+    inside target_size bytes. Returns a dict with the encoded "data", "quality",
+    "resolution" and "seconds", or with "status" and "error" if it failed
+    """
+    start = time.perf_counter()
+    params = ("service", quality, scale, width, height, target_size, encoder,
+              tuple(sorted(encoder_settings.items())))
+    source_digest = None
+    if cache is not None:
+        source_digest = hashlib.sha256(data).hexdigest()
+        cached = cache.get(source_digest, params)
+        if cached is not None:
+            return dict(cached[1]["result"], data=cached[0], cache_hit=True,
+                        seconds=time.perf_counter() - start,
+                        seconds_saved=cached[1]["seconds"])
+
+    try:
+        with Image.open(io.BytesIO(data)) as pil_img:
+            org_width, org_height = pil_img.size
+            if width is None and height is None:
+                resolution = scale_resolution(pil_img.size, scale)
+            else:
+                resolution = (width or max(1, round(org_width * height / org_height)),
+                              height or max(1, round(org_height * width / org_width)))
+            if resolution[0] > org_width or resolution[1] > org_height:
+                return {"status": 400, "error": f"The image is only {org_width} x "
+                                                f"{org_height}, it is not made bigger"}
+
+            # decoded here so that an image which cannot be read is told apart from
+            # one which cannot be encoded, which is not the client's fault
+            pil_img.draft("RGB", resolution)
+            pil_img.load()
+            settings = resolve_settings(encoder_settings, read_metadata(pil_img))
+            try:
+                if target_size is None:
+                    output = resize_and_encode(pil_img, resolution, quality,
+                                               encoder=encoder, settings=settings)
+                    result = {"quality": quality, "resolution": resolution}
+                else:
+                    solver = TargetSizeSolver(pil_to_rgb_buffer(pil_img), pil_img.size,
+                                              encoder=encoder, settings=settings)
+                    found = solver.solve(target_size, resolution)
+                    if not found["fits"]:
+                        return {"status": 422,
+                                "error": f"The image does not fit in "
+                                         f"{format_byte_count(target_size)}"}
+                    output = found["data"]
+                    result = {"quality": found["quality"],
+                              "resolution": found["resolution"],
+                              "encodes": found["encodes"]}
+            except (OSError, ValueError, MemoryError) as ex:
+                return {"status": 500, "error": f"Cannot encode the image: {ex}"}
+    except Image.UnidentifiedImageError:
+        return {"status": 400, "error": "The body is not an image in a known format"}
+    except (OSError, ValueError, Image.DecompressionBombError) as ex:
+        return {"status": 400, "error": f"Cannot read the image: {ex}"}
+
+    result["seconds"] = time.perf_counter() - start
+    if cache is not None:
+        cache.put(source_digest, params, output,
+                  {"result": result, "size": len(output), "seconds": result["seconds"]})
+    return dict(result, data=output, cache_hit=False)
+
+
+class CompressionService:
+    """
+    A small HTTP/1.1 server compressing images sent to POST /compress with the same
+    pipeline as the save button, on a pool of jobs processes. The connections are
+    handled with asyncio, so waiting for slow clients costs no process. At most jobs
+    images are compressed at once and at most queue_size more wait for a process;
+    requests beyond that are answered with 503 straight away, before their body is
+    read. GET /stats returns the counts and latency percentiles as JSON
+    """
+
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, jobs=1, queue_size=16,
+                 max_body_bytes=DEFAULT_MAX_BODY_BYTES, cache=None,
+                 status_interval=10.0, out=print):
+        self.host = host
+        self.port = port
+        self.jobs = jobs
+        self.queue_size = queue_size
+        self.max_body_bytes = max_body_bytes
+        self.cache = cache
+        self.status_interval = status_interval
+        self.out = out
+
+        self.executor = None
+        self.slots = None  # semaphore of the worker processes, made inside the loop
+        self.pending = 0  # compress requests being read, waiting or compressed
+        self.running = 0
+        self.counts = {"requests": 0, "ok": 0, "rejected": 0, "failed": 0,
+                       "cache_hits": 0}
+        self.latencies = deque(maxlen=MAX_LATENCIES)  # seconds of each ok request
+        self.queue_times = deque(maxlen=MAX_LATENCIES)
+        self.start_time = time.monotonic()
+        self.last_status = None
+
+    async def serve(self):
+        """
+        Serves until the task is cancelled, for example by Ctrl+C in asyncio.run
+        """
+        Image.init()  # loads every format plugin so Image.MIME is complete
+        self.executor = ProcessPoolExecutor(max_workers=self.jobs,
+                                            initializer=ignore_interrupts)
+        self.slots = asyncio.Semaphore(self.jobs)
+        server = await asyncio.start_server(self.handle_connection, self.host,
+                                            self.port)
+        port = server.sockets[0].getsockname()[1]
+        self.out(f"Listening on http://{self.host}:{port} with {self.jobs} workers and "
+                 f"room for {self.queue_size} waiting requests, POST images to "
+                 f"/compress and GET /stats")
+        try:
+            async with server:
+                while True:
+                    await asyncio.sleep(self.status_interval)
+                    self.report_status()
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def handle_connection(self, reader, writer):
+        """
+        Answers the requests of one connection until the client closes it or one of
+        them cannot keep the connection open
+        """
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await self.read_request_head(reader)
+                    if request is None:
+                        break
+                    keep_alive = await self.handle_request(request, reader, writer)
+                except HttpError as ex:
+                    # the rest of the request may still be unread, so the connection
+                    # cannot be used again
+                    await self.send_response(writer, ex.status,
+                                             (ex.message + "\n").encode("utf-8"),
+                                             dict(ex.headers, Connection="close"))
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request_head(self, reader):
+        """
+        Returns (method, path, query, headers) of the next request, or None if the
+        client closed the connection. Header names are lowercase
+        """
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            raise HttpError(400, "Malformed request line") from None
+        if not version.startswith("HTTP/1."):
+            raise HttpError(400, "Only HTTP/1.x is supported")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, separator, value = line.decode("latin-1").partition(":")
+            if not separator:
+                raise HttpError(400, "Malformed header")
+            headers[name.strip().lower()] = value.strip()
+        # HTTP/1.0 clients close the connection unless they ask to keep it
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.0" and connection != "keep-alive":
+            headers["connection"] = "close"
+
+        url = urlsplit(target)
+        return method, url.path, url.query, headers
+
+    async def handle_request(self, request, reader, writer):
+        """
+        Answers one request. Returns False if the connection has to be closed
+        """
+        method, path, query, headers = request
+        keep_alive = headers.get("connection", "").lower() != "close"
+        response_headers = {} if keep_alive else {"Connection": "close"}
+
+        if path == "/stats":
+            if method != "GET":
+                raise HttpError(405, "Use GET", {"Allow": "GET"})
+            body = json.dumps(self.get_stats(), indent=2).encode("utf-8")
+            await self.send_response(writer, 200, body,
+                                     dict(response_headers,
+                                          **{"Content-Type": "application/json"}))
+            return keep_alive
+        if path != "/compress":
+            raise HttpError(404, "Use POST /compress or GET /stats")
+        if method != "POST":
+            raise HttpError(405, "Use POST", {"Allow": "POST"})
+
+        self.counts["requests"] += 1
+        params = parse_compress_params(query)
+        if self.pending >= self.jobs + self.queue_size:
+            self.counts["rejected"] += 1
+            raise HttpError(503, "Too many requests are waiting, try again later",
+                            {"Retry-After": "1"})
+
+        start = time.perf_counter()
+        self.pending += 1
+        try:
+            if headers.get("expect", "").lower() == "100-continue":
+                writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            data = await self.read_body(reader, headers)
+
+            queued = time.perf_counter()
+            async with self.slots:
+                started = time.perf_counter()
+                self.running += 1
+                try:
+                    result = await asyncio.get_running_loop().run_in_executor(
+                        self.executor, functools.partial(compress_bytes, data,
+                                                         cache=self.cache, **params))
+                finally:
+                    self.running -= 1
+        finally:
+            self.pending -= 1
+
+        if "error" in result:
+            self.counts["failed"] += 1
+            await self.send_response(writer, result["status"],
+                                     (result["error"] + "\n").encode("utf-8"),
+                                     response_headers)
+            return keep_alive
+
+        self.counts["ok"] += 1
+        self.counts["cache_hits"] += result["cache_hit"]
+        if self.cache is not None:
+            self.cache.count_result(result)
+        resolution = result["resolution"]
+        response_headers.update({
+            "Content-Type": Image.MIME.get(get_encoder(params["encoder"]).pil_format,
+                                           "application/octet-stream"),
+            "X-Input-Bytes": str(len(data)),
+            "X-Output-Bytes": str(len(result["data"])),
+            "X-Resolution": f"{resolution[0]}x{resolution[1]}",
+            "X-Quality": str(result["quality"]),
+            "X-Cache": "hit" if result["cache_hit"] else "miss",
+            "Server-Timing": (f"read;dur={(queued - start) * 1000:.1f}, "
+                              f"queue;dur={(started - queued) * 1000:.1f}, "
+                              f"compress;dur={result['seconds'] * 1000:.1f}")})
+        await self.send_response(writer, 200, result["data"], response_headers)
+        self.latencies.append(time.perf_counter() - start)
+        self.queue_times.append(started - queued)
+        return keep_alive
+
+    async def read_body(self, reader, headers):
+        """
+        Reads the request body a chunk at a time, with either a Content-Length or
+        chunked transfer encoding. Raises HttpError if it is bigger than
+        max_body_bytes
+        """
+        body = bytearray()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await reader.readline()
+                try:
+                    size = int(size_line.split(b";")[0], 16)
+                except ValueError:
+                    raise HttpError(400, "Malformed chunk") from None
+                if size == 0:
+                    while await reader.readline() not in (b"\r\n", b"\n", b""):
+                        pass  # trailer headers are not used
+                    return bytes(body)
+                if len(body) + size > self.max_body_bytes:
+                    raise HttpError(413, f"Images can be at most "
+                                         f"{format_byte_count(self.max_body_bytes)}")
+                body += await reader.readexactly(size)
+                await reader.readline()  # the line break after the chunk
+
+        if "content-length" not in headers:
+            raise HttpError(411, "Send a Content-Length or use chunked encoding")
+        try:
+            length = int(headers["content-length"])
+        except ValueError:
+            raise HttpError(400, "Malformed Content-Length") from None
+        if length > self.max_body_bytes:
+            raise HttpError(413, f"Images can be at most "
+                                 f"{format_byte_count(self.max_body_bytes)}")
+        while len(body) < length:
+            body += await reader.readexactly(min(CHUNK_BYTES, length - len(body)))
+        return bytes(body)
+
+    async def send_response(self, writer, status, body, headers):
+        """
+        Writes the response a chunk at a time, waiting for the client to take each
+        one so a slow client never has the whole body buffered
+        """
+        lines = [f"HTTP/1.1 {status} {STATUS_TEXTS.get(status, '')}",
+                 f"Content-Length: {len(body)}"]
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        if "Content-Type" not in headers:
+            lines.append("Content-Type: text/plain; charset=utf-8")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+        view = memoryview(body)
+        for offset in range(0, len(body), CHUNK_BYTES):
+            writer.write(view[offset:offset + CHUNK_BYTES])
+            await writer.drain()
+        await writer.drain()
+
+    def get_stats(self):
+        """
+        Returns the counts, queue depth and latencies so far as a dict
+        """
+        latencies = list(self.latencies)
+        queue_times = list(self.queue_times)
+
+        def to_ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 2)
+
+        return dict(self.counts,
+                    pending=self.pending,
+                    running=self.running,
+                    waiting=self.pending - self.running,
+                    uptime_seconds=round(time.monotonic() - self.start_time, 1),
+                    p50_ms=to_ms(percentile(latencies, 50)),
+                    p99_ms=to_ms(percentile(latencies, 99)),
+                    queue_p50_ms=to_ms(percentile(queue_times, 50)),
+                    queue_p99_ms=to_ms(percentile(queue_times, 99)))
+
+    def format_stats(self):
+        stats = self.get_stats()
+        text = (f"{stats['requests']} requests: {stats['ok']} ok, {stats['rejected']} "
+                f"rejected, {stats['failed']} failed, {stats['pending']} in progress")
+        if stats["p50_ms"] is not None:
+            text += (f" | latency p50 {stats['p50_ms']:.1f} ms, p99 "
+                     f"{stats['p99_ms']:.1f} ms, queue p99 "
+                     f"{stats['queue_p99_ms']:.1f} ms")
+        return text
+
+    def report_status(self):
+        status = self.format_stats()
+        if status != self.last_status:
+            self.out(status)
+            self.last_status = status
+
+
+def run_service(host, port, jobs=None, queue_size=16, cache=None, out=print):
+    """
+    Runs the compression service until Ctrl+C is pressed, then writes its stats
+    """
+    service = CompressionService(host, port, jobs or os.cpu_count() or 1, queue_size,
+                                 cache=cache, out=out)
+    try:
+        asyncio.run(service.serve())
+    except KeyboardInterrupt:
+        pass
+    out(service.format_stats())
+    if cache is not None:
+        cache.trim()
+        out(cache.format_stats())
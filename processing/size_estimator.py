@@ -0,0 +1,229 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from processing.encoders import DEFAULT_ENCODER, get_encoder
+from processing.pipeline import buffer_to_pil, resize_and_encode, scale_resolution
+
+DEFAULT_SCALES = (1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1, 0.05, 0.01)
+
+
+def make_mosaic(pil_img, scale, tile_size, tiles_per_side, resample):
+    """
+    Returns tiles_per_side x tiles_per_side tiles spread over pil_img, each resized
+    by scale the way the whole image would be, joined into one small image. Its bytes
+    per pixel when encoded are close to those of the whole image at that scale
+    """
+    width, height = pil_img.size
+    mosaic = Image.new("RGB", (tile_size * tiles_per_side, tile_size * tiles_per_side))
+
+    # part of the original image which becomes one tile after resizing
+    box_w = min(width, tile_size / scale)
+    box_h = min(height, tile_size / scale)
+    for row in range(tiles_per_side):
+        for col in range(tiles_per_side):
+            x = (width - box_w) * (col + 0.5) / tiles_per_side
+            y = (height - box_h) * (row + 0.5) / tiles_per_side
+            tile_img = pil_img.resize((tile_size, tile_size), resample,
+                                      box=(x, y, x + box_w, y + box_h))
+            mosaic.paste(tile_img, (col * tile_size, row * tile_size))
+    return mosaic
+
+
+class SizeEstimator:
+    """
+    Predicts the encoded size of an image for every quality from 1 to 100 and a set
+    of resolution scales without encoding the whole image each time.
+
+    For each scale, tiles spread over the image are resized the same way the whole
+    image would be and joined into a small mosaic. The mosaic is encoded at every
+    quality to get the bytes per pixel, which is multiplied by the pixel count of
+    the real resolution. A few real encodes of the full image correct the
+    difference between the mosaic and the real image. Encoders without a quality
+    setting are measured at one quality which stands for all of them
+    """
+
+    def __init__(self, rgb_buffer, size, resample, scales=DEFAULT_SCALES, tile_size=64,
+                 tiles_per_side=6, calibration_qualities=(10, 40, 70, 90, 100),
+                 calibration_scales=(1.0, 0.5, 0.25), workers=4,
+                 encoder=DEFAULT_ENCODER, settings=None):
+        self.rgb_buffer = rgb_buffer
+        self.size = tuple(size)
+        self.resample = resample
+        self.encoder = encoder
+        self.settings = settings
+        self.has_quality = get_encoder(encoder).has_quality
+        self.scales = sorted(scales)
+        self.tile_size = tile_size
+        self.tiles_per_side = tiles_per_side
+        if not self.has_quality:
+            calibration_qualities = (100,)
+        self.calibration_qualities = calibration_qualities
+        self.calibration_scales = sorted(calibration_scales)
+        self.workers = workers
+
+        self.bytes_per_pixel = {}  # scale -> list of bytes per pixel for quality 1-100
+        self.header_sizes = []  # size of an image without any pixels for quality 1-100
+        self.corrections = {}  # scale -> {quality -> real size / estimated size}
+        self.is_ready = False
+        self.is_cancelled = False
+        self.error = None  # message of the exception which stopped build
+
+        self.lock = threading.Lock()
+        self.error_count = 0
+        self.error_sum = 0.0  # sum of absolute relative errors
+        self.max_error = 0.0
+
+    def cancel(self):
+        self.is_cancelled = True
+
+    def is_finished(self):
+        """
+        Returns True once build is over: ready, cancelled or stopped by an error
+        """
+        return self.is_ready or self.is_cancelled or self.error is not None
+
+    def get_qualities(self):
+        return range(1, 101) if self.has_quality else (100,)
+
+    def get_sizes_per_quality(self, sizes):
+        """
+        Returns sizes, measured at get_qualities, as a list for quality 1-100
+        """
+        return sizes if self.has_quality else sizes * 100
+
+    def measure_scale(self, scale):
+        mosaic = make_mosaic(buffer_to_pil(self.rgb_buffer, self.size), scale,
+                             self.tile_size, self.tiles_per_side, self.resample)
+        pixel_count = mosaic.width * mosaic.height
+        sizes = []
+        for quality in self.get_qualities():
+            if self.is_cancelled:
+                return scale, None
+            data_size = len(resize_and_encode(mosaic, None, quality,
+                                              encoder=self.encoder,
+                                              settings=self.settings))
+            sizes.append((data_size - self.header_sizes[quality - 1]) / pixel_count)
+        return scale, self.get_sizes_per_quality(sizes)
+
+    def measure_headers(self):
+        """
+        The headers of an image have the same size whatever the resolution, so they
+        are measured with a tiny image and left out of the bytes per pixel
+        """
+        tiny_img = Image.new("RGB", (8, 8))
+        self.header_sizes = self.get_sizes_per_quality(
+            [len(resize_and_encode(tiny_img, None, quality, encoder=self.encoder,
+                                   settings=self.settings))
+             for quality in self.get_qualities()])
+
+    def encode_full(self, quality, scale=1.0):
+        pil_img = buffer_to_pil(self.rgb_buffer, self.size)
+        resolution = scale_resolution(self.size, scale)
+        return len(resize_and_encode(pil_img, resolution, quality, self.resample,
+                                     self.encoder, self.settings))
+
+    def build(self):
+        """
+        Measures the mosaics of every scale and the real encodes used to correct them.
+        Meant to run on a background thread, is_ready is set once it is done. If an
+        encode fails, error is set instead
+        """
+        try:
+            self.measure_headers()
+            with ThreadPoolExecutor(max_workers=self.workers,
+                                    thread_name_prefix="size-estimator") as executor:
+                try:
+                    self.measure(executor)
+                finally:
+                    # encodes which have not started are not needed after a failure
+                    executor.shutdown(cancel_futures=True)
+        except Exception as ex:
+            self.error = str(ex)
+            return
+        self.is_ready = not self.is_cancelled
+
+    def measure(self, executor):
+        real_sizes = {(s, q): executor.submit(self.encode_full, q, s)
+                      for s in self.calibration_scales
+                      for q in self.calibration_qualities}
+        for scale, sizes in executor.map(self.measure_scale, self.scales):
+            if sizes is None:
+                return
+            self.bytes_per_pixel[scale] = sizes
+
+        for (scale, quality), future in real_sizes.items():
+            resolution = scale_resolution(self.size, scale)
+            real_pixel_bytes = future.result() - self.header_sizes[quality - 1]
+            estimate = self.estimate_pixel_bytes(quality, resolution)
+            self.corrections.setdefault(scale, {})[quality] = (real_pixel_bytes
+                                                               / estimate)
+
+    def estimate_pixel_bytes(self, quality, resolution):
+        # find the two measured scales around the scale of resolution and interpolate
+        scale = min(1.0, resolution[0] / self.size[0])
+        upper = next((s for s in self.scales if s >= scale), self.scales[-1])
+        lower = max((s for s in self.scales if s <= scale), default=self.scales[0])
+        bpp_upper = self.bytes_per_pixel[upper][quality - 1]
+        bpp_lower = self.bytes_per_pixel[lower][quality - 1]
+        if upper == lower:
+            bpp = bpp_upper
+        else:
+            t = (scale - lower) / (upper - lower)
+            bpp = bpp_lower + (bpp_upper - bpp_lower) * t
+        return bpp * resolution[0] * resolution[1]
+
+    @staticmethod
+    def interpolate(points, x):
+        """
+        Linear interpolation between the (x, y) pairs of the dict points. Values
+        outside the known range use the nearest end
+        """
+        keys = sorted(points)
+        if x <= keys[0]:
+            return points[keys[0]]
+        if x >= keys[-1]:
+            return points[keys[-1]]
+        for low, high in zip(keys, keys[1:]):
+            if low <= x <= high:
+                t = (x - low) / (high - low)
+                return points[low] + (points[high] - points[low]) * t
+
+    def get_correction(self, quality, scale):
+        by_scale = {s: self.interpolate(corrections, quality)
+                    for s, corrections in self.corrections.items()}
+        return self.interpolate(by_scale, scale)
+
+    def estimate(self, quality, resolution):
+        """
+        Returns the predicted encoded size in bytes, or None if build has not finished
+        """
+        if not self.is_ready:
+            return None
+        quality = max(1, min(100, int(quality)))
+        scale = resolution[0] / self.size[0]
+        pixel_bytes = (self.estimate_pixel_bytes(quality, resolution) *
+                       self.get_correction(quality, scale))
+        return int(pixel_bytes + self.header_sizes[quality - 1])
+
+    def record_actual(self, quality, resolution, actual_size):
+        """
+        Compares a real encode with the prediction for it and keeps track of the error
+        """
+        estimate = self.estimate(quality, resolution)
+        if estimate is None or actual_size == 0:
+            return
+        error = abs(estimate - actual_size) / actual_size
+        with self.lock:
+            self.error_count += 1
+            self.error_sum += error
+            self.max_error = max(self.max_error, error)
+
+    def get_error_stats(self):
+        with self.lock:
+            if self.error_count == 0:
+                return None
+            return {"count": self.error_count,
+                    "mean": self.error_sum / self.error_count,
+                    "max": self.max_error}
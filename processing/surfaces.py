@@ -0,0 +1,10 @@
+import pygame
+
+
+def buffer_to_surface(rgb_buffer, size):
+    """
+    Returns a pygame surface which uses rgb_buffer as its pixels without copying it.
+    The buffer must stay alive as long as the surface is used, pygame keeps a
+    reference to it for that
+    """
+    return pygame.image.frombuffer(rgb_buffer, size, "RGBX")
@@ -0,0 +1,168 @@
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from processing.encoders import (DEFAULT_ENCODER, DEFAULT_SETTINGS, get_encoder,
+                                 read_metadata, resolve_settings)
+from processing.pipeline import (buffer_to_pil, pil_to_rgb_buffer, resize_and_encode,
+                                 scale_resolution, write_file_atomic)
+
+
+class TargetSizeSolver:
+    """
+    Finds the highest quality (and if needed the largest resolution) at which an
+    image fits inside a byte budget. Every probe is a real encode, so the size of
+    each probe is remembered and reused by later searches on the same image.
+    Encoders without a quality setting only search the resolution
+    """
+
+    def __init__(self, rgb_buffer, size, resample=Image.Resampling.LANCZOS,
+                 probes_per_round=3, max_resolution_steps=6, encoder=DEFAULT_ENCODER,
+                 settings=None):
+        self.size = tuple(size)
+        self.resample = resample
+        self.encoder = encoder
+        self.settings = settings
+        self.probes_per_round = probes_per_round
+        self.max_resolution_steps = max_resolution_steps
+
+        self.probe_sizes = {}  # (quality, resolution) -> encoded size in bytes
+        # resolution -> RGB pixels resized once and reused by every probe
+        self.resized_buffers = {self.size: rgb_buffer}
+        self.encode_count = 0
+
+    def get_resized_buffer(self, resolution):
+        if resolution not in self.resized_buffers:
+            pil_img = buffer_to_pil(self.resized_buffers[self.size], self.size)
+            resized_img = pil_img.resize(resolution, self.resample)
+            self.resized_buffers[resolution] = pil_to_rgb_buffer(resized_img)
+        return self.resized_buffers[resolution]
+
+    def encode(self, quality, resolution):
+        # a new image object every time so that parallel encodes do not share one
+        pil_img = buffer_to_pil(self.get_resized_buffer(resolution), resolution)
+        return resize_and_encode(pil_img, None, quality, encoder=self.encoder,
+                                 settings=self.settings)
+
+    def probe(self, executor, qualities, resolution):
+        """
+        Encodes the image at every quality which has not been tried yet, in parallel.
+        Returns the data of each new encode keyed by quality
+        """
+        new_qualities = [q for q in qualities if (q, resolution) not in self.probe_sizes]
+        # resize in this thread so that the parallel encodes never resize twice
+        self.get_resized_buffer(resolution)
+        results = executor.map(lambda q: self.encode(q, resolution), new_qualities)
+
+        encoded = {}
+        for quality, data in zip(new_qualities, results):
+            self.probe_sizes[(quality, resolution)] = len(data)
+            encoded[quality] = data
+        self.encode_count += len(new_qualities)
+        return encoded
+
+    def search_quality(self, executor, max_bytes, resolution, min_quality):
+        """
+        Bisection over quality. Each round splits the unknown range with
+        probes_per_round encodes running at the same time. Returns the highest
+        quality that fits, or None if even min_quality is too big
+        """
+        fits = min_quality - 1  # highest quality known to fit
+        too_big = 101  # lowest quality known to be too big
+        best_data = None
+
+        while too_big - fits > 1:
+            gap = too_big - fits
+            count = min(self.probes_per_round, gap - 1)
+            qualities = {fits + max(1, round(gap * i / (count + 1)))
+                         for i in range(1, count + 1)}
+            if fits < min_quality:
+                # always find out in the first round if min_quality fits at all
+                qualities = {min_quality} | set(sorted(qualities)[1:])
+            qualities = sorted(qualities)
+
+            encoded = self.probe(executor, qualities, resolution)
+            for quality in qualities:
+                if self.probe_sizes[(quality, resolution)] <= max_bytes:
+                    if quality > fits:
+                        fits = quality
+                        best_data = encoded.get(quality)
+                else:
+                    too_big = min(too_big, quality)
+            if fits < min_quality and too_big == min_quality:
+                return None, None
+
+        if best_data is None:
+            # the size came from an earlier search so the bytes have to be made again
+            best_data = self.encode(fits, resolution)
+            self.encode_count += 1
+        return fits, best_data
+
+    def solve(self, max_bytes, max_resolution=None, min_quality=1):
+        """
+        Returns a dict with the quality, resolution, size and encoded data of the
+        largest output that fits in max_bytes, along with the number of encodes the
+        search took. "fits" is False if nothing fits even at the smallest resolution
+        """
+        resolution = tuple(max_resolution or self.size)
+        if not get_encoder(self.encoder).has_quality:
+            min_quality = 100  # every quality gives the same output, so try only one
+        encodes_before = self.encode_count
+        best = None
+
+        with ThreadPoolExecutor(max_workers=self.probes_per_round) as executor:
+            for _ in range(self.max_resolution_steps + 1):
+                quality, data = self.search_quality(executor, max_bytes, resolution,
+                                                    min_quality)
+                if quality is not None:
+                    best = (quality, resolution, data)
+                    break
+
+                # Not even min_quality fits so shrink the image. Size grows roughly
+                # with the number of pixels, so scale both sides by the square root
+                size = self.probe_sizes[(min_quality, resolution)]
+                scale = math.sqrt(max_bytes / size) * 0.95
+                new_resolution = scale_resolution(resolution, scale)
+                if new_resolution == resolution:
+                    break
+                resolution = new_resolution
+
+        result = {"encodes": self.encode_count - encodes_before, "fits": best is not None}
+        if best is None:
+            result.update(quality=min_quality, resolution=resolution, data=None,
+                          size=self.probe_sizes[(min_quality, resolution)])
+        else:
+            quality, resolution, data = best
+            result.update(quality=quality, resolution=resolution, data=data,
+                          size=len(data))
+        return result
+
+
+def compress_file_to_size(src_path, dst_path, max_bytes, scale=1.0, min_quality=1,
+                          encoder=DEFAULT_ENCODER, settings=DEFAULT_SETTINGS):
+    """
+    Same as compress_file but the quality and resolution are searched so that the
+    output fits inside max_bytes. scale sets the largest resolution allowed
+    """
+    start = time.perf_counter()
+    with Image.open(src_path) as pil_img:
+        max_resolution = scale_resolution(pil_img.size, scale)
+        pil_img.draft("RGB", max_resolution)
+        settings = resolve_settings(settings, read_metadata(pil_img))
+        solver = TargetSizeSolver(pil_to_rgb_buffer(pil_img), pil_img.size,
+                                  encoder=encoder, settings=settings)
+    result = solver.solve(max_bytes, max_resolution, min_quality)
+
+    data = result.pop("data")
+    if data is not None:
+        write_file_atomic(dst_path, data)
+
+    result.update(path=src_path,
+                  output_path=dst_path,
+                  input_bytes=os.path.getsize(src_path),
+                  output_bytes=result["size"],
+                  seconds=time.perf_counter() - start)
+    return result
@@ -0,0 +1,412 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from processing.batch import (compress_job, describe_result, describe_settings,
+                              list_batch_files)
+from processing.encoders import (DEFAULT_ENCODER, DEFAULT_SETTINGS, INPUT_EXTENSIONS,
+                                 get_encoder)
+from processing.pipeline import (format_byte_count, get_modified_img_path,
+                                 write_file_atomic)
+
+JOURNAL_NAME = ".image_quality_journal.jsonl"
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004  # also sent when the modification time is set
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, length of the name after it
+
+
+class InotifyWatcher:
+    """
+    Calls on_change from its own thread whenever an image in directory is created,
+    written to, moved or deleted, using Linux's inotify through ctypes. Raises
+    OSError if inotify cannot be used, in which case the folder has to be polled
+    """
+
+    def __init__(self, directory, on_change):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                | IN_CREATE | IN_DELETE)
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"Cannot watch {directory}")
+
+        self.on_change = on_change
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, name="inotify", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.is_running:
+            # the timeout only lets stop end the thread
+            readable, _, _ = select.select([self.fd], [], [], 1.0)
+            if not readable:
+                continue
+            try:
+                events = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+
+            changed = False
+            offset = 0
+            while offset < len(events):
+                _, mask, _, name_length = INOTIFY_EVENT.unpack_from(events, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(events[offset:offset + name_length].rstrip(b"\0"))
+                offset += name_length
+                if mask & IN_IGNORED:  # the folder itself is gone
+                    self.is_running = False
+                # outputs, temporary files and the journal do not matter
+                is_image = os.path.splitext(name)[1].lower() in INPUT_EXTENSIONS
+                if mask & (IN_Q_OVERFLOW | IN_IGNORED) or is_image:
+                    changed = True
+            if changed:
+                self.on_change()
+
+    def stop(self):
+        self.is_running = False
+        self.thread.join()
+        os.close(self.fd)
+
+
+class JobJournal:
+    """
+    Remembers which files of a watched folder were compressed, in a file with one JSON
+    object per line which is only ever appended to, so a restart skips them. A file
+    counts as handled while its size and modification time are still the recorded
+    ones, so a file which is replaced is compressed again. Files which failed are
+    only tried again once they change
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # file name -> its last entry
+
+        line_count = 0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    line_count += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # the last line is cut short after a crash
+                        continue
+                    self.entries[entry["name"]] = entry
+
+        # rewrite the journal without the older entries of each file once they
+        # make up most of it
+        if line_count > 2 * len(self.entries) + 100:
+            lines = "".join(json.dumps(entry) + "\n" for entry in self.entries.values())
+            write_file_atomic(path, lines.encode("utf-8"))
+        self.file = open(path, "a", encoding="utf-8")
+
+    def is_handled(self, name, stat):
+        entry = self.entries.get(name)
+        return (entry is not None and entry["size"] == stat.st_size
+                and entry["mtime_ns"] == stat.st_mtime_ns)
+
+    def record(self, entry):
+        """
+        Adds entry, a dict with at least "name", "size" and "mtime_ns", and makes
+        sure it is on disk before returning
+        """
+        self.entries[entry["name"]] = entry
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class FolderWatch:
+    """
+    Compresses images as they appear in directory, across a pool of jobs processes,
+    the same way run_batch does. A file is only read once its size and modification
+    time have not changed for settle_seconds, or it was last modified longer ago
+    than that, so files still being copied in are left alone. Finished files are
+    recorded in a JobJournal inside directory. The folder is watched with inotify
+    where it is available and scanned every poll_interval seconds otherwise
+    """
+
+    def __init__(self, directory, quality, scale, jobs=None, target_size=None,
+                 encoder=DEFAULT_ENCODER, target_score=None, metric_max_pixels=None,
+                 encoder_settings=DEFAULT_SETTINGS, settle_seconds=2.0,
+                 poll_interval=1.0, status_interval=10.0, metrics_path=None,
+                 cache=None, out=print):
+        self.directory = directory
+        self.jobs = jobs or os.cpu_count() or 1
+        self.target_size = target_size
+        self.target_score = target_score
+        self.encoder = encoder
+        # arguments of compress_job after the paths
+        self.job_args = (quality, scale, target_size, target_score, metric_max_pixels,
+                         encoder, encoder_settings, cache)
+        self.cache = cache
+        self.settings_text = describe_settings(quality, scale, target_size, encoder,
+                                               target_score, encoder_settings)
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.status_interval = status_interval
+        self.metrics_path = metrics_path
+        self.out = out
+        self.MIN_SCAN_INTERVAL = 0.1  # files being written wake the loop very often
+
+        self.journal = JobJournal(os.path.join(directory, JOURNAL_NAME))
+        self.settling = {}  # file name -> ((size, mtime_ns), time it last changed)
+        self.ready = deque()  # (path, size, mtime_ns) waiting for a worker
+        # the pool gets at most 2 files per process so ready shows the real backlog
+        self.in_progress = {}  # future -> (path, size, mtime_ns, dst_path)
+        self.outputs = {}  # output path -> name of the file saved there in this run
+
+        self.processed = 0
+        self.failed = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.finish_times = deque()  # when each file of the last minute finished
+        self.start_time = time.monotonic()
+        self.last_status = None
+        self.trimmed_at_count = 0  # files finished when the cache was last trimmed
+
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        try:
+            self.watcher = InotifyWatcher(directory, self.wake_event.set)
+        except (OSError, AttributeError):  # AttributeError if libc has no inotify
+            self.watcher = None
+        self.executor = None
+
+    def stop(self):
+        """
+        Makes run return, can be called from any thread
+        """
+        self.stop_event.set()
+        self.wake_event.set()
+
+    def run(self):
+        """
+        Watches the folder until stop is called or Ctrl+C is pressed. Returns the
+        number of files which failed
+        """
+        self.executor = ProcessPoolExecutor(max_workers=self.jobs)
+        self.out(f"Watching {self.directory} with {self.jobs} workers "
+                 f"({'inotify' if self.watcher else 'polling'}, {self.settings_text})")
+        next_status = time.monotonic() + self.status_interval
+        try:
+            while not self.stop_event.is_set():
+                scan_start = time.monotonic()
+                self.scan(scan_start)
+                self.collect_results()
+                self.submit_ready()
+                if scan_start >= next_status:
+                    self.report_status()
+                    next_status = scan_start + self.status_interval
+
+                self.wake_event.wait(self.get_wait_timeout(next_status))
+                self.wake_event.clear()
+                time.sleep(max(0.0, scan_start + self.MIN_SCAN_INTERVAL
+                               - time.monotonic()))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.out("Stopping, waiting for the files being compressed...")
+            self.stop_event.set()
+            try:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+            except KeyboardInterrupt:
+                pass
+            self.collect_results()
+            if self.watcher is not None:
+                self.watcher.stop()
+            self.journal.close()
+            self.report_status()
+            if self.cache is not None:
+                self.out(self.cache.format_stats())
+        return self.failed
+
+    def get_wait_timeout(self, next_status):
+        """
+        Returns how long the loop can sleep before it has something to do. Finished
+        jobs and inotify wake it up earlier
+        """
+        now = time.monotonic()
+        deadlines = [next_status]
+        if self.settling:
+            deadlines.append(min(changed for _, changed in self.settling.values())
+                             + self.settle_seconds)
+        if self.watcher is None:
+            deadlines.append(now + self.poll_interval)
+        return max(0.0, min(deadlines) - now)
+
+    def scan(self, now):
+        """
+        Looks for new or changed images and moves the ones which stopped changing
+        for settle_seconds to the ready queue
+        """
+        busy = {os.path.basename(path) for path, _, _ in self.ready}
+        busy.update(os.path.basename(job[0]) for job in self.in_progress.values())
+        seen = set()
+        for path in list_batch_files(self.directory):
+            name = os.path.basename(path)
+            seen.add(name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name in busy or self.journal.is_handled(name, stat):
+                self.settling.pop(name, None)
+                continue
+
+            # a file last modified long ago, like one which was there before the
+            # watch started, is not being written any more
+            signature = (stat.st_size, stat.st_mtime_ns)
+            last = self.settling.get(name)
+            if last is None and time.time() - stat.st_mtime >= self.settle_seconds:
+                last = (signature, now - self.settle_seconds)
+            if last is None or last[0] != signature:
+                self.settling[name] = (signature, now)
+            elif now - last[1] >= self.settle_seconds and stat.st_size > 0:
+                self.settling.pop(name, None)
+                self.ready.append((path, stat.st_size, stat.st_mtime_ns))
+
+        # files deleted before they settled
+        for name in list(self.settling):
+            if name not in seen:
+                del self.settling[name]
+
+    def submit_ready(self):
+        while self.ready and len(self.in_progress) < self.jobs * 2:
+            path, size, mtime_ns = self.ready.popleft()
+            name = os.path.basename(path)
+            dst_path = get_modified_img_path(path, get_encoder(self.encoder).extensions)
+
+            # photo.jpg and photo.png would both be saved as modified_photo.webp
+            owner = self.outputs.setdefault(dst_path, name)
+            if owner != name:
+                self.out(f"{name}: skipped, {owner} is saved to the same file")
+                self.journal.record({"name": name, "size": size, "mtime_ns": mtime_ns,
+                                     "status": "skipped", "time": time.time()})
+                continue
+
+            future = self.executor.submit(compress_job, path, dst_path, *self.job_args)
+            future.add_done_callback(lambda _: self.wake_event.set())
+            self.in_progress[future] = (path, size, mtime_ns, dst_path)
+
+    def collect_results(self):
+        """
+        Reports and records every finished job
+        """
+        for future in [f for f in self.in_progress if f.done()]:
+            path, size, mtime_ns, dst_path = self.in_progress.pop(future)
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except Exception as ex:  # the worker process died
+                if self.stop_event.is_set():
+                    continue  # most likely Ctrl+C, the file is tried again next time
+                result = {"path": path, "error": str(ex)}
+
+            is_done, text = describe_result(result, self.target_size, self.target_score)
+            entry = {"name": os.path.basename(path), "size": size, "mtime_ns": mtime_ns,
+                     "status": "done" if is_done else "failed", "time": time.time()}
+            if is_done:
+                self.processed += 1
+                self.input_bytes += result["input_bytes"]
+                self.output_bytes += result["output_bytes"]
+                entry.update(output=os.path.basename(dst_path),
+                             output_bytes=result["output_bytes"])
+            else:
+                self.failed += 1
+                entry["error"] = result.get("error", text)
+            if self.cache is not None:
+                self.cache.count_result(result)
+            self.finish_times.append(time.monotonic())
+            self.journal.record(entry)
+            self.out(f"[{self.processed + self.failed}] {text}")
+
+    def get_metrics(self):
+        """
+        Returns a dict with the queue depth, totals and throughput so far
+        """
+        now = time.monotonic()
+        while self.finish_times and self.finish_times[0] < now - 60:
+            self.finish_times.popleft()
+        elapsed = max(now - self.start_time, 1e-9)
+        return {"directory": self.directory,
+                "watcher": "inotify" if self.watcher is not None else "polling",
+                "settling": len(self.settling),
+                "ready": len(self.ready),
+                "in_progress": len(self.in_progress),
+                "queue_depth": len(self.ready) + len(self.in_progress),
+                "processed": self.processed,
+                "failed": self.failed,
+                "input_bytes": self.input_bytes,
+                "output_bytes": self.output_bytes,
+                "images_last_minute": len(self.finish_times),
+                "images_per_second": self.processed / elapsed,
+                "input_bytes_per_second": self.input_bytes / elapsed,
+                "uptime_seconds": elapsed}
+
+    def report_status(self):
+        """
+        Writes the metrics to metrics_path, and a summary line with out if anything
+        changed since the last one
+        """
+        # the workers only add to the cache, so old entries are deleted here
+        finished_count = self.processed + self.failed
+        if self.cache is not None and finished_count != self.trimmed_at_count:
+            self.cache.trim()
+            self.trimmed_at_count = finished_count
+        metrics = self.get_metrics()
+        if self.metrics_path is not None:
+            try:
+                write_file_atomic(self.metrics_path,
+                                  json.dumps(metrics, indent=2).encode("utf-8"))
+            except OSError as ex:
+                self.out(f"Cannot write metrics to {self.metrics_path}: {ex}")
+
+        status = (f"Queue: {metrics['settling']} settling, {metrics['ready']} waiting, "
+                  f"{metrics['in_progress']} in progress | {metrics['processed']} done, "
+                  f"{metrics['failed']} failed | {metrics['images_last_minute']} in the "
+                  f"last minute, {format_byte_count(self.input_bytes)} -> "
+                  f"{format_byte_count(self.output_bytes)}")
+        if status != self.last_status:
+            self.out(status)
+            self.last_status = status
+
+
+def run_watch(directory, quality, scale, jobs=None, target_size=None,
+              encoder=DEFAULT_ENCODER, target_score=None, metric_max_pixels=None,
+              encoder_settings=DEFAULT_SETTINGS, settle_seconds=2.0,
+              metrics_path=None, cache=None, out=print):
+    """
+    Compresses images as they appear in directory until Ctrl+C is pressed, with the
+    same settings as run_batch. Returns the number of files that failed
+    """
+    return FolderWatch(directory, quality, scale, jobs, target_size, encoder,
+                       target_score, metric_max_pixels, encoder_settings,
+                       settle_seconds, metrics_path=metrics_path, cache=cache,
+                       out=out).run()